@@ -22,7 +22,12 @@ import app.settings as settings
 
 from packaging import version
 
+from app.utils.clusters import ClusterRegistry
 from app.utils.json import JSONSchemaManager, json_api
+from app.utils.nomad_client import NomadClientManager
+from app.utils.lookups import ConcurrentLookups
+from app.utils.nodes import NodeAddressIndex
+from app.utils.tcp_ports import TcpPortPool
 
 # this is kinda tacky - we should look to see if there's a environment autoloader
 # this has to be checked against the actual environment in order to load the .env
@@ -46,6 +51,11 @@ momblish = load_corpus()
 json_schema_manager = JSONSchemaManager("../support/schemas")
 Q = RQ()
 redis_client = FlaskRedis()
+tcp_port_pool = TcpPortPool(redis_client)
+nomad_clients = NomadClientManager()
+node_addresses = NodeAddressIndex()
+nomad_clusters = ClusterRegistry(nomad_clients, node_addresses)
+nomad_lookups = ConcurrentLookups()
 Q.queues = ["email", "nomad"]
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -65,17 +75,30 @@ def create_app(env: str = "development"):
     stripe.api_key = app.config["STRIPE_KEY"]
     stripe.api_base = app.config["STRIPE_ENDPOINT"]
     from app.jobs.nomad_cleanup import check_all_boxes, find_unused_boxes
+    from app.jobs.warm_pool import refill_warm_pool
+    from app.jobs.tcp_ports import reconcile_tcp_ports
+    from app.jobs.usage import verify_usage
+    from app.jobs.hibernation import hibernate_idle_tunnels
+    from app.jobs.prepull import prepull_sshd_image
+    from app.jobs.node_load import refresh_node_load
 
     # queue job every day at noon (UTC!)
     find_unused_boxes.cron("*/15 * * * *", "Finding unused tunnels")
     check_all_boxes.cron("0 0 12 * *", "Check running tunnels")
+    refill_warm_pool.cron("* * * * *", "Refill warm sshd pool")
+    reconcile_tcp_ports.cron("*/10 * * * *", "Reconcile tcp port pool")
+    verify_usage.cron("0 * * * *", "Verify usage counters")
+    hibernate_idle_tunnels.cron("*/5 * * * *", "Hibernate idle tunnels")
+    prepull_sshd_image.cron("* * * * *", "Pre-pull sshd image")
+    refresh_node_load.cron("* * * * *", "Refresh node load index")
     from app.routes.tunnels import tunnel_blueprint
     from app.routes.subdomains import subdomain_blueprint
     from app.routes.authentication import auth_blueprint
     from app.routes.account import account_blueprint
     from app.routes.admin import admin_blueprint
     from app.routes.root import root_blueprint
-    from app.commands import plan, redis
+    from app.routes.operations import operations_blueprint
+    from app.commands import allocations, job_spec, plan, redis
 
     from querystring_parser.parser import parse as qs_parse
 
@@ -91,8 +114,11 @@ def create_app(env: str = "development"):
     app.register_blueprint(account_blueprint)
     app.register_blueprint(admin_blueprint)
     app.register_blueprint(root_blueprint)
+    app.register_blueprint(operations_blueprint)
     app.cli.add_command(plan)
     app.cli.add_command(redis)
+    app.cli.add_command(job_spec)
+    app.cli.add_command(allocations)
 
     from app.serializers import ErrorSchema
     from app.utils.errors import (
@@ -101,6 +127,7 @@ def create_app(env: str = "development"):
         TooManyRequestsError,
         NotFoundError,
         InternalServerError,
+        NomadUnavailable,
     )
     import re
 
@@ -127,6 +154,12 @@ def create_app(env: str = "development"):
     def too_many_requests(_):
         return json_api(TooManyRequestsError, ErrorSchema), 429
 
+    @app.errorhandler(NomadUnavailable)
+    def nomad_unavailable(e):
+        response = json_api(e, ErrorSchema)
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response, 503
+
     @app.errorhandler(500)
     def debug_error_handler(e):
         if env == "production":
@@ -1,10 +1,19 @@
 import stripe
 import click
 import json
+import time
+import timeit
 from flask.cli import with_appcontext
 from flask import current_app
 from app.models import Plan
-from app import db, redis_client
+from app import db, nomad_clients, nomad_clusters, redis_client, tcp_port_pool
+from app.utils.tcp_ports import TcpPortPool
+from app.services.allocation_sync import AllocationSync
+from app.services.port_reconciliation import PortReconciliation
+from app.services.prepull import ImagePrepull
+from app.utils import dispatch
+from app.utils.job_spec import build_sshd_job, dispatch_job_id, render_sshd_job
+from app.utils.timing import percentile
 from stripe.error import InvalidRequestError
 
 
@@ -83,13 +92,199 @@ def redis():
 
 
 @redis.command("populate")
+@click.option("--start", default=10000, help="First public tcp port")
+@click.option("--stop", default=25000, help="Public tcp ports end before this one")
 @with_appcontext
-def populate_redis_command():
-    populate_redis()
+def populate_redis_command(start, stop):
+    populate_redis(start, stop)
 
 
-def populate_redis():
-    """ Populate redis set"""
-    ports = list(range(10000, 25000))
-    redis_client.sadd("open_tcp_ports", *ports)
+def populate_redis(start=10000, stop=25000):
+    """ Populate redis, running it again with another range resizes the
+    tcp port pool in place"""
+    tcp_port_pool.resize(start, stop)
     redis_client.sadd("unhealthy_tunnels", 0)
+
+
+@redis.command("reconcile-ports")
+@with_appcontext
+def reconcile_ports_command():
+    """ Repair the tcp port pool against the tunnels in the database """
+    drift = PortReconciliation().run()
+    for name, count in drift.items():
+        click.echo(f"{name:10} {count}")
+
+
+@redis.command("bench-ports")
+@click.option("--start", default=10000, help="First public tcp port")
+@click.option("--stop", default=25000, help="Public tcp ports end before this one")
+@with_appcontext
+def bench_ports_command(start, stop):
+    bench_ports(start, stop)
+
+
+def bench_ports(start, stop):
+    """ Compare loading the tcp port pool as a set and as a bitmap """
+    set_key = "bench_tcp_ports_set"
+    pool = TcpPortPool(redis_client, key="bench_tcp_ports")
+    redis_client.delete(set_key, *pool.keys)
+
+    try:
+        as_set = timeit.timeit(
+            lambda: redis_client.sadd(set_key, *range(start, stop)), number=1
+        )
+        as_bitmap = timeit.timeit(lambda: pool.resize(start, stop), number=1)
+
+        for name, seconds, key in [
+            ("set", as_set, set_key),
+            ("bitmap", as_bitmap, pool.bitmap_key),
+        ]:
+            memory = redis_client.execute_command("MEMORY", "USAGE", key)
+            click.echo(
+                f"{name:6} {stop - start} ports "
+                f"load {seconds * 1000:8.1f}ms memory {memory:8} bytes"
+            )
+    finally:
+        redis_client.delete(set_key, *pool.keys)
+
+
+@click.group()
+def job_spec():
+    """ Nomad job specs """
+    pass
+
+
+@job_spec.command("bench")
+@click.option("--rounds", default=1000, help="Jobs to build per case")
+@with_appcontext
+def bench_job_spec_command(rounds):
+    bench_job_spec(rounds)
+
+
+BENCH_PORT_TYPES = [["http"], ["https"], ["tcp"], ["http", "https", "tcp", "tcp"]]
+
+
+def bench_job_spec(rounds):
+    """ Check build_sshd_job against sshd.j2.json and time them both """
+    for port_types in BENCH_PORT_TYPES:
+        tcp_ports = [
+            10000 + i if port == "tcp" else 0 for i, port in enumerate(port_types)
+        ]
+        for pool, box_name in [(False, "abox"), (True, None), (True, "abox")]:
+            args = ("ssh-client-abox", box_name, port_types, tcp_ports)
+            kwargs = dict(
+                ssh_key="ssh-rsa AAAA bench@holepunch", bandwidth="100", pool=pool
+            )
+
+            if json.loads(render_sshd_job(*args, **kwargs)) != json.loads(
+                build_sshd_job(*args, **kwargs)
+            ):
+                raise click.ClickException(
+                    f"Job specs differ for {port_types} pool={pool} box={box_name}"
+                )
+
+            template = timeit.timeit(
+                lambda: render_sshd_job(*args, **kwargs), number=rounds
+            )
+            compiled = timeit.timeit(
+                lambda: build_sshd_job(*args, **kwargs), number=rounds
+            )
+            click.echo(
+                f"{'-'.join(port_types):20} pool={pool!s:5} box={box_name!s:5} "
+                f"template {template / rounds * 1e6:8.1f}us "
+                f"compiled {compiled / rounds * 1e6:8.1f}us "
+                f"({template / compiled:.1f}x)"
+            )
+
+
+@job_spec.command("prepull")
+@with_appcontext
+def prepull_command():
+    """ Make every node pull the current sshd image """
+    for cluster in nomad_clusters.all():
+        prepull = ImagePrepull(cluster=cluster.name)
+        action = "registered" if prepull.ensure() else "unchanged"
+        click.echo(f"{cluster.name}: {current_app.config['SSHD_IMAGE']} {action}")
+        click.echo(f"{cluster.name}: {prepull.refresh()} nodes running it")
+
+
+@job_spec.command("bench-backends")
+@click.option("--tunnels", default=10000, help="Tunnels to start per backend")
+@click.option("--port", multiple=True, default=["http"], help="Port types")
+@with_appcontext
+def bench_backends_command(tunnels, port):
+    bench_backends(tunnels, list(port))
+
+
+def bench_backends(tunnels, port_types):
+    """ Start tunnels with a job each and by dispatch, comparing how long Nomad
+    takes to schedule them and how much job state it keeps for them """
+    tcp_ports = [10000 + i if port == "tcp" else 0 for i, port in enumerate(port_types)]
+    args = dict(ssh_key="ssh-rsa AAAA bench@holepunch", bandwidth="100")
+
+    def submit_job(i):
+        job_id = f"ssh-client-bench-{i}"
+        job = build_sshd_job(job_id, f"bench{i}", port_types, tcp_ports, **args)
+        response = nomad_clients.retry(
+            lambda client: client.job.request(
+                job_id,
+                data=job,
+                method="post",
+                headers={"Content-Type": "application/json"},
+            )
+        )
+        return job_id, response.json()["EvalID"]
+
+    def submit_dispatch(i):
+        response = dispatch.dispatch_sshd_job(
+            f"bench{i}", port_types, tcp_ports, args["ssh_key"], args["bandwidth"]
+        )
+        return response["DispatchedJobID"], response["EvalID"]
+
+    for backend, submit in [("job", submit_job), ("dispatch", submit_dispatch)]:
+        client = nomad_clients.client()
+        job_ids, latencies = [], []
+        try:
+            for i in range(tunnels):
+                started = time.monotonic()
+                job_id, eval_id = submit(i)
+                job_ids.append(job_id)
+                while client.evaluation.get_evaluation(eval_id)["Status"] not in (
+                    "complete",
+                    "failed",
+                    "canceled",
+                ):
+                    time.sleep(0.01)
+                latencies.append(time.monotonic() - started)
+
+            # Dispatched children are jobs of their own in Nomad's state too
+            if backend == "dispatch":
+                job_ids.append(dispatch_job_id(port_types))
+            state = sum(len(json.dumps(client.job.get_job(j))) for j in job_ids)
+        finally:
+            for job_id in job_ids:
+                client.job.deregister_job(job_id, purge=True)
+            dispatch.registered.clear()
+
+        latencies.sort()
+        click.echo(
+            f"{backend:8} {tunnels} tunnels "
+            f"scheduled p50 {percentile(latencies, 50) * 1000:8.1f}ms "
+            f"p95 {percentile(latencies, 95) * 1000:8.1f}ms "
+            f"state {state / 1e6:8.1f}MB ({state / tunnels:.0f} bytes per tunnel)"
+        )
+
+
+@click.group()
+def allocations():
+    """ Follow Nomad allocations """
+    pass
+
+
+@allocations.command("watch")
+@click.option("--cluster", default=None, help="Nomad cluster, the first if not given")
+@with_appcontext
+def watch_allocations_command(cluster):
+    """ Keep tunnels in step with their allocations until stopped, run one of
+    these for every Nomad cluster """
+    AllocationSync(cluster=cluster).run()
@@ -0,0 +1,9 @@
+from app import Q, db
+from app.services.hibernation import Hibernation
+
+
+@Q.job(func_or_queue="nomad", timeout=100000)
+def hibernate_idle_tunnels():
+    hibernated = Hibernation().run()
+    db.session.commit()
+    return hibernated
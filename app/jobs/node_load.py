@@ -0,0 +1,7 @@
+from app import Q
+from app.services.node_load import NodeLoad
+
+
+@Q.job(func_or_queue="nomad", timeout=100000)
+def refresh_node_load():
+    return NodeLoad.refresh()
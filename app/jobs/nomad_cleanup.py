@@ -1,21 +1,44 @@
 import nomad
 import consul
-from app import Q, redis_client
+from flask import current_app
+from redis.exceptions import LockError
+from app import Q, nomad_clusters, redis_client
 from app.utils.dns import discover_service
+from app.utils.errors import NomadUnavailable
+from app.services.hibernation import HIBERNATED_KEY, Hibernation
+from app.services.clusters import on_cluster
+from app.services.multiplex import Multiplexer
+from app.utils.job_spec import POOL_KV_PREFIX, multiplexed
 from datetime import timedelta
 
-from app.models import Tunnel
+from app.models import Subdomain, Tunnel
 
+from typing import Optional, Tuple
 
-@Q.job(func_or_queue="nomad", timeout=60000)
-def cleanup_old_nomad_box(job_id):
-    nomad_client = nomad.Nomad(discover_service("nomad").ip)
 
+@Q.job(func_or_queue="nomad", timeout=60000)
+def cleanup_old_nomad_box(job_id, box_name=None, cluster=None):
     try:
-        del_tunnel_nomad(nomad_client, job_id)
-    except nomad.api.exceptions.BaseNomadException:
-        cleanup_old_nomad_box.schedule(timedelta(hours=2), job_id, timeout=60000)
-        raise nomad.api.exceptions.BaseNomadException
+        if multiplexed(job_id) and box_name:
+            # Only the tunnels slot, the container is shared with the others
+            Multiplexer(job_id).release(box_name)
+        else:
+            nomad_clusters.get(cluster).nomad.retry(
+                lambda client: del_tunnel_nomad(client, job_id)
+            )
+    except (nomad.api.exceptions.BaseNomadException, NomadUnavailable, LockError):
+        # A LockError means another tunnel of the container holds its slots
+        cleanup_old_nomad_box.schedule(
+            timedelta(hours=2), job_id, box_name, cluster, timeout=60000
+        )
+        raise
+
+    redis_client.hdel(HIBERNATED_KEY, job_id)
+
+    # Warm pool containers keep their key in Consul rather than the job
+    if job_id.startswith("ssh-pool-"):
+        consul_client = consul.Consul(host=discover_service("consul").ip)
+        consul_client.kv.delete(f"{POOL_KV_PREFIX}/{job_id}", recurse=True)
 
 
 def del_tunnel_nomad(nomad_client, job_id):
@@ -24,13 +47,15 @@ def del_tunnel_nomad(nomad_client, job_id):
 
 @Q.job(func_or_queue="nomad", timeout=100000)
 def check_all_boxes():
-    nomad_client = nomad.Nomad(discover_service("nomad").ip)
-    deployments = nomad_client.job.get_deployments("ssh-client")
+    for cluster in nomad_clusters.all():
+        deployments = cluster.nomad.client().job.get_deployments("ssh-client")
 
-    for deployment in deployments:
-        tunnel_exist = Tunnel.query.filter_by(job_id=deployment).first()
-        if not tunnel_exist:
-            cleanup_old_nomad_box(deployment)
+        for deployment in deployments:
+            tunnel_exist = Tunnel.query.filter(
+                Tunnel.job_id == deployment, on_cluster(cluster.name)
+            ).first()
+            if not tunnel_exist:
+                cleanup_old_nomad_box(deployment, cluster=cluster.name)
 
 
 @Q.job(func_or_queue="nomad", timeout=100000)
@@ -51,9 +76,32 @@ def find_unused_boxes():
             if subdomain == "TCP":
                 subdomain = subdomain + "-" + health_check["ServiceName"].split("-")[2]
 
+            # Tunnels that have gone idle are hibernated instead
+            tunnel = tunnel_for(subdomain)
+            if (
+                current_app.config["HIBERNATE_AFTER"] > 0
+                and tunnel
+                and Hibernation.hibernates(tunnel)
+            ):
+                continue
+
             exists = redis_client.sismember("unhealthy_tunnels", subdomain)
             if exists:
                 redis_client.srem("unhealthy_tunnels", subdomain)
-                cleanup_old_nomad_box("ssh-client-" + subdomain)
+                job_id, cluster = job_for_subdomain(subdomain)
+                cleanup_old_nomad_box(job_id, subdomain, cluster)
             else:
                 redis_client.sadd("unhealthy_tunnels", subdomain)
+
+
+def tunnel_for(subdomain: str):
+    return Tunnel.query.join(Subdomain).filter(Subdomain.name == subdomain).first()
+
+
+def job_for_subdomain(subdomain: str) -> Tuple[str, Optional[str]]:
+    """The job of the subdomains tunnel and the cluster it runs on"""
+    # Tunnels served from the warm pool do not follow the job naming scheme
+    tunnel = tunnel_for(subdomain)
+    if tunnel:
+        return tunnel.job_id, tunnel.cluster
+    return "ssh-client-" + subdomain, None
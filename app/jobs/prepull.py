@@ -0,0 +1,19 @@
+import nomad
+from flask import current_app
+from app import Q, nomad_clusters
+from app.services.prepull import ImagePrepull
+from app.utils.errors import NomadUnavailable
+
+
+@Q.job(func_or_queue="nomad", timeout=100000)
+def prepull_sshd_image():
+    warm = 0
+    for cluster in nomad_clusters.all():
+        prepull = ImagePrepull(cluster=cluster.name)
+        try:
+            prepull.ensure()
+            warm += prepull.refresh()
+        except (nomad.api.exceptions.BaseNomadException, NomadUnavailable):
+            # The other clusters still get the image, this one next minute
+            current_app.logger.warning(f"Could not pre-pull on {cluster.name}")
+    return warm
@@ -0,0 +1,7 @@
+from app import Q
+from app.services.port_reconciliation import PortReconciliation
+
+
+@Q.job(func_or_queue="nomad", timeout=100000)
+def reconcile_tcp_ports():
+    return PortReconciliation().run()
@@ -0,0 +1,19 @@
+from app import Q, db
+from app.models import Tunnel
+
+
+@Q.job(func_or_queue="nomad", timeout=60000)
+def provision_tunnel(tunnel_id: int, ssh_key: str) -> None:
+    # Imported here as the tunnel service queues this job
+    from app.services.tunnel import TunnelCreationService
+
+    tunnel = Tunnel.query.get(tunnel_id)
+
+    # The tunnel was closed before we got around to provisioning it
+    if tunnel is None or tunnel.status != "pending":
+        return
+
+    TunnelCreationService(
+        tunnel.subdomain.user, tunnel.subdomain_id, tunnel.port, ssh_key
+    ).provision(tunnel)
+    db.session.commit()
@@ -0,0 +1,9 @@
+from app import Q, db
+from app.services.usage import Usage
+
+
+@Q.job(func_or_queue="nomad", timeout=100000)
+def verify_usage():
+    drifted = Usage.verify()
+    db.session.commit()
+    return drifted
@@ -0,0 +1,8 @@
+from app import Q
+from app.services.warm_pool import WarmPool
+
+
+@Q.job(func_or_queue="nomad", timeout=100000)
+def refill_warm_pool():
+    for port_types in WarmPool.profiles():
+        WarmPool(port_types).refill()
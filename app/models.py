@@ -6,7 +6,7 @@ from app import db
 from app.utils.errors import UserError
 from app.utils.general import memoized
 from sqlalchemy.dialects.postgresql import UUID
-from typing import NamedTuple, Union
+from typing import NamedTuple, Optional, Union
 
 
 class UserLimit(NamedTuple):
@@ -18,6 +18,8 @@ class UserLimit(NamedTuple):
 
 class AsyncJob(NamedTuple):
     id: Union[str, int]
+    status: Optional[str] = None
+    tunnel_id: Optional[int] = None
 
 
 class Subdomain(db.Model):  # type: ignore
@@ -119,14 +121,35 @@ class User(db.Model):  # type: ignore
         return plan
 
 
+class UserUsage(db.Model):  # type: ignore
+    """Open tunnels and reserved subdomains of a user, kept up to date by the
+    services creating and deleting them so limits are a single read"""
+
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), primary_key=True
+    )
+    tunnels = db.Column(db.Integer, nullable=False, default=0)
+    reserved_subdomains = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<UserUsage {} {} {}>".format(
+            self.user_id, self.tunnels, self.reserved_subdomains
+        )
+
+
 class Tunnel(db.Model):  # type: ignore
     id = db.Column(db.Integer, primary_key=True)
     port = db.Column(types.ARRAY(types.String()))
     allocated_tcp_ports = db.Column(types.ARRAY(types.Integer()))
     subdomain_id = db.Column(db.Integer, db.ForeignKey("subdomain.id"))
     ssh_port = db.Column(db.Integer)
-    job_id = db.Column(db.String(64))
+    job_id = db.Column(db.String(64), index=True)
     ip_address = db.Column(db.String(32))
+    # The slot of a multiplexed container the tunnel is served from
+    slot = db.Column(db.Integer)
+    # The Nomad cluster running the tunnels container, the first one if unset
+    cluster = db.Column(db.String(32))
+    status = db.Column(db.String(16), nullable=False, default="running")
     subdomain = db.relationship("Subdomain", backref="tunnel", lazy="joined")
 
     user = association_proxy("subdomain", "user")
@@ -2,14 +2,21 @@
 Provides CRUD operations for Tunnel Resources
 """
 
-from flask import Blueprint, request, Response, make_response
+from flask import Blueprint, request, Response, jsonify, make_response
 from flask_jwt_extended import get_jwt_identity, jwt_required
-from app import json_schema_manager, logger
+from app import (
+    json_schema_manager,
+    logger,
+    nomad_clients,
+    nomad_clusters,
+    nomad_lookups,
+)
 from app.models import Tunnel, User, Subdomain
 from app.serializers import ErrorSchema
 from app.services.tunnel import TunnelDeletionService
 from app.utils.errors import NotFoundError, TunnelError, BadRequest
 from app.utils.json import dig, json_api
+from app.utils.timing import phase_summary
 from typing import Tuple
 from jsonschema import ValidationError
 
@@ -47,3 +54,40 @@ def tunnel_admin() -> Tuple[Response, int]:
         return make_response(""), 204
     except TunnelError:
         return json_api(TunnelError, ErrorSchema), 500
+
+
+@admin_blueprint.route("/admin/nomad", methods=["GET"])
+@jwt_required
+def nomad_pool_stats() -> Tuple[Response, int]:
+    """
+    Connection pool statistics for the Nomad servers this process talks to,
+    those of the first cluster at the top and every cluster's under
+    "clusters", and how much time looking up allocations concurrently saved
+    """
+    current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
+    if current_user.tier != "admin":
+        return json_api(NotFoundError, ErrorSchema), 404
+
+    return (
+        jsonify(
+            dict(
+                nomad_clients.stats(),
+                clusters=nomad_clusters.stats(),
+                lookups=nomad_lookups.stats(),
+            )
+        ),
+        200,
+    )
+
+
+@admin_blueprint.route("/admin/timings", methods=["GET"])
+@jwt_required
+def tunnel_timings() -> Tuple[Response, int]:
+    """
+    p50, p95 and p99 in milliseconds of each phase of recent tunnel creations
+    """
+    current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
+    if current_user.tier != "admin":
+        return json_api(NotFoundError, ErrorSchema), 404
+
+    return jsonify(phase_summary("tunnel")), 200
@@ -0,0 +1,59 @@
+"""
+Batches of tunnel and subdomain changes, following the JSON:API atomic
+operations extension
+"""
+
+import json
+from flask import Blueprint, request, Response, make_response
+from flask_jwt_extended import get_jwt_identity, jwt_required
+from jsonschema import ValidationError
+
+from app import json_schema_manager
+from app.models import Subdomain, Tunnel, User
+from app.serializers import ErrorSchema, SubdomainSchema, TunnelSchema
+from app.services.operations import OperationsService
+from app.utils.errors import BadRequest, JsonApiException, NomadUnavailable
+from app.utils.json import json_api
+from typing import Tuple
+
+
+operations_blueprint = Blueprint("operations", __name__)
+
+SCHEMAS = {Subdomain: SubdomainSchema, Tunnel: TunnelSchema}
+
+
+@operations_blueprint.route("/operations", methods=["POST"])
+@jwt_required
+def run_operations() -> Tuple[Response, int]:
+    """
+    Add and remove tunnels and subdomains in one go.  Either every operation
+    is applied or none of them are
+    """
+    try:
+        json_schema_manager.validate(request.json, "operations.json")
+    except ValidationError as e:
+        return json_api(BadRequest(detail=e.message), ErrorSchema), 400
+
+    current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
+    try:
+        results = OperationsService(
+            current_user, request.json["atomic:operations"]
+        ).run()
+    except NomadUnavailable:
+        # Answered with a Retry-After, see create_app
+        raise
+    except JsonApiException as e:
+        return json_api(e, ErrorSchema), int(e.status)
+
+    response = make_response(
+        json.dumps(
+            {
+                "atomic:results": [
+                    SCHEMAS[type(result)]().dump(result).data if result else {}
+                    for result in results
+                ]
+            }
+        )
+    )
+    response.headers["Content-Type"] = "application/vnd.api+json"
+    return response, 200
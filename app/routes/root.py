@@ -1,6 +1,8 @@
 from flask import Blueprint, jsonify, current_app
 import os
 
+from app import nomad_clusters
+
 root_blueprint = Blueprint("root", __name__)
 
 
@@ -22,6 +24,27 @@ def health_check():
     return "OK"
 
 
+@root_blueprint.route("/health")
+def health():
+    """
+    Health of the services the api depends on.  Always answers 200 so load
+    balancers keep sending traffic, tunnel changes are refused with a 503
+    on their own while Nomad is down.  `nomad` is the breaker of the first
+    cluster, `clusters` has the breaker of every one
+    """
+    breakers = {
+        cluster.name: cluster.nomad.breaker.stats() for cluster in nomad_clusters.all()
+    }
+    closed = all(breaker["state"] == "closed" for breaker in breakers.values())
+    return jsonify(
+        {
+            "status": "ok" if closed else "degraded",
+            "nomad": breakers[nomad_clusters.default()],
+            "clusters": breakers,
+        }
+    )
+
+
 def source_commit():
     if current_app.env == "production":
         return open("./SOURCE_COMMIT").readline()
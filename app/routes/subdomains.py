@@ -14,6 +14,7 @@ from app.utils.errors import (
     SubdomainInUse,
     SubdomainLimitReached,
 )
+from app.utils.idempotency import idempotent
 from app.utils.json import dig, json_api
 
 subdomain_blueprint = Blueprint("subdomain", __name__)
@@ -34,6 +35,7 @@ def subdomain_index():
 
 @subdomain_blueprint.route("/subdomains", methods=["POST"])
 @jwt_required
+@idempotent
 def subdomain_reserve():
     try:
         json_schema_manager.validate(request.json, "subdomain_create.json")
@@ -2,22 +2,30 @@
 Provides CRUD operations for Tunnel Resources
 """
 
-from flask import Blueprint, request, Response, make_response
+from flask import Blueprint, request, Response, make_response, url_for
 from flask_jwt_extended import get_jwt_identity, jwt_required
 from jsonschema import ValidationError
 
 from app import json_schema_manager
 from app.models import Tunnel, User, Subdomain
-from app.serializers import ErrorSchema, TunnelSchema
-from app.services.tunnel import TunnelCreationService, TunnelDeletionService
+from app.serializers import AsyncSchema, ErrorSchema, TunnelSchema
+from app.services.tunnel import (
+    TunnelCreationService,
+    TunnelDeletionService,
+    TunnelResumeService,
+    TunnelUpdateService,
+)
 from app.utils.errors import (
     BadRequest,
     AccessDenied,
+    NomadUnavailable,
     SubdomainInUse,
     SubdomainLimitReached,
     TunnelError,
     TunnelLimitReached,
+    UnprocessableEntity,
 )
+from app.utils.idempotency import idempotent
 from app.utils.json import dig, json_api
 from typing import Tuple
 
@@ -42,6 +50,7 @@ def tunnel_index() -> Tuple[Response, int]:
 
 @tunnel_blueprint.route("/tunnels", methods=["POST"])
 @jwt_required
+@idempotent
 def start_tunnel() -> Tuple[Response, int]:
     try:
         json_schema_manager.validate(request.json, "tunnel_create.json")
@@ -52,13 +61,30 @@ def start_tunnel() -> Tuple[Response, int]:
 
         current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
         try:
-            tunnel_info = TunnelCreationService(
+            service = TunnelCreationService(
                 current_user, subdomain_id, port_types, ssh_key
-            ).create()
+            )
+            if dig(request.json, "data/attributes/reattach"):
+                tunnel_info = service.reattach()
+                if tunnel_info:
+                    return json_api(tunnel_info, TunnelSchema), 200
+
+            if "respond-async" in request.headers.get("Prefer", ""):
+                job = service.reserve()
+                response = json_api(job, AsyncSchema)
+                response.headers["Location"] = url_for(
+                    "tunnel.get_tunnel", tunnel_id=job.tunnel_id
+                )
+                return response, 202
+
+            tunnel_info = service.create()
         except SubdomainLimitReached:
             return json_api(SubdomainLimitReached, ErrorSchema), 403
         except TunnelLimitReached:
             return json_api(TunnelLimitReached, ErrorSchema), 403
+        except NomadUnavailable:
+            # Answered with a Retry-After, see create_app
+            raise
         except TunnelError:
             return json_api(TunnelError, ErrorSchema), 500
 
@@ -86,15 +112,65 @@ def stop_tunnel(tunnel_id) -> Tuple[Response, int]:
     try:
         TunnelDeletionService(current_user, tunnel).delete()
         return make_response(""), 204
+    except NomadUnavailable:
+        raise
     except TunnelError:
         return json_api(TunnelError, ErrorSchema), 500
 
 
+@tunnel_blueprint.route("/tunnels/<int:tunnel_id>", methods=["PATCH"])
+@jwt_required
+def update_tunnel(tunnel_id) -> Tuple[Response, int]:
+    """
+    Change the ports a running tunnel forwards without recreating it
+    """
+    current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
+    tunnel = Tunnel.query.filter_by(user=current_user, id=tunnel_id).first_or_404()
+
+    try:
+        json_schema_manager.validate(request.json, "tunnel_update.json")
+        port_types = dig(request.json, "data/attributes/port")
+
+        tunnel = TunnelUpdateService(current_user, tunnel, port_types).update()
+        return json_api(tunnel, TunnelSchema), 200
+    except ValidationError as e:
+        return json_api(BadRequest(detail=e.message), ErrorSchema), 400
+    except UnprocessableEntity as e:
+        return json_api(e, ErrorSchema), 422
+    except NomadUnavailable:
+        raise
+    except TunnelError as e:
+        return json_api(e, ErrorSchema), 500
+
+
+@tunnel_blueprint.route("/tunnels/<int:tunnel_id>/resume", methods=["POST"])
+@jwt_required
+def resume_tunnel(tunnel_id) -> Tuple[Response, int]:
+    """
+    Start a hibernated tunnel again on the address it had
+    """
+    current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
+    tunnel = Tunnel.query.filter_by(user=current_user, id=tunnel_id).first_or_404()
+
+    try:
+        tunnel = TunnelResumeService(current_user, tunnel).resume()
+        return json_api(tunnel, TunnelSchema), 200
+    except UnprocessableEntity as e:
+        return json_api(e, ErrorSchema), 422
+    except NomadUnavailable:
+        raise
+    except TunnelError as e:
+        return json_api(e, ErrorSchema), 500
+
+
 @tunnel_blueprint.route("/tunnels/<int:tunnel_id>", methods=["GET"])
 @jwt_required
 def get_tunnel(tunnel_id) -> Tuple[Response, int]:
     """
     Retrieve Tunnel Resource
+
+    A tunnel being provisioned is pending until it is running, or failed with
+    its subdomain free to open another one
     """
     current_user = User.query.filter_by(uuid=get_jwt_identity()).first_or_404()
     tunnel = Tunnel.query.filter_by(user=current_user, id=tunnel_id).first_or_404()
@@ -16,6 +16,10 @@ class TunnelSchema(Schema):
     ssh_port = fields.Str()
     ip_address = fields.Str()
     allocated_tcp_ports = fields.List(fields.Str())
+    # Forwards of tunnels sharing a container go to its ports moved up by
+    # SLOT_STRIDE times the slot, see app.utils.job_spec
+    slot = fields.Int(allow_none=True)
+    status = fields.Str()
     subdomain = fields.Relationship(
         "/subdomains/{subdomain_id}",
         related_url_kwargs={"subdomain_id": "<subdomain_id>"},
@@ -71,3 +75,7 @@ class AsyncSchema(Schema):
         self = "<url>"
 
     id = fields.Str()
+    status = fields.Str()
+    tunnel = fields.Relationship(
+        attribute="tunnel_id", include_resource_linkage=True, type_="tunnel"
+    )
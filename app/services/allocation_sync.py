@@ -0,0 +1,135 @@
+import random
+import time
+import nomad
+import requests
+from dpath.util import values
+from flask import current_app
+from redis.exceptions import RedisError
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import db, nomad_clusters
+from app.models import Tunnel
+from app.services.clusters import on_cluster
+from app.services.tunnel import TunnelDeletionService
+from app.utils.allocations import FAILED_STATUSES
+from app.utils.errors import TunnelError
+
+from typing import Dict, List, Optional
+
+
+class AllocationSync:
+    """Keeps Tunnel rows in step with their Nomad allocations.
+
+    Follows `/v1/allocations` with blocking queries and writes every change
+    seen in one round trip in a single transaction, so reading a tunnel never
+    has to go to Nomad and dead containers are noticed within seconds rather
+    than at the next cleanup run.  Tunnels whose container died are marked
+    failed and give back what they held.  Pending tunnels are left to the
+    provisioning job that owns them, and hibernated ones to their resume.
+
+    Only follows one Nomad cluster, the first one unless told otherwise."""
+
+    def __init__(self, nomad_client=None, cluster: Optional[str] = None):
+        self._nomad_client = nomad_client
+        self.cluster = nomad_clusters.get(cluster)
+        self.index = 0
+
+    @property
+    def nomad_client(self):
+        # Pick a server every time so ejected ones are skipped
+        return self._nomad_client or self.cluster.nomad.client()
+
+    def run(self) -> None:
+        failures = 0
+        while True:
+            try:
+                self.poll()
+                failures = 0
+            except (
+                nomad.api.exceptions.BaseNomadException,
+                requests.RequestException,
+                RedisError,
+                SQLAlchemyError,
+                TunnelError,
+            ):
+                db.session.rollback()
+                failures += 1
+                time.sleep(random.uniform(0, min(30, 2 ** failures)))
+
+    def poll(self, block: bool = True) -> int:
+        """Wait for allocations to change and apply the changes, returning
+        how many tunnels were updated"""
+        client = self.nomad_client
+        params = {}
+        if block:
+            # Leave room for the jitter Nomad adds to blocking queries
+            wait = int(client.allocations.timeout * 15 / 17 * 1000)
+            params = {"index": self.index, "wait": f"{wait}ms"}
+
+        response = client.allocations.request(method="get", params=params)
+        index = int(response.headers.get("X-Nomad-Index", 0))
+
+        changed = [
+            allocation
+            for allocation in self.latest(response.json()).values()
+            if allocation["ModifyIndex"] > self.index
+        ]
+
+        updated = self.apply(client, changed)
+        db.session.commit()
+
+        # Only move on once the changes are saved, a failed round is retried
+        self.index = index if index >= self.index else 0
+        return updated
+
+    @staticmethod
+    def latest(allocations: List[dict]) -> Dict[str, dict]:
+        """The newest allocation of every tunnel job, older ones have been
+        replaced and don't say anything about the tunnel anymore"""
+        latest: Dict[str, dict] = {}
+        for allocation in allocations:
+            if not allocation["JobID"].startswith("ssh-"):
+                continue
+            current = latest.get(allocation["JobID"])
+            if current is None or allocation["CreateIndex"] > current["CreateIndex"]:
+                latest[allocation["JobID"]] = allocation
+        return latest
+
+    def apply(self, client, allocations: List[dict]) -> int:
+        by_job = {allocation["JobID"]: allocation for allocation in allocations}
+        if not by_job:
+            return 0
+
+        tunnels = Tunnel.query.filter(
+            Tunnel.job_id.in_(list(by_job)),
+            Tunnel.status.notin_(["pending", "hibernated", "failed"]),
+            on_cluster(self.cluster.name),
+        ).all()
+
+        updated = 0
+        for tunnel in tunnels:
+            allocation = by_job[tunnel.job_id]
+            if allocation["ClientStatus"] == "running":
+                self.running(client, tunnel, allocation)
+            elif allocation["ClientStatus"] in FAILED_STATUSES:
+                # Frees the subdomain, tcp ports and usage the dead tunnel held
+                TunnelDeletionService(tunnel.user, tunnel).fail()
+            else:
+                continue
+
+            db.session.add(tunnel)
+            updated += 1
+
+        return updated
+
+    def running(self, client, tunnel: Tunnel, allocation: dict) -> None:
+        # Allocation stubs don't carry ports, so a rescheduled container
+        # needs one more look to find out where sshd ended up
+        details = client.allocation.get_allocation(allocation["ID"])
+        ports = values(details, "Resources/Networks/0/DynamicPorts/*")
+
+        tunnel.ssh_port = next(x for x in ports if x["Label"] == "ssh")["Value"]
+        tunnel.ip_address = self.cluster.nodes.address(allocation["NodeID"], client)
+        if current_app.config["ENV"] == "development":
+            tunnel.ip_address = current_app.config["SEA_HOST"]
+        tunnel.status = "running"
@@ -0,0 +1,51 @@
+import zlib
+from flask import current_app
+
+from app import db, nomad_clusters
+from app.models import Tunnel
+
+from typing import List, Optional
+
+
+def on_cluster(name: Optional[str]):
+    """Filter for the tunnels running on a cluster, tunnels from before there
+    were several are on the first one"""
+    if nomad_clusters.is_default(name):
+        return db.or_(
+            Tunnel.cluster.is_(None), Tunnel.cluster == nomad_clusters.default()
+        )
+    return Tunnel.cluster == name
+
+
+class ClusterPlacement:
+    """Picks the Nomad cluster a new tunnel is scheduled on.
+
+    "hash" keeps a subdomain on the same cluster every time it is opened,
+    without looking at anything but the clusters there are.  "least_loaded"
+    goes for the cluster running the fewest tunnels.  The cluster picked is
+    kept on the tunnel, so changing either of them only moves new tunnels."""
+
+    @classmethod
+    def pick(cls, box_name: str) -> str:
+        names = nomad_clusters.names()
+        if len(names) == 1:
+            return names[0]
+        if current_app.config["CLUSTER_STRATEGY"] == "least_loaded":
+            return cls.least_loaded(names)
+        return cls.by_hash(box_name, names)
+
+    @staticmethod
+    def by_hash(box_name: str, names: List[str]) -> str:
+        # Python's own hash of a str changes with every process
+        return names[zlib.crc32(box_name.encode()) % len(names)]
+
+    @staticmethod
+    def least_loaded(names: List[str]) -> str:
+        cluster = db.func.coalesce(Tunnel.cluster, names[0])
+        tunnels = dict(
+            db.session.query(cluster, db.func.count(Tunnel.id))
+            .filter(Tunnel.status.in_(["running", "pending"]))
+            .group_by(cluster)
+        )
+        # Ties go to the cluster listed first
+        return min(names, key=lambda name: tunnels.get(name, 0))
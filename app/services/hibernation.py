@@ -0,0 +1,134 @@
+import json
+import time
+import consul
+import nomad
+from flask import current_app
+
+from app import db, nomad_clients, nomad_clusters, redis_client
+from app.models import Subdomain, Tunnel
+from app.services.clusters import on_cluster
+from app.utils.dns import discover_service
+from app.utils.errors import NomadUnavailable
+from app.utils.job_spec import dispatched, multiplexed
+
+from typing import Dict, List, Set
+
+# Box name -> when its services were first seen failing
+IDLE_KEY = "idle_tunnels"
+# Job id -> spec of the job a hibernated tunnel is resumed with
+HIBERNATED_KEY = "hibernated_jobs"
+
+
+def service_box(service_name: str) -> str:
+    # Tunnel services are named ssh-<box name>-<port label>
+    return service_name[len("ssh-") :].rsplit("-", 1)[0]
+
+
+class Hibernation:
+    """Stops the containers of tunnels nobody has been connected to for a
+    while.
+
+    A service's check only passes while the client forwards its port, so a
+    tunnel whose checks have all been failing for HIBERNATE_AFTER seconds is
+    idle.  Its job is stopped and its spec kept to start it again on resume,
+    while the tunnel, its subdomain and its tcp ports stay as they are so the
+    user keeps their address.  Tunnels sharing a container or dispatched
+    from a parameterized job are left running, as are those on any but the
+    first Nomad cluster, whose checks are in another datacenter."""
+
+    def __init__(self, nomad_client=None):
+        self._nomad_client = nomad_client
+
+    @property
+    def nomad_client(self):
+        return self._nomad_client or nomad_clients.client()
+
+    def run(self) -> List[str]:
+        """Hibernate the tunnels idle for long enough, returning their job ids"""
+        threshold = current_app.config["HIBERNATE_AFTER"]
+        if threshold <= 0:
+            return []
+
+        idle = self.idle_boxes()
+        now = int(time.time())
+        since = {
+            box.decode(): int(at) for box, at in redis_client.hgetall(IDLE_KEY).items()
+        }
+
+        pipe = redis_client.pipeline()
+        back = [box for box in since if box not in idle]
+        if back:
+            pipe.hdel(IDLE_KEY, *back)
+        for box in idle - set(since):
+            pipe.hset(IDLE_KEY, box, now)
+        pipe.execute()
+
+        due = [box for box in idle if now - since.get(box, now) >= threshold]
+        if not due:
+            return []
+
+        hibernated = []
+        for tunnel in (
+            Tunnel.query.join(Subdomain)
+            .filter(
+                Subdomain.name.in_(due), Tunnel.status == "running", on_cluster(None)
+            )
+            .all()
+        ):
+            if not self.hibernates(tunnel):
+                continue
+            try:
+                self.hibernate(tunnel)
+            except (nomad.api.exceptions.BaseNomadException, NomadUnavailable):
+                # Still idle next time round
+                current_app.logger.warning(f"Could not hibernate {tunnel.job_id}")
+                continue
+            hibernated.append(tunnel.job_id)
+
+        return hibernated
+
+    @staticmethod
+    def hibernates(tunnel: Tunnel) -> bool:
+        """Whether the tunnel is hibernated rather than left running once it
+        has been idle for long enough"""
+        return (
+            tunnel.status == "running"
+            and nomad_clusters.is_default(tunnel.cluster)
+            and not (dispatched(tunnel.job_id) or multiplexed(tunnel.job_id))
+        )
+
+    @staticmethod
+    def idle_boxes() -> Set[str]:
+        """Box names of the tunnel services without a passing check"""
+        consul_client = consul.Consul(host=discover_service("consul").ip)
+        passing: Dict[str, bool] = {}
+        for check in consul_client.health.state("any")[1]:
+            if not check["ServiceName"].startswith("ssh-"):
+                continue
+            box = service_box(check["ServiceName"])
+            passing[box] = passing.get(box, False) or check["Status"] == "passing"
+        return {box for box, up in passing.items() if not up}
+
+    def hibernate(self, tunnel: Tunnel) -> None:
+        job = self.nomad_client.job.get_job(tunnel.job_id)
+        redis_client.hset(HIBERNATED_KEY, tunnel.job_id, json.dumps(job))
+
+        # AllocationSync leaves hibernated tunnels alone, so that has to be
+        # saved before the container stops or it is taken for a dead one
+        ssh_port = tunnel.ssh_port
+        tunnel.status = "hibernated"
+        tunnel.ssh_port = None
+        db.session.add(tunnel)
+        db.session.commit()
+
+        try:
+            # Stopped rather than purged, the tunnel still owns the job id
+            nomad_clients.retry(lambda client: client.job.deregister_job(tunnel.job_id))
+        except (nomad.api.exceptions.BaseNomadException, NomadUnavailable):
+            tunnel.status = "running"
+            tunnel.ssh_port = ssh_port
+            db.session.add(tunnel)
+            db.session.commit()
+            redis_client.hdel(HIBERNATED_KEY, tunnel.job_id)
+            raise
+        redis_client.hdel(IDLE_KEY, tunnel.subdomain.name)
@@ -0,0 +1,142 @@
+import json
+import consul
+import nomad
+import requests
+from flask import current_app
+from redis.exceptions import LockError
+
+from app import nomad_clients, redis_client
+from app.utils.dns import discover_service
+from app.utils.job_spec import (
+    MULTIPLEX_KV_PREFIX,
+    build_multiplexed_sshd_job,
+    multiplex_job_id,
+    slot_labels,
+)
+
+from typing import Dict, List, Optional, Tuple
+
+Slot = Tuple[str, List[str], List[int]]
+
+
+class Multiplexer:
+    """The sshd container all the tunnels of a user share.
+
+    It is started with a slot for every tunnel the users plan allows.  A
+    tunnel takes a slot by writing its key to Consul and adding its services
+    to the job, which Nomad applies to the running container, so only the
+    first tunnel of a user waits for a container to be scheduled.  The slots
+    in use are kept in Redis, and changed under a lock so the job registered
+    always has the services of all of them."""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.kv_prefix = f"{MULTIPLEX_KV_PREFIX}/{job_id}"
+
+    @classmethod
+    def for_user(cls, user_id: int) -> "Multiplexer":
+        return cls(multiplex_job_id(user_id))
+
+    @property
+    def slots_key(self) -> str:
+        return f"multiplex:{self.job_id}"
+
+    @staticmethod
+    def slot_ports() -> List[str]:
+        return current_app.config["MULTIPLEX_SLOT_PORTS"]
+
+    def fits(self, port_types: List[str]) -> bool:
+        return slot_labels(port_types, self.slot_ports()) is not None
+
+    def tunnels(self) -> Tuple[int, Dict[int, Slot]]:
+        """The number of slots of the container and the tunnels in them"""
+        fields = redis_client.hgetall(self.slots_key)
+        size = int(fields.pop(b"size", 0))
+        return size, {int(slot): tuple(json.loads(t)) for slot, t in fields.items()}
+
+    def claim(
+        self,
+        box_name: str,
+        port_types: List[str],
+        ssh_key: str,
+        bandwidth: str,
+        tcp_ports: List[int],
+        slots: int,
+    ) -> Optional[int]:
+        """Put a tunnel into a free slot of the container, starting it with
+        `slots` slots if the user has none yet.  Returns the slot or None
+        when the tunnel should get a container of its own"""
+        if not self.fits(port_types):
+            return None
+
+        try:
+            with redis_client.lock(f"{self.slots_key}:lock", timeout=60):
+                size, tunnels = self.tunnels()
+                size = size or slots
+                free = [slot for slot in range(size) if slot not in tunnels]
+                if not free:
+                    return None
+                slot = free[0]
+
+                try:
+                    consul_client = consul.Consul(host=discover_service("consul").ip)
+                    consul_client.kv.put(f"{self.kv_prefix}/keys/{slot}", ssh_key)
+                    consul_client.kv.put(f"{self.kv_prefix}/bandwidth", bandwidth)
+                    tunnels[slot] = (box_name, port_types, tcp_ports)
+                    self.register(size, tunnels)
+                except (
+                    consul.ConsulException,
+                    nomad.api.exceptions.BaseNomadException,
+                    requests.RequestException,
+                ):
+                    # A key left in Consul only lets the user into their own
+                    # container, and is overwritten by the next tunnel
+                    return None
+
+                redis_client.hmset(
+                    self.slots_key,
+                    {"size": size, slot: json.dumps([box_name, port_types, tcp_ports])},
+                )
+        except LockError:
+            return None
+
+        return slot
+
+    def release(self, box_name: str) -> None:
+        """Take a tunnel out of its slot, stopping the container along with
+        the last tunnel in it"""
+        with redis_client.lock(f"{self.slots_key}:lock", timeout=60):
+            size, tunnels = self.tunnels()
+            slot = next(
+                (slot for slot, tunnel in tunnels.items() if tunnel[0] == box_name),
+                None,
+            )
+            if slot is None:
+                return
+
+            del tunnels[slot]
+            consul_client = consul.Consul(host=discover_service("consul").ip)
+            if tunnels:
+                self.register(size, tunnels)
+                redis_client.hdel(self.slots_key, slot)
+                consul_client.kv.delete(f"{self.kv_prefix}/keys/{slot}")
+            else:
+                nomad_clients.retry(
+                    lambda client: client.job.deregister_job(self.job_id, purge=True)
+                )
+                redis_client.delete(self.slots_key)
+                consul_client.kv.delete(self.kv_prefix, recurse=True)
+
+    def register(self, size: int, tunnels: Dict[int, Slot]) -> None:
+        # The job always carries every slot in use, so registering it again
+        # is safe to retry
+        new_job = build_multiplexed_sshd_job(
+            self.job_id, size, tunnels, self.slot_ports()
+        )
+        nomad_clients.retry(
+            lambda client: client.jobs.request(
+                data=new_job,
+                method="post",
+                headers={"Content-Type": "application/json"},
+            )
+        )
@@ -0,0 +1,55 @@
+from redis import RedisError
+from flask import current_app
+
+from app import db, redis_client
+from app.models import Plan, Subdomain, Tunnel, User
+
+from typing import Dict
+
+# Node address -> plan bandwidth of the tunnels running there
+LOAD_KEY = "node_load"
+
+
+class NodeLoad:
+    """How much bandwidth the tunnels on each node may use, by node address.
+
+    The index is rebuilt from the database by a cron job and kept in Redis,
+    so placing a tunnel only costs a single read and never goes near the
+    database"""
+
+    @staticmethod
+    def compute() -> Dict[str, int]:
+        return {
+            address: int(bandwidth or 0)
+            for address, bandwidth in db.session.query(
+                Tunnel.ip_address, db.func.sum(Plan.bandwidth)
+            )
+            .select_from(Tunnel)
+            .join(Tunnel.subdomain)
+            .join(User, Subdomain.user_id == User.id)
+            .join(User.plan)
+            .filter(Tunnel.status == "running", Tunnel.ip_address.isnot(None))
+            .group_by(Tunnel.ip_address)
+        }
+
+    @classmethod
+    def refresh(cls) -> Dict[str, int]:
+        load = cls.compute()
+        pipe = redis_client.pipeline()
+        pipe.delete(LOAD_KEY)
+        if load:
+            pipe.hmset(LOAD_KEY, load)
+            # An index nobody keeps up to date is worse than none at all
+            pipe.expire(LOAD_KEY, current_app.config["NODE_LOAD_TTL"])
+        pipe.execute()
+        return load
+
+    @staticmethod
+    def read() -> Dict[str, int]:
+        try:
+            return {
+                address.decode(): int(bandwidth)
+                for address, bandwidth in redis_client.hgetall(LOAD_KEY).items()
+            }
+        except RedisError:
+            return {}
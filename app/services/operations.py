@@ -0,0 +1,193 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from jsonschema import ValidationError
+
+from app import db, json_schema_manager
+from app.jobs.nomad_cleanup import cleanup_old_nomad_box
+from app.models import Subdomain, Tunnel, User
+from app.services.subdomain import SubdomainCreationService, SubdomainDeletionService
+from app.services.tunnel import Launch, TunnelCreationService, TunnelDeletionService
+from app.utils.admission import admit
+from app.utils.errors import (
+    BadRequest,
+    JsonApiException,
+    NotFoundError,
+    TunnelLimitReached,
+)
+from app.utils.json import dig
+
+from typing import Dict, List, Optional, Union
+
+Resource = Optional[Union[Subdomain, Tunnel]]
+
+
+class OperationsService:
+    """Runs the operations of a JSON:API atomic operations request in a single
+    transaction.
+
+    Everything that touches the database happens in order on the request
+    thread.  The Nomad side of new tunnels is started concurrently once all
+    operations have been checked, and removed tunnels are only stopped once
+    every new tunnel is up, so a failure leaves nothing behind."""
+
+    def __init__(self, current_user: User, operations: List[dict]):
+        self.current_user = current_user
+        self.operations = operations
+        self.results: List[Resource] = [None] * len(operations)
+        self.launches: Dict[int, TunnelCreationService] = {}
+        self.removed: List[TunnelDeletionService] = []
+        self.lids: Dict[str, str] = {}
+
+    def run(self) -> List[Resource]:
+        for index, operation in enumerate(self.operations):
+            try:
+                self.results[index] = self.apply(index, operation)
+            except ValidationError as e:
+                raise self.failed(BadRequest(detail=e.message), index)
+            except JsonApiException as e:
+                raise self.failed(e, index)
+
+        self.launch()
+
+        for deletion in self.removed:
+            deletion.stop()
+
+        return self.results
+
+    def apply(self, index: int, operation: dict) -> Resource:
+        if operation["op"] == "add":
+            data = self.resolve_lids(operation["data"])
+            if data["type"] == "subdomain":
+                return self.add_subdomain(data, operation["data"].get("lid"))
+            return self.add_tunnel(index, data)
+
+        ref = operation["ref"]
+        if ref["type"] == "subdomain":
+            return self.remove_subdomain(ref["id"])
+        return self.remove_tunnel(ref["id"])
+
+    def resolve_lids(self, data: dict) -> dict:
+        """Point relationships at resources added earlier in the request"""
+        data = {key: value for key, value in data.items() if key != "lid"}
+        subdomain = dig(data, "relationships/subdomain/data")
+        if subdomain and "lid" in subdomain:
+            if subdomain["lid"] not in self.lids:
+                raise NotFoundError(detail=f"Unknown lid {subdomain['lid']}")
+            data["relationships"] = {
+                "subdomain": {
+                    "data": {"type": "subdomain", "id": self.lids[subdomain["lid"]]}
+                }
+            }
+        return data
+
+    def add_subdomain(self, data: dict, lid: Optional[str]) -> Subdomain:
+        json_schema_manager.validate({"data": data}, "subdomain_create.json")
+        subdomain = SubdomainCreationService(
+            self.current_user, dig(data, "attributes/name")
+        ).reserve(True)
+
+        if lid:
+            self.lids[lid] = str(subdomain.id)
+
+        return subdomain
+
+    def add_tunnel(self, index: int, data: dict) -> None:
+        json_schema_manager.validate({"data": data}, "tunnel_create.json")
+        service = TunnelCreationService(
+            self.current_user,
+            dig(data, "relationships/subdomain/data/id"),
+            dig(data, "attributes/port"),
+            dig(data, "attributes/sshKey"),
+        )
+        if service.subdomain is None:
+            raise NotFoundError(detail="Subdomain not found")
+
+        service.check_subdomain_permissions()
+        if service.over_tunnel_limit(planned=len(self.launches)):
+            raise TunnelLimitReached("Maximum number of opened tunnels reached")
+
+        # Hold on to the subdomain so later operations can't use it as well
+        service.subdomain.in_use = True
+        db.session.add(service.subdomain)
+        db.session.flush()
+
+        # The tunnel itself is saved once its container is up
+        self.launches[index] = service
+        return None
+
+    def remove_subdomain(self, subdomain_id: str) -> None:
+        subdomain = Subdomain.query.filter_by(
+            user=self.current_user, id=subdomain_id
+        ).first()
+        if subdomain is None:
+            raise NotFoundError(detail="Subdomain not found")
+
+        SubdomainDeletionService(self.current_user, subdomain).release()
+        return None
+
+    def remove_tunnel(self, tunnel_id: str) -> None:
+        tunnel = Tunnel.query.filter_by(user=self.current_user, id=tunnel_id).first()
+        if tunnel is None:
+            raise NotFoundError(detail="Tunnel not found")
+
+        deletion = TunnelDeletionService(self.current_user, tunnel)
+        deletion.remove()
+        self.removed.append(deletion)
+        return None
+
+    def launch(self) -> None:
+        if not self.launches:
+            return
+
+        # Turn the whole request away before anything is started
+        clusters = [service.cluster for service in self.launches.values()]
+        admit(self.current_user.id, clusters, len(self.launches))
+
+        # The workers can't use the request's session, everything they need
+        # from the database is read here
+        plans = {
+            index: service.plan_launch() for index, service in self.launches.items()
+        }
+
+        app = current_app._get_current_object()
+        workers = min(len(self.launches), current_app.config["OPERATIONS_WORKERS"])
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                index: pool.submit(self._launch, app, service, plans[index])
+                for index, service in self.launches.items()
+            }
+
+        started = {}
+        failure = None
+        for index, future in futures.items():
+            try:
+                started[index] = future.result()
+            except Exception as e:
+                failure = failure or (e, index)
+
+        if failure:
+            # Their tcp ports were never confirmed and go back to the pool
+            # once the lease runs out, by then the containers are gone
+            for index, (job_id, _, _, _) in started.items():
+                service = self.launches[index]
+                cleanup_old_nomad_box.queue(
+                    job_id, service.subdomain.name, service.cluster.name, timeout=60000
+                )
+
+            error, index = failure
+            if isinstance(error, JsonApiException):
+                raise self.failed(error, index)
+            raise error
+
+        for index, service in self.launches.items():
+            self.results[index] = service.save(*started[index])
+
+    @staticmethod
+    def _launch(app, service: TunnelCreationService, plan: Launch):
+        with app.app_context():
+            return service.launch(plan)
+
+    @staticmethod
+    def failed(error: JsonApiException, index: int) -> JsonApiException:
+        error.source = f"/atomic:operations/{index}"
+        return error
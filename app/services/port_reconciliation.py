@@ -0,0 +1,64 @@
+from flask import current_app
+
+from app import db, tcp_port_pool
+from app.models import Subdomain, Tunnel
+from app.utils.tcp_ports import RECONCILED
+
+from typing import Dict, Iterator, Tuple
+
+
+class PortReconciliation:
+    """Makes the tcp port pool agree with Tunnel.allocated_tcp_ports.
+
+    Ports of tunnels that failed half way or whose rows were dropped without
+    giving their ports back are returned to the pool, and ports the database
+    has handed out are taken out of it.  The pool is checked batch_size ports
+    at a time so no script holds Redis for long."""
+
+    def __init__(self, pool=None, batch_size: int = 1000):
+        self.pool = pool or tcp_port_pool
+        self.batch_size = batch_size
+
+    def run(self) -> Dict[str, int]:
+        """Repair the pool, returning the drift found"""
+        drift = dict.fromkeys(RECONCILED, 0)
+        drift["duplicated"] = 0
+
+        allocated: Dict[int, str] = {}
+        for port, owner in self.allocated_ports():
+            if allocated.setdefault(port, owner) != owner:
+                current_app.logger.warning(
+                    f"tcp port {port} is allocated to both "
+                    f"{allocated[port]} and {owner}"
+                )
+                drift["duplicated"] += 1
+
+        start, stop = self.pool.stats()["range"]
+        ports = sorted(set(range(start, stop)) | set(allocated) | set(self.pool.held()))
+        for i in range(0, len(ports), self.batch_size):
+            batch = ports[i : i + self.batch_size]
+            fixed = self.pool.reconcile(
+                {port: allocated.get(port, "") for port in batch}
+            )
+            for name, count in fixed.items():
+                drift[name] += count
+
+        drift["counter"] = self.pool.recount()
+
+        if any(count for name, count in drift.items() if name != "suspect"):
+            current_app.logger.warning(f"tcp port pool drifted: {drift}")
+        return drift
+
+    @staticmethod
+    def allocated_ports() -> Iterator[Tuple[int, str]]:
+        """Every tcp port in the database with the subdomain holding it"""
+        port = db.func.unnest(Tunnel.allocated_tcp_ports).label("port")
+        query = (
+            db.session.query(port, Subdomain.name)
+            .select_from(Tunnel)
+            .join(Tunnel.subdomain)
+            .yield_per(1000)
+        )
+        for port, owner in query:
+            if port:
+                yield port, owner
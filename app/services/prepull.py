@@ -0,0 +1,87 @@
+import nomad
+from flask import current_app
+from redis import RedisError
+
+from app import nomad_clusters, redis_client
+from app.utils.job_spec import PREPULL_JOB_ID, build_prepull_job
+from app.utils.json import dig
+
+from typing import Optional
+
+# The nodes already running the current sshd image, one set per cluster
+WARM_NODES_KEY = "prepull:warm_nodes"
+
+
+class ImagePrepull:
+    """Keeps the current sshd image on every node.
+
+    A system job runs the image everywhere, and is registered again whenever
+    SSHD_IMAGE changes.  The nodes where it is running are kept in Redis so
+    tunnels can tell whether they started on a node that had the image.
+
+    Every Nomad cluster runs a job of its own, the first one unless told
+    otherwise."""
+
+    def __init__(self, nomad_client=None, cluster: Optional[str] = None):
+        self._nomad_client = nomad_client
+        self.cluster = nomad_clusters.get(cluster)
+
+    @property
+    def nomad_client(self):
+        return self._nomad_client or self.cluster.nomad.client()
+
+    @staticmethod
+    def image() -> str:
+        return current_app.config["SSHD_IMAGE"]
+
+    def ensure(self) -> bool:
+        """Register the system job unless it already runs the current image,
+        returns whether it was registered"""
+        try:
+            job = self.nomad_client.job.get_job(PREPULL_JOB_ID)
+        except nomad.api.exceptions.URLNotFoundNomadException:
+            job = None
+        if job and not job.get("Stop") and dig(job, "Meta/image") == self.image():
+            return False
+
+        new_job = build_prepull_job(self.image(), self.cluster.datacenters)
+        self.cluster.nomad.retry(
+            lambda client: client.job.request(
+                PREPULL_JOB_ID,
+                data=new_job,
+                method="post",
+                headers={"Content-Type": "application/json"},
+            )
+        )
+        return True
+
+    def refresh(self) -> int:
+        """Remember the nodes running the current version of the job,
+        returns how many there are"""
+        job = self.nomad_client.job.get_job(PREPULL_JOB_ID)
+        nodes = {
+            allocation["NodeID"]
+            for allocation in self.nomad_client.job.get_allocations(PREPULL_JOB_ID)
+            if allocation["ClientStatus"] == "running"
+            and allocation.get("JobVersion", 0) == job.get("Version", 0)
+        }
+
+        key = self.warm_nodes_key(self.cluster.name)
+        pipe = redis_client.pipeline()
+        pipe.delete(key)
+        if nodes:
+            pipe.sadd(key, *nodes)
+        pipe.execute()
+        return len(nodes)
+
+    @staticmethod
+    def warm_nodes_key(cluster: str) -> str:
+        return f"{WARM_NODES_KEY}:{cluster}"
+
+    @classmethod
+    def warm(cls, node_id: str, cluster: Optional[str] = None) -> bool:
+        key = cls.warm_nodes_key(nomad_clusters.get(cluster).name)
+        try:
+            return bool(redis_client.sismember(key, node_id))
+        except RedisError:
+            return False
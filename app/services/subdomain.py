@@ -1,5 +1,6 @@
 from app import db, momblish
 from app.models import Subdomain
+from app.services.usage import Usage
 from app.utils.errors import SubdomainTaken, SubdomainInUse, SubdomainLimitReached
 
 subdomain_reserved_limits = {"free": 0, "paid": 5, "beta": 5, "admin": 5}
@@ -11,9 +12,7 @@ class SubdomainCreationService:
         self.subdomain_name = subdomain_name
 
     def over_subdomain_limits(self):
-        num_reserved_subdomains = self.current_user.subdomains.filter_by(
-            reserved=True
-        ).count()
+        num_reserved_subdomains = Usage(self.current_user.id).reserved_subdomains()
         if num_reserved_subdomains >= self.current_user.limits().reserved_subdomains:
             return True
         return False
@@ -55,6 +54,9 @@ class SubdomainCreationService:
         db.session.add(subdomain)
         db.session.flush()
 
+        if reserve:
+            Usage(self.current_user.id).change(reserved_subdomains=1)
+
         return subdomain
 
 
@@ -68,3 +70,6 @@ class SubdomainDeletionService:
             raise SubdomainInUse("Subdomain is in use")
         db.session.delete(self.subdomain)
         db.session.flush()
+
+        if self.subdomain.reserved:
+            Usage(self.subdomain.user_id).change(reserved_subdomains=-1)
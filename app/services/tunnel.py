@@ -1,23 +1,63 @@
-from typing import Tuple, List
+from typing import Dict, Tuple, List
+import json
+import time
+import uuid
+import consul
 import nomad
+import requests
+from functools import partial
 from dpath.util import values
 
-from app import db, redis_client
+from app import db, nomad_clusters, nomad_lookups, redis_client, tcp_port_pool
 from app.jobs.nomad_cleanup import cleanup_old_nomad_box
-from app.models import Subdomain, Tunnel, User
+from app.jobs.tunnel_provisioning import provision_tunnel
+from app.models import AsyncJob, Subdomain, Tunnel, User
+from app.services.clusters import ClusterPlacement
+from app.services.hibernation import HIBERNATED_KEY
+from app.services.multiplex import Multiplexer
+from app.services.node_load import NodeLoad
+from app.services.prepull import ImagePrepull
 from app.services.subdomain import SubdomainCreationService
+from app.services.usage import Usage
+from app.services.warm_pool import WarmPool
+from app.utils.db import Interactor
 from app.utils.errors import (
     AccessDenied,
+    NomadUnavailable,
     TunnelError,
     SubdomainInUse,
     TunnelLimitReached,
+    UnprocessableEntity,
+)
+from app.utils.admission import admit
+from app.utils.allocations import AllocationWaiter
+from app.utils.dns import discover_service
+from app.utils.dispatch import dispatch_sshd_job
+from app.utils.job_spec import (
+    MULTIPLEX_KV_PREFIX,
+    POOL_KV_PREFIX,
+    build_sshd_job,
+    dispatched,
+    load_affinities,
+    multiplex_job_id,
+    multiplexed,
+    printable,
 )
 from app.utils.json import dig
+from app.utils.timing import PhaseTimer
 
-from app.utils.dns import discover_service
+from typing import NamedTuple, Optional
+from flask import current_app
+
+
+class Launch(NamedTuple):
+    """What starting a tunnels container needs from the database, read on
+    the request thread so the start itself can run on any other"""
 
-from typing import Optional
-from flask import current_app, render_template
+    box_name: str
+    user_id: int
+    bandwidth: str
+    tunnel_count: int
 
 
 class TunnelCreationService:
@@ -32,36 +72,83 @@ class TunnelCreationService:
         self.port_types = port_types
         self.ssh_key = ssh_key
         self.current_user = current_user
+        self.timer = PhaseTimer("tunnel")
+        # The slot of the users multiplexed container the tunnel went into
+        self.slot: Optional[int] = None
 
-        if subdomain_id:
-            self.subdomain = Subdomain.query.get(subdomain_id)
-        else:
-            tcp_url = len(self.port_types) == 1 and self.port_types[0] == "tcp"
-            self.subdomain = SubdomainCreationService(
-                self.current_user
-            ).get_unused_subdomain(tcp_url)
+        with self.timer.phase("subdomain"):
+            if subdomain_id:
+                self.subdomain = Subdomain.query.get(subdomain_id)
+            else:
+                tcp_url = len(self.port_types) == 1 and self.port_types[0] == "tcp"
+                self.subdomain = SubdomainCreationService(
+                    self.current_user
+                ).get_unused_subdomain(tcp_url)
 
-        # We need to do this each time so each if a nomad service goes down
-        # it doesnt affect web api
-        self.nomad_client = nomad.Nomad(discover_service("nomad").ip)
+        self.use_cluster(
+            ClusterPlacement.pick(self.subdomain.name) if self.subdomain else None
+        )
+
+    def use_cluster(self, name: Optional[str]) -> None:
+        self.cluster = nomad_clusters.get(name)
+        # Clients are shared, a nomad server going down is ejected from the
+        # pool so it doesnt affect web api
+        self.nomad_client = self.cluster.nomad.client()
 
     def create(self) -> Tunnel:
         self.check_subdomain_permissions()
-        job_id = None
 
         if self.over_tunnel_limit():
             raise TunnelLimitReached("Maximum number of opened tunnels reached")
+
+        admit(self.current_user.id, [self.cluster])
+
+        return self.save(*self.launch())
+
+    def plan_launch(self) -> Launch:
+        """Read what `launch` needs from the database"""
+        limits = self.current_user.limits()
+        return Launch(
+            box_name=self.subdomain.name,
+            user_id=self.current_user.id,
+            bandwidth=str(limits.bandwidth),
+            tunnel_count=limits.tunnel_count,
+        )
+
+    def launch(self, plan: Optional[Launch] = None) -> Tuple[str, List[int], str, str]:
+        """Start the SSH container and wait for it to come up.
+
+        Given a plan it only talks to Nomad and Redis, never the database, so
+        several of these can run at once outside of the request thread"""
+        plan = plan or self.plan_launch()
+        # Don't take any ports while Nomad is known to be down
+        self.cluster.nomad.breaker.check()
+
+        tcp_ports = self.get_tcp_ports(plan.box_name)
+        job_id = None
         try:
-            job_id, tcp_ports = self.create_tunnel_nomad()
+            job_id, _ = self.create_tunnel_nomad(tcp_ports, plan)
             ssh_port, ip_address = self.get_tunnel_details(job_id)
-        except TunnelError:
+        except (TunnelError, nomad.api.exceptions.BaseNomadException) as e:
             # if nomad fails to even start the job then there will be no job_id
             if job_id:
-                cleanup_old_nomad_box.queue(job_id, timeout=60000)
-            raise TunnelError("Failed to create tunnel")
-        except nomad.api.exceptions.BaseNomadException:
+                # The ports stay leased until the container is gone for sure
+                cleanup_old_nomad_box.queue(
+                    job_id, plan.box_name, self.cluster.name, timeout=60000
+                )
+            else:
+                tcp_port_pool.release(plan.box_name, tcp_ports)
+            if isinstance(e, NomadUnavailable):
+                raise
             raise TunnelError("Failed to create tunnel")
+        finally:
+            self.timer.flush()
+
+        return job_id, tcp_ports, ssh_port, ip_address
 
+    def save(
+        self, job_id: str, tcp_ports: List[int], ssh_port: str, ip_address: str
+    ) -> Tunnel:
         self.subdomain.in_use = True
 
         tunnel = Tunnel(
@@ -71,6 +158,9 @@ class TunnelCreationService:
             ssh_port=ssh_port,
             ip_address=ip_address,
             allocated_tcp_ports=tcp_ports,
+            slot=self.slot,
+            cluster=self.cluster.name,
+            status="running",
         )
 
         tunnel.subdomain = self.subdomain
@@ -78,9 +168,225 @@ class TunnelCreationService:
         db.session.add(tunnel)
         db.session.add(self.subdomain)
         db.session.flush()
+        Usage(self.current_user.id).change(tunnels=1)
 
+        self.confirm_tcp_ports(tcp_ports)
         return tunnel
 
+    def reserve(self) -> AsyncJob:
+        """Reserve the subdomain and tcp ports for a tunnel and leave the Nomad
+        scheduling to a background job.  Progress can be followed through the
+        status of the returned tunnel, which gives everything back if it fails"""
+        self.check_subdomain_permissions()
+
+        if self.over_tunnel_limit():
+            raise TunnelLimitReached("Maximum number of opened tunnels reached")
+
+        admit(self.current_user.id, [self.cluster])
+
+        self.subdomain.in_use = True
+
+        tunnel = Tunnel(
+            subdomain_id=self.subdomain.id,
+            port=self.port_types,
+            job_id=self.job_name(),
+            allocated_tcp_ports=self.get_tcp_ports(),
+            cluster=self.cluster.name,
+            status="pending",
+        )
+
+        tunnel.subdomain = self.subdomain
+
+        db.session.add(tunnel)
+        db.session.add(self.subdomain)
+        db.session.flush()
+        Usage(self.current_user.id).change(tunnels=1)
+
+        self.confirm_tcp_ports(tunnel.allocated_tcp_ports)
+        tunnel_id = tunnel.id
+        ssh_key = self.ssh_key
+        provision_job_id = str(uuid.uuid4())
+
+        # The worker has to be able to see the tunnel, so only hand it over
+        # once the request has been committed
+        @Interactor.after_commit
+        def provision_after_commit(_):
+            provision_tunnel.queue(
+                tunnel_id, ssh_key, job_id=provision_job_id, timeout=60000
+            )
+
+        self.timer.flush()
+        return AsyncJob(id=provision_job_id, status=tunnel.status, tunnel_id=tunnel_id)
+
+    def provision(self, tunnel: Tunnel) -> Tunnel:
+        """Schedule the SSH container for a tunnel created by `reserve`"""
+        self.use_cluster(tunnel.cluster)
+        try:
+            tunnel.job_id, _ = self.create_tunnel_nomad(tunnel.allocated_tcp_ports)
+            tunnel.slot = self.slot
+            tunnel.ssh_port, tunnel.ip_address = self.get_tunnel_details(tunnel.job_id)
+            tunnel.status = "running"
+        except (TunnelError, nomad.api.exceptions.BaseNomadException):
+            # Kept for whoever polls it, but nothing is left holding the
+            # subdomain, tcp ports or the usage count
+            TunnelDeletionService(self.current_user, tunnel).fail()
+            return tunnel
+        finally:
+            self.timer.flush()
+
+        db.session.add(tunnel)
+        db.session.flush()
+
+        return tunnel
+
+    def reattach(self) -> Optional[Tunnel]:
+        """Hand a reconnecting client back the tunnel it already has on this
+        reserved subdomain, instead of tearing the container down and
+        scheduling an identical one.
+
+        Only a running tunnel with the same port types whose allocation is
+        still healthy is reused, the new key is swapped into it in place, and
+        a hibernated one is resumed first.  A tunnel whose container has died,
+        or a dispatched one whose key changed, is deleted so a fresh one can
+        be created, None is returned whenever the caller should go on and
+        create the tunnel as usual"""
+        if not self.subdomain.reserved:
+            return None
+        if self.subdomain.user != self.current_user:
+            raise AccessDenied("You do not own this subdomain")
+
+        tunnel = Tunnel.query.filter(
+            Tunnel.subdomain_id == self.subdomain.id,
+            Tunnel.status.in_(["running", "hibernated"]),
+        ).first()
+        if tunnel is None or tunnel.port != self.port_types:
+            return None
+        self.use_cluster(tunnel.cluster)
+
+        if tunnel.status == "hibernated":
+            try:
+                TunnelResumeService(self.current_user, tunnel).resume()
+            except TunnelError:
+                self.discard(tunnel)
+                return None
+
+        try:
+            with self.timer.phase("reattach"):
+                if not (
+                    self.allocation_healthy(tunnel.job_id)
+                    and self.update_ssh_key(tunnel)
+                ):
+                    self.discard(tunnel)
+                    return None
+        except (
+            consul.ConsulException,
+            nomad.api.exceptions.BaseNomadException,
+            requests.RequestException,
+        ):
+            raise TunnelError("Failed to reattach tunnel")
+        finally:
+            self.timer.flush()
+
+        db.session.add(tunnel)
+        db.session.flush()
+
+        return tunnel
+
+    def discard(self, tunnel: Tunnel) -> None:
+        """Delete a tunnel the caller is about to replace.  A job the new
+        tunnel is registered under again is left alone, purging it later
+        on would stop the replacement instead"""
+        deletion = TunnelDeletionService(self.current_user, tunnel)
+        if tunnel.job_id != self.job_name():
+            deletion.delete()
+            return
+
+        deletion.remove()
+        if tunnel.allocated_tcp_ports:
+            tcp_port_pool.release(self.subdomain.name, tunnel.allocated_tcp_ports)
+
+    def allocation_healthy(self, job_id: str) -> bool:
+        allocations = self.nomad_client.job.get_allocations(job_id)
+        if not allocations:
+            return False
+
+        latest = max(allocations, key=lambda a: a["CreateIndex"])
+        return latest["ClientStatus"] == "running" and latest["DesiredStatus"] == "run"
+
+    def update_ssh_key(self, tunnel: Tunnel) -> bool:
+        """Swap the new key into the tunnel's container, returns False when
+        that can't be done without starting a new one"""
+        stripped_ssh_key = printable(self.ssh_key)
+
+        if tunnel.job_id.startswith("ssh-pool-"):
+            # Pool containers render their key from Consul, so changing it
+            # there is picked up without restarting anything
+            consul_client = consul.Consul(host=discover_service("consul").ip)
+            consul_client.kv.put(
+                f"{POOL_KV_PREFIX}/{tunnel.job_id}/authorized_keys", stripped_ssh_key
+            )
+            return True
+        if multiplexed(tunnel.job_id):
+            # As do multiplexed ones, with a key for every slot
+            consul_client = consul.Consul(host=discover_service("consul").ip)
+            consul_client.kv.put(
+                f"{MULTIPLEX_KV_PREFIX}/{tunnel.job_id}/keys/{tunnel.slot}",
+                stripped_ssh_key,
+            )
+            return True
+
+        job = self.nomad_client.job.get_job(tunnel.job_id)
+        if dispatched(tunnel.job_id):
+            # Dispatched jobs can't be changed, only replaced
+            return dig(job, "Meta/ssh_key") == stripped_ssh_key
+        if dig(job, "TaskGroups/0/Tasks/0/Env/SSH_KEY") == stripped_ssh_key:
+            return True
+
+        after_index = self.update_job(
+            tunnel.job_id,
+            tunnel.allocated_tcp_ports or [0] * len(self.port_types),
+            stripped_ssh_key,
+        )
+        tunnel.ssh_port, tunnel.ip_address = self.get_tunnel_details(
+            tunnel.job_id, after_index
+        )
+        return True
+
+    def update_job(
+        self,
+        job_id: str,
+        tcp_ports: List[int],
+        ssh_key: str,
+        port_types: Optional[List[str]] = None,
+    ) -> int:
+        """Submit a new version of an existing tunnel job and return its
+        `JobModifyIndex`.
+
+        Keeping the job id means Nomad updates the job rather than starting
+        over, and the subdomain services stay registered throughout"""
+        new_job = build_sshd_job(
+            job_id,
+            self.subdomain.name,
+            port_types or self.port_types,
+            tcp_ports,
+            ssh_key=ssh_key,
+            bandwidth=str(self.current_user.limits().bandwidth),
+            pool=job_id.startswith("ssh-pool-"),
+            # Every update of a tunnel job starts a new container anyway
+            affinities=self.affinities(),
+            datacenters=self.cluster.datacenters,
+        )
+        with self.timer.phase("nomad_submit"):
+            response = self.cluster.nomad.retry(
+                lambda client: client.job.request(
+                    job_id,
+                    data=new_job,
+                    method="post",
+                    headers={"Content-Type": "application/json"},
+                )
+            )
+        return response.json()["JobModifyIndex"]
+
     def check_subdomain_permissions(self) -> None:
         if self.subdomain.user != self.current_user:
             raise AccessDenied("You do not own this subdomain")
@@ -89,59 +395,115 @@ class TunnelCreationService:
         elif self.subdomain.user == self.current_user:
             pass
 
-    def over_tunnel_limit(self) -> bool:
-        num_tunnels = self.current_user.tunnels.count()
+    def over_tunnel_limit(self, planned: int = 0) -> bool:
+        num_tunnels = Usage(self.current_user.id).tunnels() + planned
         if num_tunnels >= self.current_user.limits().tunnel_count:
             return True
         return False
 
-    def create_tunnel_nomad(self) -> Tuple[str, List[int]]:
-        """Create a tunnel by scheduling an SSH container into the Nomad cluster"""
-        tcp_ports = []
-        for port in self.port_types:
-            if "tcp" in port:
-                tcp_ports.append(self.get_tcp_port())
-            else:
-                tcp_ports.append(0)
-        # this removes all chars that literal eval can not eval. ex: \n, \r, etc..
-        stripped_ssh_key = "".join(i for i in self.ssh_key if 31 < ord(i) < 127)
-        new_job = render_template(
-            "sshd.j2.json",
-            ssh_key=stripped_ssh_key,
-            box_name=self.subdomain.name,
-            bandwidth=str(self.current_user.limits().bandwidth),
-            base_url=current_app.config["BASE_SERVICE_URL"],
-            port_types=self.port_types,
-            tcp_ports=tcp_ports,
-            tcp_lb_ip=current_app.config["TCP_LB_IP"],
+    @staticmethod
+    def affinities() -> Optional[List[dict]]:
+        return load_affinities(
+            NodeLoad.read(), current_app.config["NODE_LOAD_AFFINITIES"]
         )
-        self.nomad_client.jobs.request(
-            data=new_job, method="post", headers={"Content-Type": "application/json"}
-        )
-        return "ssh-client-" + self.subdomain.name, tcp_ports
 
-    def get_tunnel_details(self, job_id: str) -> Tuple[str, str]:
-        """Get details of ssh container"""
-        # FIXME: nasty blocking loops should be asynced or something
-        # Add error handling to this
-        status = None
-        trys = 0
-        while status != "running":
-            trys += 1
-            status = self.nomad_client.job[job_id]["Status"]
-            if trys > 1000:
-                raise TunnelError(detail="The tunnel failed to start.")
-
-        job_info = self.nomad_client.job.get_allocations(job_id)
-
-        allocation_info = self.nomad_client.allocation.get_allocation(
-            dig(job_info, "0/ID")
-        )
+    def job_name(self, box_name: Optional[str] = None) -> str:
+        return "ssh-client-" + (box_name or self.subdomain.name)
+
+    def create_tunnel_nomad(
+        self, tcp_ports: Optional[List[int]] = None, plan: Optional[Launch] = None
+    ) -> Tuple[str, List[int]]:
+        """Create a tunnel by scheduling an SSH container into the Nomad cluster"""
+        plan = plan or self.plan_launch()
+        if tcp_ports is None:
+            tcp_ports = self.get_tcp_ports(plan.box_name)
+        stripped_ssh_key = printable(self.ssh_key)
+        bandwidth = plan.bandwidth
 
-        allocation_node = values(allocation_info, "NodeID")
-        nodes = self.nomad_client.nodes.get_nodes()
+        # The warm pool and the shared containers only run on the first cluster
+        backend = current_app.config["TUNNEL_BACKEND"]
+        shared = nomad_clusters.is_default(self.cluster.name)
 
-        ip_address = next(x["Address"] for x in nodes if x["ID"] in allocation_node)
+        if shared:
+            with self.timer.phase("warm_pool"):
+                pool_job_id = WarmPool(self.port_types, self.nomad_client).claim(
+                    plan.box_name, stripped_ssh_key, bandwidth, tcp_ports
+                )
+            if pool_job_id:
+                return pool_job_id, tcp_ports
+
+        if shared and backend == "multiplexed":
+            with self.timer.phase("multiplex"):
+                self.slot = Multiplexer.for_user(plan.user_id).claim(
+                    plan.box_name,
+                    self.port_types,
+                    stripped_ssh_key,
+                    bandwidth,
+                    tcp_ports,
+                    plan.tunnel_count,
+                )
+            if self.slot is not None:
+                return multiplex_job_id(plan.user_id), tcp_ports
+
+        if shared and backend == "dispatch":
+            with self.timer.phase("nomad_dispatch"):
+                response = dispatch_sshd_job(
+                    plan.box_name,
+                    self.port_types,
+                    tcp_ports,
+                    stripped_ssh_key,
+                    bandwidth,
+                )
+            return response["DispatchedJobID"], tcp_ports
+
+        with self.timer.phase("job_spec"):
+            new_job = build_sshd_job(
+                self.job_name(plan.box_name),
+                plan.box_name,
+                self.port_types,
+                tcp_ports,
+                ssh_key=stripped_ssh_key,
+                bandwidth=bandwidth,
+                affinities=self.affinities(),
+                datacenters=self.cluster.datacenters,
+            )
+        with self.timer.phase("nomad_submit"):
+            self.cluster.nomad.retry(
+                lambda client: client.jobs.request(
+                    data=new_job,
+                    method="post",
+                    headers={"Content-Type": "application/json"},
+                )
+            )
+        return self.job_name(plan.box_name), tcp_ports
+
+    def get_tunnel_details(self, job_id: str, after_index: int = 0) -> Tuple[str, str]:
+        """Get details of ssh container"""
+        deadline = time.monotonic() + current_app.config["TUNNEL_START_TIMEOUT"]
+        started = time.monotonic()
+        with self.timer.phase("wait_running"):
+            allocation = AllocationWaiter(
+                self.nomad_client, deadline=current_app.config["TUNNEL_START_TIMEOUT"]
+            ).wait_until_running(job_id, after_index)
+        # Split the wait by whether the node had the sshd image already
+        warm = ImagePrepull.warm(allocation["NodeID"], self.cluster.name)
+        warm = "warm" if warm else "cold"
+        self.timer.record(f"wait_running_{warm}", time.monotonic() - started)
+
+        # The allocation stub already knows its node, so the ports and the
+        # node address can be looked up side by side
+        with self.timer.phase("allocation_lookup"):
+            details = nomad_lookups.gather(
+                deadline - time.monotonic(),
+                allocation_info=partial(
+                    self.nomad_client.allocation.get_allocation, dig(allocation, "ID")
+                ),
+                ip_address=partial(
+                    self.cluster.nodes.address, allocation["NodeID"], self.nomad_client
+                ),
+            )
+        allocation_info = details["allocation_info"]
+        ip_address = details["ip_address"]
         allocated_ports = values(allocation_info, "Resources/Networks/0/DynamicPorts/*")
         ssh_port = next(x for x in allocated_ports if x["Label"] == "ssh")["Value"]
         if current_app.config["ENV"] == "development":
@@ -149,12 +511,28 @@ class TunnelCreationService:
 
         return (ssh_port, ip_address)
 
-    def get_tcp_port(self) -> int:
-        try:
-            new_port = redis_client.spop("open_tcp_ports")
-            return int(new_port)
-        except TypeError:  # type error is thrown when attempting to case None to int
-            raise TunnelError(detail="No tcp ports available")
+    def get_tcp_ports(self, box_name: Optional[str] = None) -> List[int]:
+        """Lease a tcp port for every tcp forward, all of them in one go"""
+        with self.timer.phase("tcp_ports"):
+            leased = iter(
+                tcp_port_pool.lease(
+                    box_name or self.subdomain.name,
+                    sum("tcp" in port for port in self.port_types),
+                )
+            )
+        return [next(leased) if "tcp" in port else 0 for port in self.port_types]
+
+    def confirm_tcp_ports(self, tcp_ports: List[int]) -> None:
+        """Keep the leased ports for good once the tunnel holding them has been
+        committed, until then they go back to the pool on their own"""
+        if not any(tcp_ports):
+            return
+
+        owner = self.subdomain.name
+
+        @Interactor.after_commit
+        def confirm_after_commit(_):
+            tcp_port_pool.confirm(owner, tcp_ports)
 
 
 class TunnelDeletionService:
@@ -167,11 +545,20 @@ class TunnelDeletionService:
             self.subdomain = tunnel.subdomain
             self.job_id = tunnel.job_id
 
-        self.nomad_client = nomad.Nomad(discover_service("nomad").ip)
+        self.cluster = nomad_clusters.get(tunnel.cluster if tunnel else None)
+        self.nomad_client = self.cluster.nomad.client()
 
     def delete(self):
-        if self.tunnel.allocated_tcp_ports:
-            redis_client.sadd("open_tcp_ports", *self.tunnel.allocated_tcp_ports)
+        # A failed tunnel gave everything back already, and its container
+        # may have been replaced by a new tunnel on the same subdomain
+        failed = self.tunnel.status == "failed"
+        self.remove()
+        if not failed:
+            self.stop()
+
+    def remove(self):
+        """Remove the tunnel from the database, leaving its container running"""
+        failed = self.tunnel.status == "failed"
         if self.subdomain.reserved:
             self.subdomain.in_use = False
             db.session.add(self.subdomain)
@@ -181,4 +568,219 @@ class TunnelDeletionService:
             db.session.delete(self.tunnel)
             db.session.delete(self.subdomain)
             db.session.flush()
-        cleanup_old_nomad_box.queue(self.job_id, timeout=60000)
+        if not failed:
+            Usage(self.subdomain.user_id).change(tunnels=-1)
+
+    def fail(self):
+        """Mark the tunnel failed and give back its subdomain, tcp ports and
+        usage, keeping the row so whoever follows the tunnel can tell what
+        happened to it until it is deleted"""
+        if self.tunnel.status == "failed":
+            return
+
+        self.stop()
+        self.tunnel.status = "failed"
+        self.tunnel.allocated_tcp_ports = []
+        self.subdomain.in_use = False
+        db.session.add(self.tunnel)
+        db.session.add(self.subdomain)
+        db.session.flush()
+        Usage(self.subdomain.user_id).change(tunnels=-1)
+
+    def stop(self):
+        """Give back the tunnels tcp ports and stop its container"""
+        if self.tunnel.allocated_tcp_ports:
+            tcp_port_pool.release(
+                self.tunnel.subdomain.name, self.tunnel.allocated_tcp_ports
+            )
+        cleanup_old_nomad_box.queue(
+            self.job_id, self.tunnel.subdomain.name, self.cluster.name, timeout=60000
+        )
+
+
+class TunnelUpdateService(TunnelCreationService):
+    """Changes the ports of a running tunnel.
+
+    Only the forwards that were added or dropped take tcp ports from or give
+    them back to the pool, and the tunnels job is updated under the same id
+    instead of being torn down and created again"""
+
+    def __init__(self, current_user: User, tunnel: Tunnel, port_types: list):
+        self.port_types = port_types
+        self.current_user = current_user
+        self.tunnel = tunnel
+        self.subdomain = tunnel.subdomain
+        self.timer = PhaseTimer("tunnel_update")
+        self.use_cluster(tunnel.cluster)
+
+    def update(self) -> Tunnel:
+        if self.tunnel.status != "running":
+            raise UnprocessableEntity(detail="Only running tunnels can be changed")
+        if self.port_types == self.tunnel.port:
+            return self.tunnel
+        if dispatched(self.tunnel.job_id):
+            raise UnprocessableEntity(
+                detail="Dispatched tunnels can't be changed, open a new one instead"
+            )
+        if multiplexed(self.tunnel.job_id):
+            raise UnprocessableEntity(
+                detail="Tunnels sharing a container can't be changed, "
+                "open a new one instead"
+            )
+
+        self.cluster.nomad.breaker.check()
+
+        job_id = self.tunnel.job_id
+        tcp_ports, added, removed = self.port_changes()
+        submitted = False
+        try:
+            after_index = self.update_job(job_id, tcp_ports, self.current_ssh_key())
+            submitted = True
+            ssh_port, ip_address = self.get_tunnel_details(job_id, after_index)
+        except (TunnelError, nomad.api.exceptions.BaseNomadException) as e:
+            self.roll_back(submitted, added)
+            if isinstance(e, NomadUnavailable):
+                raise
+            raise TunnelError("Failed to update tunnel")
+        finally:
+            self.timer.flush()
+
+        self.tunnel.port = self.port_types
+        self.tunnel.allocated_tcp_ports = tcp_ports
+        self.tunnel.ssh_port = ssh_port
+        self.tunnel.ip_address = ip_address
+
+        db.session.add(self.tunnel)
+        db.session.flush()
+
+        self.confirm_tcp_ports(added)
+
+        # Dropped ports only go back to the pool once nothing can undo the
+        # update, otherwise another tunnel could be handed a port still in use
+        if removed:
+            owner = self.subdomain.name
+
+            @Interactor.after_commit
+            def release_after_commit(_):
+                tcp_port_pool.release(owner, removed)
+
+        return self.tunnel
+
+    def port_changes(self) -> Tuple[List[int], List[int], List[int]]:
+        """Line the new port types up with the tcp ports the tunnel already
+        holds for the same type.
+
+        Returns the tcp ports of the new layout, the ones taken from the pool
+        for it and the ones it no longer needs"""
+        held: Dict[str, List[int]] = {}
+        old_tcp_ports = self.tunnel.allocated_tcp_ports or [0] * len(self.tunnel.port)
+        for port_type, tcp_port in zip(self.tunnel.port, old_tcp_ports):
+            if tcp_port:
+                held.setdefault(port_type, []).append(tcp_port)
+
+        kept: List[Optional[int]] = []
+        for port_type in self.port_types:
+            if "tcp" not in port_type:
+                kept.append(0)
+            elif held.get(port_type):
+                kept.append(held[port_type].pop(0))
+            else:
+                kept.append(None)
+
+        with self.timer.phase("tcp_ports"):
+            added = tcp_port_pool.lease(self.subdomain.name, kept.count(None))
+        leased = iter(added)
+        tcp_ports = [next(leased) if port is None else port for port in kept]
+
+        removed = [tcp_port for ports in held.values() for tcp_port in ports]
+        return tcp_ports, added, removed
+
+    def current_ssh_key(self) -> str:
+        if self.tunnel.job_id.startswith("ssh-pool-"):
+            # Pool jobs read their key from Consul, it stays where it is
+            return ""
+        job = self.nomad_client.job.get_job(self.tunnel.job_id)
+        return dig(job, "TaskGroups/0/Tasks/0/Env/SSH_KEY", "")
+
+    def roll_back(self, submitted: bool, added: List[int]) -> None:
+        """Put the job back the way the tunnel describes it and return the
+        ports taken for the update"""
+        if submitted:
+            try:
+                self.update_job(
+                    self.tunnel.job_id,
+                    self.tunnel.allocated_tcp_ports or [0] * len(self.tunnel.port),
+                    self.current_ssh_key(),
+                    port_types=self.tunnel.port,
+                )
+            except (nomad.api.exceptions.BaseNomadException, NomadUnavailable):
+                # The job may still be listening on the new ports, leave them
+                # out of the pool until their lease runs out
+                current_app.logger.warning(
+                    f"Could not roll back port update of {self.tunnel.job_id}"
+                )
+                return
+
+        tcp_port_pool.release(self.subdomain.name, added)
+
+
+class TunnelResumeService(TunnelCreationService):
+    """Starts the container of a hibernated tunnel again.
+
+    The job is registered again exactly as it was stopped, on the same tcp
+    ports, so the tunnel comes back with the address it had"""
+
+    def __init__(self, current_user: User, tunnel: Tunnel):
+        self.current_user = current_user
+        self.tunnel = tunnel
+        self.subdomain = tunnel.subdomain
+        self.port_types = tunnel.port
+        self.timer = PhaseTimer("tunnel_resume")
+        self.use_cluster(tunnel.cluster)
+
+    def resume(self) -> Tunnel:
+        if self.tunnel.status == "running":
+            return self.tunnel
+        if self.tunnel.status != "hibernated":
+            raise UnprocessableEntity(detail="Only hibernated tunnels can be resumed")
+
+        self.cluster.nomad.breaker.check()
+        admit(self.current_user.id, [self.cluster])
+
+        job_id = self.tunnel.job_id
+        try:
+            after_index = self.restart_job(job_id)
+            ssh_port, ip_address = self.get_tunnel_details(job_id, after_index)
+        except (TunnelError, nomad.api.exceptions.BaseNomadException) as e:
+            if isinstance(e, NomadUnavailable):
+                raise
+            raise TunnelError("Failed to resume tunnel")
+        finally:
+            self.timer.flush()
+
+        redis_client.hdel(HIBERNATED_KEY, job_id)
+        self.tunnel.ssh_port = ssh_port
+        self.tunnel.ip_address = ip_address
+        self.tunnel.status = "running"
+
+        db.session.add(self.tunnel)
+        db.session.flush()
+
+        return self.tunnel
+
+    def restart_job(self, job_id: str) -> int:
+        spec = redis_client.hget(HIBERNATED_KEY, job_id)
+        # Nomad keeps stopped jobs until they are garbage collected
+        job = json.loads(spec) if spec else self.nomad_client.job.get_job(job_id)
+        new_job = json.dumps({"Job": dict(job, Stop=False)})
+
+        with self.timer.phase("nomad_submit"):
+            response = self.cluster.nomad.retry(
+                lambda client: client.job.request(
+                    job_id,
+                    data=new_job,
+                    method="post",
+                    headers={"Content-Type": "application/json"},
+                )
+            )
+        return response.json()["JobModifyIndex"]
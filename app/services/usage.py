@@ -0,0 +1,122 @@
+from flask import current_app
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+from app.models import Subdomain, Tunnel, UserUsage
+
+from typing import Dict, Optional, Tuple
+
+COUNTERS = ["tunnels", "reserved_subdomains"]
+
+
+class Usage:
+    """The usage counters of a user.
+
+    Failed tunnels are kept around until deleted but no longer count.
+
+    Changes are a single upsert run in the transaction making the change, so
+    the counters move with the rows they count and concurrent changes for the
+    same user queue up on the counter row instead of overwriting each other"""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+
+    def tunnels(self) -> int:
+        return self.read(UserUsage.tunnels)
+
+    def reserved_subdomains(self) -> int:
+        return self.read(UserUsage.reserved_subdomains)
+
+    def read(self, column) -> int:
+        # Users that never opened anything have no row yet
+        return (
+            db.session.query(column).filter(UserUsage.user_id == self.user_id).scalar()
+            or 0
+        )
+
+    def change(self, **deltas: int) -> None:
+        table = UserUsage.__table__
+        statement = insert(table).values(
+            user_id=self.user_id,
+            **{name: max(deltas.get(name, 0), 0) for name in COUNTERS},
+        )
+        changes = {name: table.c[name] + delta for name, delta in deltas.items()}
+        if changes:
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.user_id], set_=changes
+            )
+        else:
+            statement = statement.on_conflict_do_nothing()
+        db.session.execute(statement)
+
+    def fix(self) -> Optional[dict]:
+        """Recount the users tunnels and reserved subdomains with the counter
+        row locked, so nothing changes them in the meantime, and store the
+        counts when they differ"""
+        self.change()
+        usage = (
+            UserUsage.query.filter_by(user_id=self.user_id)
+            .populate_existing()
+            .with_for_update()
+            .one()
+        )
+
+        tunnels = (
+            db.session.query(db.func.count(Tunnel.id))
+            .select_from(Tunnel)
+            .join(Tunnel.subdomain)
+            .filter(Subdomain.user_id == self.user_id, Tunnel.status != "failed")
+            .scalar()
+        )
+        reserved = Subdomain.query.filter_by(
+            user_id=self.user_id, reserved=True
+        ).count()
+
+        counted = [usage.tunnels, usage.reserved_subdomains]
+        if counted == [tunnels, reserved]:
+            return None
+
+        usage.tunnels = tunnels
+        usage.reserved_subdomains = reserved
+        db.session.add(usage)
+        db.session.flush()
+        return {"counted": counted, "actual": [tunnels, reserved]}
+
+    @classmethod
+    def verify(cls) -> Dict[int, dict]:
+        """Compare every counter with the rows it counts and fix the ones
+        that drifted, returning what they were and what they should be"""
+        actual: Dict[int, Tuple[int, int]] = {}
+        for user_id, tunnels in (
+            db.session.query(Subdomain.user_id, db.func.count(Tunnel.id))
+            .select_from(Tunnel)
+            .join(Tunnel.subdomain)
+            .filter(Tunnel.status != "failed")
+            .group_by(Subdomain.user_id)
+        ):
+            actual[user_id] = (tunnels, 0)
+        for user_id, reserved in (
+            db.session.query(Subdomain.user_id, db.func.count(Subdomain.id))
+            .filter(Subdomain.reserved.is_(True))
+            .group_by(Subdomain.user_id)
+        ):
+            actual[user_id] = (actual.get(user_id, (0, 0))[0], reserved)
+
+        counted = {
+            usage.user_id: (usage.tunnels, usage.reserved_subdomains)
+            for usage in UserUsage.query
+        }
+
+        drifted = {}
+        for user_id in set(actual) | set(counted):
+            if actual.get(user_id, (0, 0)) == counted.get(user_id, (0, 0)):
+                continue
+
+            # The counts above may be out of date by now
+            drift = cls(user_id).fix()
+            if drift:
+                drifted[user_id] = drift
+
+        if drifted:
+            current_app.logger.warning(f"usage counters drifted: {drifted}")
+        return drifted
@@ -0,0 +1,120 @@
+import secrets
+import consul
+import nomad
+import requests
+from flask import current_app
+
+from app import nomad_clients, redis_client
+from app.jobs.nomad_cleanup import cleanup_old_nomad_box
+from app.utils.allocations import AllocationWaiter
+from app.utils.dns import discover_service
+from app.utils.errors import TunnelError
+from app.utils.job_spec import POOL_KV_PREFIX, build_sshd_job
+
+from typing import List, Optional
+
+
+class WarmPool:
+    """Idle sshd containers kept running for a port profile.
+
+    A tunnel claiming one of them only has to write its key to Consul and
+    attach its services to the job, which Nomad applies in place, instead of
+    waiting for a brand new container to be scheduled and started."""
+
+    def __init__(self, port_types: List[str], nomad_client=None):
+        self.port_types = list(port_types)
+        self.profile = "-".join(self.port_types)
+        self.nomad_client = nomad_client or nomad_clients.client()
+
+    @property
+    def ready_key(self) -> str:
+        return f"warm_pool:{self.profile}"
+
+    @property
+    def pending_key(self) -> str:
+        return f"warm_pool_pending:{self.profile}"
+
+    @staticmethod
+    def profiles() -> List[List[str]]:
+        if current_app.config["WARM_POOL_TARGET"] <= 0:
+            return []
+        return current_app.config["WARM_POOL_PROFILES"]
+
+    def serves(self) -> bool:
+        return self.port_types in self.profiles()
+
+    def size(self) -> int:
+        return redis_client.scard(self.ready_key)
+
+    def claim(
+        self, box_name: str, ssh_key: str, bandwidth: str, tcp_ports: List[int]
+    ) -> Optional[str]:
+        """Hand an idle container over to a tunnel, returning its job id or
+        None when the pool has nothing to offer"""
+        if not self.serves():
+            return None
+
+        job_id = redis_client.spop(self.ready_key)
+        if job_id is None:
+            return None
+        job_id = job_id.decode()
+
+        try:
+            consul_client = consul.Consul(host=discover_service("consul").ip)
+            consul_client.kv.put(f"{POOL_KV_PREFIX}/{job_id}/authorized_keys", ssh_key)
+            consul_client.kv.put(f"{POOL_KV_PREFIX}/{job_id}/bandwidth", bandwidth)
+            self.register(job_id, box_name, tcp_ports)
+        except (
+            consul.ConsulException,
+            nomad.api.exceptions.BaseNomadException,
+            requests.RequestException,
+        ):
+            cleanup_old_nomad_box.queue(job_id, timeout=60000)
+            return None
+
+        return job_id
+
+    def register(
+        self, job_id: str, box_name: Optional[str], tcp_ports: List[int]
+    ) -> None:
+        new_job = build_sshd_job(
+            job_id, box_name, self.port_types, tcp_ports, pool=True
+        )
+        self.nomad_client.jobs.request(
+            data=new_job, method="post", headers={"Content-Type": "application/json"}
+        )
+
+    def refill(self) -> int:
+        """Start containers until the pool is back at its target size"""
+        if not self.serves():
+            return 0
+
+        missing = (
+            current_app.config["WARM_POOL_TARGET"]
+            - self.size()
+            - redis_client.scard(self.pending_key)
+        )
+
+        started = []
+        for _ in range(max(missing, 0)):
+            job_id = f"ssh-pool-{self.profile}-{secrets.token_hex(4)}"
+            redis_client.sadd(self.pending_key, job_id)
+            try:
+                self.register(job_id, None, [0] * len(self.port_types))
+                started.append(job_id)
+            except nomad.api.exceptions.BaseNomadException:
+                redis_client.srem(self.pending_key, job_id)
+
+        waiter = AllocationWaiter(
+            self.nomad_client, deadline=current_app.config["TUNNEL_START_TIMEOUT"]
+        )
+        for job_id in started:
+            try:
+                waiter.wait_until_running(job_id)
+                redis_client.sadd(self.ready_key, job_id)
+            except TunnelError:
+                cleanup_old_nomad_box.queue(job_id, timeout=60000)
+            finally:
+                redis_client.srem(self.pending_key, job_id)
+
+        return len(started)
@@ -8,6 +8,85 @@ class Config(object):
 
     JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY")
     CONSUL_HOST = os.environ.get("CONSUL_HOST")
+    # Shared Nomad connections, see app.utils.nomad_client
+    NOMAD_PORT = int(os.environ.get("NOMAD_PORT", 4646))
+    NOMAD_TIMEOUT = int(os.environ.get("NOMAD_TIMEOUT", 10))
+    NOMAD_ENDPOINT_TTL = int(os.environ.get("NOMAD_ENDPOINT_TTL", 60))
+    NOMAD_EJECT_SECONDS = int(os.environ.get("NOMAD_EJECT_SECONDS", 30))
+    NOMAD_POOL_SIZE = int(os.environ.get("NOMAD_POOL_SIZE", 10))
+    # Failed requests in a row that open the circuit breaker, and seconds
+    # until it lets a request through to see whether Nomad is back
+    NOMAD_BREAKER_FAILURES = int(os.environ.get("NOMAD_BREAKER_FAILURES", 5))
+    NOMAD_BREAKER_RESET = int(os.environ.get("NOMAD_BREAKER_RESET", 30))
+    # Retries of a failed call, capped at a percentage of all calls
+    NOMAD_RETRIES = int(os.environ.get("NOMAD_RETRIES", 2))
+    NOMAD_RETRY_PERCENT = int(os.environ.get("NOMAD_RETRY_PERCENT", 20))
+    NOMAD_RETRY_BACKOFF_MS = int(os.environ.get("NOMAD_RETRY_BACKOFF_MS", 200))
+    # Nomad clusters tunnels are sharded over, as <datacenter>=<nomad
+    # service>[:<port>].  The first one gets the tunnels from before there
+    # were several and is the only one running the warm pool, multiplexed and
+    # dispatched containers, see app.utils.clusters.  New tunnels go to the
+    # cluster picked by CLUSTER_STRATEGY, "hash" of their subdomain or
+    # "least_loaded", see app.services.clusters
+    NOMAD_CLUSTERS = os.environ.get("NOMAD_CLUSTERS", "city=nomad").split(",")
+    CLUSTER_STRATEGY = os.environ.get("CLUSTER_STRATEGY", "hash")
+    # New tunnels let through to Nomad per second, cluster wide and per user,
+    # with the bursts allowed on top, see app.utils.admission
+    ADMISSION_RATE = float(os.environ.get("ADMISSION_RATE", 10))
+    ADMISSION_BURST = int(os.environ.get("ADMISSION_BURST", 50))
+    ADMISSION_USER_RATE = float(os.environ.get("ADMISSION_USER_RATE", 0.5))
+    ADMISSION_USER_BURST = int(os.environ.get("ADMISSION_USER_BURST", 10))
+    # New tunnels are turned away above these, 0 turns the check off
+    ADMISSION_MAX_NOMAD_MS = int(os.environ.get("ADMISSION_MAX_NOMAD_MS", 2000))
+    ADMISSION_MAX_QUEUED = int(os.environ.get("ADMISSION_MAX_QUEUED", 500))
+    # How tunnels get their sshd container: "job" registers a job for every
+    # tunnel, "dispatch" dispatches it from a parameterized job per port
+    # profile, see app.utils.dispatch, and "multiplexed" serves all the tunnels
+    # of a user from one container, see app.services.multiplex
+    TUNNEL_BACKEND = os.environ.get("TUNNEL_BACKEND", "job")
+    # The forwards every slot of a multiplexed container has room for, tunnels
+    # needing others get a container of their own
+    MULTIPLEX_SLOT_PORTS = os.environ.get(
+        "MULTIPLEX_SLOT_PORTS", "http,https,tcp,tcp"
+    ).split(",")
+    # Seconds the services of a tunnel have to fail their checks before its
+    # container is stopped until it is resumed, 0 turns it off.  See
+    # app.services.hibernation
+    HIBERNATE_AFTER = int(os.environ.get("HIBERNATE_AFTER", 0))
+    # The sshd image tunnels run, every node pulls it ahead of the first
+    # tunnel landing there, see app.services.prepull
+    SSHD_IMAGE = os.environ.get("SSHD_IMAGE", "cypherpunkarmory/sshd:0.1.4")
+    # New tunnels are kept off this many of the nodes carrying the most plan
+    # bandwidth, 0 turns it off.  The load index behind it is rebuilt every
+    # minute and dropped when older than NODE_LOAD_TTL, see
+    # app.services.node_load
+    NODE_LOAD_AFFINITIES = int(os.environ.get("NODE_LOAD_AFFINITIES", 5))
+    NODE_LOAD_TTL = int(os.environ.get("NODE_LOAD_TTL", 300))
+    # Seconds a tunnel has to get its container running before we give up
+    TUNNEL_START_TIMEOUT = int(os.environ.get("TUNNEL_START_TIMEOUT", 60))
+    # Seconds a tunnel has to confirm its tcp ports before they are returned
+    TCP_PORT_LEASE_SECONDS = int(os.environ.get("TCP_PORT_LEASE_SECONDS", 600))
+    # NodeID -> Address index, see app.utils.nodes
+    NODE_INDEX_TTL = int(os.environ.get("NODE_INDEX_TTL", 300))
+    NODE_INDEX_WATCH = os.environ.get("NODE_INDEX_WATCH", "true") == "true"
+    # Threads looking up allocation details side by side, see app.utils.lookups
+    LOOKUP_WORKERS = int(os.environ.get("LOOKUP_WORKERS", 16))
+    # Tunnel creation phase timings kept per phase, see app.utils.timing
+    PHASE_SAMPLES = int(os.environ.get("PHASE_SAMPLES", 1000))
+    PHASE_TRACING = os.environ.get("FLASK_ENV") == "production"
+    # Idempotency-Key handling, see app.utils.idempotency
+    IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 24 * 60 * 60))
+    IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get("IDEMPOTENCY_LOCK_SECONDS", 120))
+    IDEMPOTENCY_WAIT = int(os.environ.get("IDEMPOTENCY_WAIT", 30))
+    # Tunnels started at the same time by a single POST /operations
+    OPERATIONS_WORKERS = int(os.environ.get("OPERATIONS_WORKERS", 8))
+    # Idle sshd containers to keep running per port profile, 0 turns it off.
+    # Profiles are separated by ; and their port types by , eg. http;tcp,http
+    WARM_POOL_TARGET = int(os.environ.get("WARM_POOL_TARGET", 0))
+    WARM_POOL_PROFILES = [
+        profile.split(",")
+        for profile in os.environ.get("WARM_POOL_PROFILES", "http;https;tcp").split(";")
+    ]
 
 
 class TestConfig(Config):
@@ -18,6 +97,12 @@ class TestConfig(Config):
     RQ_REDIS_URL = "redis://redis:6379"
     REDIS_URL = "redis://redis:6379"
     TCP_LB_IP = "0.0.0.0"
+    NODE_INDEX_WATCH = False
+    ADMISSION_RATE = 1000.0
+    ADMISSION_BURST = 1000
+    ADMISSION_USER_RATE = 1000.0
+    ADMISSION_USER_BURST = 1000
+    ADMISSION_MAX_QUEUED = 0
     # RQ_ASYNC = False
     MAIL_SERVER = "mail"
     MAIL_PORT = 1025
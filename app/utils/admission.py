@@ -0,0 +1,86 @@
+import math
+from flask import current_app
+
+from app import Q, redis_client
+from app.utils.clusters import Cluster
+from app.utils.errors import TunnelCreationThrottled, TunnelLimitReached
+
+from typing import Iterable
+
+# KEYS: the cluster wide bucket, the bucket of the user.  ARGV: rate and
+# burst of each bucket, then the number of tokens wanted, which can't be
+# more than either burst.  Tokens are only taken when both buckets have them,
+# otherwise the milliseconds until they will are returned
+TAKE = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local wanted = tonumber(ARGV[5])
+
+local wait, tokens = 0, {}
+for i = 1, #KEYS do
+  local rate, burst = tonumber(ARGV[i * 2 - 1]), tonumber(ARGV[i * 2])
+  local state = redis.call('HMGET', KEYS[i], 'tokens', 'at')
+  local at = tonumber(state[2]) or now
+  tokens[i] = math.min(burst, (tonumber(state[1]) or burst) + (now - at) * rate)
+  if tokens[i] < wanted then
+    wait = math.max(wait, (wanted - tokens[i]) / rate)
+  end
+  tokens[i] = tokens[i] - wanted
+end
+
+if wait > 0 then
+  return math.ceil(wait * 1000)
+end
+
+for i = 1, #KEYS do
+  local rate, burst = tonumber(ARGV[i * 2 - 1]), tonumber(ARGV[i * 2])
+  redis.call('HMSET', KEYS[i], 'tokens', tokens[i], 'at', now)
+  redis.call('PEXPIRE', KEYS[i], math.ceil(burst / rate * 1000) + 1000)
+end
+return 0
+"""
+
+BUCKET_KEY = "admission:tunnels"
+# Seconds a client is asked to wait when Nomad or the workers are behind
+OVERLOADED_RETRY_AFTER = 5
+
+
+def admit(user_id: int, clusters: Iterable[Cluster], count: int = 1) -> None:
+    """Let `count` new tunnels of a user go to the Nomad `clusters` they are
+    placed on, raising TunnelCreationThrottled when they should be tried again
+    later instead.
+
+    Tunnels are turned away while one of those clusters answers slowly or the
+    nomad queue is backed up, and otherwise take tokens from a bucket shared
+    by every web process and from one of the user's own, so a single user
+    can't use up what is there for everybody.  More tunnels than a bucket
+    holds at all are never let through and raise TunnelLimitReached"""
+    config = current_app.config
+
+    most = min(config["ADMISSION_BURST"], config["ADMISSION_USER_BURST"])
+    if count > most:
+        raise TunnelLimitReached(detail=f"At most {most} tunnels can be opened at once")
+
+    max_latency = config["ADMISSION_MAX_NOMAD_MS"]
+    if max_latency and any(
+        cluster.nomad.latency() > max_latency for cluster in clusters
+    ):
+        raise TunnelCreationThrottled(retry_after=OVERLOADED_RETRY_AFTER)
+
+    max_queued = config["ADMISSION_MAX_QUEUED"]
+    if max_queued and Q.get_queue("nomad").count > max_queued:
+        raise TunnelCreationThrottled(retry_after=OVERLOADED_RETRY_AFTER)
+
+    wait = redis_client.register_script(TAKE)(
+        keys=[BUCKET_KEY, f"{BUCKET_KEY}:{user_id}"],
+        args=[
+            config["ADMISSION_RATE"],
+            config["ADMISSION_BURST"],
+            config["ADMISSION_USER_RATE"],
+            config["ADMISSION_USER_BURST"],
+            count,
+        ],
+    )
+    if wait:
+        raise TunnelCreationThrottled(retry_after=math.ceil(wait / 1000))
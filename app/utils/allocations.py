@@ -0,0 +1,106 @@
+import random
+import time
+import nomad
+
+from app.utils.errors import TunnelError
+
+from typing import List, Optional
+
+# Allocation client statuses Nomad will not move on from
+FAILED_STATUSES = {"failed", "lost", "complete"}
+
+
+class AllocationWaiter:
+    """Wait for the allocation of a job to start running.
+
+    Rather than polling the job until its status changes we lean on Nomad's
+    blocking queries - every request carries the last `X-Nomad-Index` we saw
+    and Nomad holds it open until something about the allocations changes, so
+    a normal start only costs a couple of round trips.
+    """
+
+    def __init__(
+        self,
+        nomad_client,
+        deadline: float = 60,
+        wait: float = 30,
+        backoff: float = 0.25,
+        max_backoff: float = 4,
+    ):
+        self.nomad_client = nomad_client
+        self.deadline = deadline
+        self.wait = wait
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.round_trips = 0
+
+    def wait_until_running(self, job_id: str, after_index: int = 0) -> dict:
+        """Block until an allocation of `job_id` is running and return its stub.
+
+        Pass the `JobModifyIndex` of a job update as `after_index` to ignore
+        the allocations that existed before it."""
+        give_up_at = time.monotonic() + self.deadline
+        failures = 0
+        index = after_index
+
+        while True:
+            remaining = give_up_at - time.monotonic()
+            if remaining <= 0:
+                raise TunnelError(detail="The tunnel failed to start.")
+
+            try:
+                new_index, allocations = self._allocations(job_id, index, remaining)
+            except nomad.api.exceptions.BaseNomadException:
+                failures += 1
+                time.sleep(min(self._jittered_backoff(failures), remaining))
+                continue
+
+            failures = 0
+            allocations = [
+                a for a in allocations if a.get("CreateIndex", 0) > after_index
+            ]
+
+            allocation = self._running(allocations)
+            if allocation:
+                return allocation
+
+            if self._failed(allocations):
+                raise TunnelError(detail="The tunnel failed to start.")
+
+            # Nomad asks clients to start over if the index ever goes backwards
+            index = new_index if new_index >= index else 0
+
+    def _allocations(self, job_id: str, index: int, remaining: float):
+        self.round_trips += 1
+        response = self.nomad_client.job.request(
+            job_id,
+            "allocations",
+            method="get",
+            params={"index": index, "wait": f"{self._wait_ms(remaining)}ms"},
+        )
+        return int(response.headers.get("X-Nomad-Index", 0)), response.json()
+
+    def _wait_ms(self, remaining: float) -> int:
+        # Nomad adds up to wait/16 of jitter to a blocking query, so leave
+        # enough room for it to answer before the HTTP client gives up.
+        client_timeout = self.nomad_client.job.timeout
+        wait = min(self.wait, remaining, client_timeout * 15 / 17)
+        return max(int(wait * 1000), 1)
+
+    def _jittered_backoff(self, failures: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** failures))
+
+    @staticmethod
+    def _newest_first(allocations: List[dict]) -> List[dict]:
+        return sorted(allocations, key=lambda a: a.get("CreateIndex", 0), reverse=True)
+
+    def _running(self, allocations: List[dict]) -> Optional[dict]:
+        for allocation in self._newest_first(allocations):
+            if allocation["ClientStatus"] == "running":
+                return allocation
+        return None
+
+    def _failed(self, allocations: List[dict]) -> bool:
+        return bool(allocations) and all(
+            a["ClientStatus"] in FAILED_STATUSES for a in allocations
+        )
@@ -0,0 +1,80 @@
+import threading
+from flask import current_app
+
+from app.utils.nodes import NodeAddressIndex
+from app.utils.nomad_client import NomadClientManager
+
+from typing import Dict, List, Optional, Tuple
+
+
+class Cluster:
+    """A Nomad cluster tunnels can be scheduled on, named after the datacenter
+    its jobs run in"""
+
+    def __init__(self, name: str, nomad: NomadClientManager, nodes: NodeAddressIndex):
+        self.name = name
+        self.nomad = nomad
+        self.nodes = nodes
+
+    @property
+    def datacenters(self) -> List[str]:
+        return [self.name]
+
+
+class ClusterRegistry:
+    """The Nomad clusters tunnels are sharded over, see NOMAD_CLUSTERS.
+
+    Every cluster has its own client manager, so its own servers, circuit
+    breaker and retry budget, and its own node address index, so one cluster
+    going down leaves the tunnels on the others alone.  The first cluster is
+    served by the app wide `nomad_clients` and `node_addresses`, and is the
+    one every tunnel from before there were several lives on."""
+
+    def __init__(self, nomad: NomadClientManager, nodes: NodeAddressIndex):
+        self.lock = threading.Lock()
+        self.default_nomad = nomad
+        self.default_nodes = nodes
+        self.clusters: Dict[str, Cluster] = {}
+
+    @staticmethod
+    def config() -> Dict[str, Tuple[str, Optional[int]]]:
+        """Cluster name -> the Nomad service and port its servers answer on"""
+        clusters = {}
+        for entry in current_app.config["NOMAD_CLUSTERS"]:
+            name, _, address = entry.partition("=")
+            service, _, port = address.partition(":")
+            clusters[name] = (service or "nomad", int(port) if port else None)
+        return clusters
+
+    def names(self) -> List[str]:
+        return list(self.config())
+
+    def default(self) -> str:
+        return self.names()[0]
+
+    def is_default(self, name: Optional[str]) -> bool:
+        return name is None or name == self.default()
+
+    def get(self, name: Optional[str] = None) -> Cluster:
+        """The cluster of that name, tunnels without one are on the first"""
+        name = name or self.default()
+        with self.lock:
+            if name not in self.clusters:
+                self.clusters[name] = self._build(name)
+            return self.clusters[name]
+
+    def all(self) -> List[Cluster]:
+        return [self.get(name) for name in self.names()]
+
+    def stats(self) -> dict:
+        return {cluster.name: cluster.nomad.stats() for cluster in self.all()}
+
+    def _build(self, name: str) -> Cluster:
+        service, port = self.config()[name]
+        if self.is_default(name):
+            self.default_nomad.service = service
+            self.default_nomad.port = port
+            return Cluster(name, self.default_nomad, self.default_nodes)
+
+        nomad = NomadClientManager(service, port)
+        return Cluster(name, nomad, NodeAddressIndex(nomad))
@@ -0,0 +1,45 @@
+import nomad
+
+from app import nomad_clients
+from app.utils.job_spec import build_sshd_dispatch_job, dispatch_job_id, dispatch_meta
+
+from typing import List, Set
+
+# Parameterized jobs this process has registered.  One is registered again
+# after a dispatch from it failed, in case Nomad no longer has it
+registered: Set[str] = set()
+
+
+def register_dispatch_job(port_types: List[str]) -> None:
+    # Registering an unchanged job doesn't make Nomad do anything
+    job = build_sshd_dispatch_job(port_types)
+    nomad_clients.retry(
+        lambda client: client.jobs.request(
+            data=job, method="post", headers={"Content-Type": "application/json"}
+        )
+    )
+    registered.add(dispatch_job_id(port_types))
+
+
+def dispatch_sshd_job(
+    box_name: str,
+    port_types: List[str],
+    tcp_ports: List[int],
+    ssh_key: str,
+    bandwidth: str,
+) -> dict:
+    """Start the sshd container of a tunnel by dispatching the parameterized
+    job of its port profile, rather than registering a job of its own.
+
+    Returns Nomad's answer, the tunnel's job id is its `DispatchedJobID`"""
+    parent = dispatch_job_id(port_types)
+    if parent not in registered:
+        register_dispatch_job(port_types)
+
+    meta = dispatch_meta(box_name, port_types, tcp_ports, ssh_key, bandwidth)
+    try:
+        # Not retried, every dispatch that gets through starts a container
+        return nomad_clients.client().job.dispatch_job(parent, meta=meta)
+    except nomad.api.exceptions.BaseNomadException:
+        registered.discard(parent)
+        raise
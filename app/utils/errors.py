@@ -67,6 +67,25 @@ class TunnelError(JsonApiException):
     status = "500"
 
 
+class NomadUnavailable(TunnelError):
+    """Raised without calling Nomad while its circuit breaker is open"""
+
+    title = "Nomad Unavailable"
+    detail = "Tunnels can't be changed right now, please try again shortly"
+    status = "503"
+
+    def __init__(self, retry_after: int = 1, **kwargs):
+        super().__init__(**kwargs)
+        self.retry_after = retry_after
+
+
+class TunnelCreationThrottled(NomadUnavailable):
+    """Raised when new tunnels are turned away before reaching Nomad"""
+
+    title = "Tunnel Creation Throttled"
+    detail = "Too many tunnels are being created right now, please try again shortly"
+
+
 class RedisError(JsonApiException):
     """Raised when there is an error connecting to Redis"""
 
@@ -194,3 +213,11 @@ class LockAcquisitionException(JsonApiException):
 class TooManyRequestsError(JsonApiException):
     title = "TooManyRequestsException"
     status = "429"
+
+
+class RequestInProgress(JsonApiException):
+    """Raised when a request with the same Idempotency-Key is still running"""
+
+    title = "Request in progress"
+    detail = "A request with this Idempotency-Key is still being processed"
+    status = "409"
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import time
+from functools import wraps
+from flask import current_app, make_response, request
+from flask_jwt_extended import get_jwt_identity
+
+from app import redis_client
+from app.serializers import ErrorSchema
+from app.utils.db import Interactor
+from app.utils.errors import BadRequest, RequestInProgress, UnprocessableEntity
+from app.utils.json import json_api
+
+from typing import Optional
+
+# Response headers worth handing back when a request is replayed
+REPLAYED_HEADERS = ["Content-Type", "Location"]
+POLL_INTERVAL = 0.25
+
+
+def idempotent(f):
+    """Let clients safely retry a request by sending an Idempotency-Key.
+
+    The first request with a key runs as usual and its response is kept in
+    Redis for IDEMPOTENCY_TTL seconds once it has been committed.  Retries get
+    that response back instead of running again, and a retry arriving while
+    the first request is still running waits up to IDEMPOTENCY_WAIT seconds
+    for it to finish.  Server errors aren't kept so they can be retried."""
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return f(*args, **kwargs)
+        if not 0 < len(key) <= 255:
+            detail = "Idempotency-Key must be between 1 and 255 characters"
+            return json_api(BadRequest(detail=detail), ErrorSchema), 400
+
+        redis_key = f"idempotency:{get_jwt_identity()}:{request.path}:{key}"
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        while not redis_client.set(
+            redis_key,
+            json.dumps({"fingerprint": fingerprint}),
+            nx=True,
+            ex=current_app.config["IDEMPOTENCY_LOCK_SECONDS"],
+        ):
+            replayed = replay(redis_key, fingerprint)
+            if replayed is not None:
+                return replayed
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            redis_client.delete(redis_key)
+            raise
+
+        if response.status_code >= 500:
+            redis_client.delete(redis_key)
+            return response
+
+        stored = json.dumps(
+            {
+                "fingerprint": fingerprint,
+                "status": response.status_code,
+                "body": response.get_data(as_text=True),
+                "headers": {
+                    header: response.headers[header]
+                    for header in REPLAYED_HEADERS
+                    if header in response.headers
+                },
+            }
+        )
+
+        def store(_=None):
+            redis_client.set(
+                redis_key, stored, ex=current_app.config["IDEMPOTENCY_TTL"]
+            )
+
+        if response.status_code < 400:
+            # Successful requests are only final once they've been committed
+            Interactor.after_commit(store)
+        else:
+            store()
+
+        return response
+
+    return wrapper
+
+
+def replay(redis_key: str, fingerprint: str):
+    """The response to hand back for a key that has been seen before, None
+    when the earlier request failed and this one should run instead"""
+    deadline = time.monotonic() + current_app.config["IDEMPOTENCY_WAIT"]
+    while True:
+        stored = load(redis_key)
+        if stored is None:
+            return None
+
+        if stored["fingerprint"] != fingerprint:
+            detail = "Idempotency-Key has already been used for a different request"
+            return json_api(UnprocessableEntity(detail=detail), ErrorSchema), 422
+
+        if "status" in stored:
+            response = make_response(stored["body"], stored["status"])
+            for header, value in stored["headers"].items():
+                response.headers[header] = value
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        if time.monotonic() >= deadline:
+            response = json_api(RequestInProgress, ErrorSchema)
+            response.headers["Retry-After"] = "1"
+            return response, 409
+
+        time.sleep(POLL_INTERVAL)
+
+
+def load(redis_key: str) -> Optional[dict]:
+    stored = redis_client.get(redis_key)
+    if stored is None:
+        return None
+    return json.loads(stored)
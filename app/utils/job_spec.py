@@ -0,0 +1,617 @@
+import json
+import re
+from functools import lru_cache
+from flask import current_app, render_template
+
+from typing import Dict, List, Optional, Tuple
+
+# Consul KV prefix warm pool containers read their ssh key and bandwidth from
+POOL_KV_PREFIX = "holepunch/pool"
+
+# Parameterized sshd jobs tunnels are dispatched from, one per port profile
+DISPATCH_PREFIX = "ssh-dispatch-"
+
+# The sshd jobs each serving all the tunnels of a user, and the Consul KV
+# prefix they read the keys of their slots and the users bandwidth from
+MULTIPLEX_PREFIX = "ssh-user-"
+MULTIPLEX_KV_PREFIX = "holepunch/users"
+# The container ports of slot n are those of a tunnel of its own moved up by
+# SLOT_STRIDE * n, eg. http is on 3000 in slot 0 and 3010 in slot 1
+SLOT_STRIDE = 10
+# The system job keeping the sshd image on every node
+PREPULL_JOB_ID = "sshd-prepull"
+
+# Resources of a multiplexed container on top of a single tunnel's ones
+SLOT_CPU = 5
+SLOT_MEMORY_MB = 5
+
+# Anything ast.literal_eval in the container can't cope with, eg. \n, \r, etc..
+UNPRINTABLE = re.compile(r"[^\x20-\x7e]+")
+
+# The parts of the sshd job that are the same for every tunnel.  They are
+# shared between the jobs build_sshd_job puts together, so never modify them.
+JOB = {
+    "Affinities": None,
+    "AllAtOnce": False,
+    "Constraints": [{"LTarget": "${meta.app}", "RTarget": "holepunch", "Operand": "="}],
+    "CreateIndex": 81,
+    "Datacenters": ["city"],
+    "Dispatched": False,
+    "JobModifyIndex": 81,
+    "Meta": None,
+    "Migrate": None,
+    "ModifyIndex": 83,
+    "Namespace": "default",
+    "ParameterizedJob": None,
+    "ParentID": "",
+    "Payload": None,
+    "Periodic": None,
+    "Priority": 50,
+    "Region": "global",
+    "Reschedule": None,
+    "Spreads": None,
+    "Stable": False,
+    "Status": None,
+    "StatusDescription": "",
+    "Stop": False,
+    "SubmitTime": 1559239760878108100,
+    "Type": "service",
+    "Update": {
+        "AutoRevert": False,
+        "Canary": 0,
+        "HealthCheck": "",
+        "HealthyDeadline": 0,
+        "MaxParallel": 0,
+        "MinHealthyTime": 0,
+        "ProgressDeadline": 0,
+        "Stagger": 0,
+    },
+    "VaultToken": "",
+    "Version": 0,
+}
+
+TASK_GROUP = {
+    "Affinities": None,
+    "Constraints": None,
+    "Count": 1,
+    "EphemeralDisk": {"Migrate": False, "SizeMB": 300, "Sticky": False},
+    "Meta": None,
+    "Migrate": {
+        "HealthCheck": "checks",
+        "HealthyDeadline": 300000000000,
+        "MaxParallel": 1,
+        "MinHealthyTime": 10000000000,
+    },
+    "Name": "holepunch",
+    "ReschedulePolicy": {
+        "Attempts": 0,
+        "Delay": 30000000000,
+        "DelayFunction": "exponential",
+        "Interval": 0,
+        "MaxDelay": 3600000000000,
+        "Unlimited": True,
+    },
+    "RestartPolicy": {
+        "Attempts": 2,
+        "Delay": 15000000000,
+        "Interval": 1800000000000,
+        "Mode": "fail",
+    },
+    "Spreads": None,
+    "Update": None,
+}
+
+TASK = {
+    "Affinities": None,
+    "Artifacts": None,
+    "Constraints": None,
+    "DispatchPayload": None,
+    "Driver": "docker",
+    "KillSignal": "",
+    "KillTimeout": 5000000000,
+    "Leader": False,
+    "LogConfig": {"MaxFileSizeMB": 10, "MaxFiles": 10},
+    "Meta": None,
+    "Name": "sshd",
+    "ShutdownDelay": 0,
+    "User": "",
+    "Vault": None,
+}
+
+POOL_ENV = {
+    "BANDWIDTH_FILE": "/secrets/bandwidth",
+    "SSH_KEY_FILE": "/secrets/authorized_keys",
+}
+
+
+def printable(text: str) -> str:
+    return UNPRINTABLE.sub("", text)
+
+
+def port_label(port: str, iter: int) -> str:
+    return f"{port}{iter}" if port == "tcp" else port
+
+
+@lru_cache(maxsize=128)
+def port_layout(port_types: Tuple[str, ...]) -> Tuple[dict, dict]:
+    """The docker port map and network block for a combination of port types"""
+    port_map = {}
+    tcp_port = 3002
+    for iter, port in enumerate(port_types, 1):
+        if port == "tcp":
+            port_map[port_label(port, iter)] = tcp_port
+            tcp_port += 1
+        else:
+            port_map[port] = 3000 if port == "http" else 3001
+    port_map["ssh"] = 22
+
+    network = {
+        "CIDR": "",
+        "Device": "",
+        "DynamicPorts": [
+            {"Label": port_label(port, iter), "Value": 0}
+            for iter, port in enumerate(port_types, 1)
+        ]
+        + [{"Label": "ssh", "Value": 0}],
+        "IP": "",
+        "MBits": 1,
+        "ReservedPorts": None,
+    }
+    return port_map, network
+
+
+def service(
+    port: str, iter: int, box_name: str, tcp_port: int, base_url: str, tcp_lb_ip: str
+) -> dict:
+    label = port_label(port, iter)
+    if port == "tcp":
+        tag = f"urlprefix-{tcp_lb_ip}:{tcp_port}/ proto=tcp"
+        # health_check.j2.json has always named the tcp checks and labelled
+        # the others, keep doing the same so existing jobs don't change
+        check_name = ("Name", f"{label}-{box_name}-up")
+    elif port == "http":
+        tag = f"urlprefix-{box_name}.{base_url}/ proto=http"
+        check_name = ("Label", f"{label}-{box_name}-up")
+    else:
+        tag = f"urlprefix-{box_name}.{base_url}/ proto=tcp+sni"
+        check_name = ("Label", f"{label}-{box_name}-up")
+
+    check = {
+        "AddressMode": "driver",
+        "Args": None,
+        "CheckRestart": None,
+        "Command": "",
+        "GRPCService": "",
+        "GRPCUseTLS": False,
+        "Header": None,
+        "Id": "",
+        "Interval": 10000000000,
+        "InitialStatus": "",
+        "Method": "",
+        "Path": "",
+        "PortLabel": label,
+        "Protocol": "",
+        "TLSSkipVerify": False,
+        "Timeout": 2000000000,
+        "Type": "tcp",
+    }
+    check[check_name[0]] = check_name[1]
+
+    return {
+        "AddressMode": "auto",
+        "CanaryTags": None,
+        "CheckRestart": None,
+        "Checks": [check],
+        "Id": "",
+        "Name": f"ssh-{box_name}-{label}",
+        "PortLabel": label,
+        "Tags": [tag],
+    }
+
+
+def build_sshd_job(
+    job_id: str,
+    box_name: Optional[str],
+    port_types: List[str],
+    tcp_ports: List[int],
+    ssh_key: str = "",
+    bandwidth: str = "",
+    pool: bool = False,
+    affinities: Optional[List[dict]] = None,
+    datacenters: Optional[List[str]] = None,
+) -> str:
+    """Put together the Nomad job running the sshd container behind a tunnel.
+
+    Pool jobs read the ssh key and bandwidth from Consul so they can be
+    handed to a user without restarting, and only get their services once
+    they are bound to a `box_name`.  `affinities` steer the container away
+    from busy nodes, see `load_affinities`, and `datacenters` are those of
+    the cluster the tunnel was sharded to.
+
+    Produces the same job as rendering sshd.j2.json, see `render_sshd_job`,
+    without going through the template on every tunnel."""
+    port_map, network = port_layout(tuple(port_types))
+
+    services = []
+    if box_name:
+        base_url = current_app.config["BASE_SERVICE_URL"]
+        tcp_lb_ip = current_app.config["TCP_LB_IP"]
+        services = [
+            service(port, iter, box_name, tcp_port, base_url, tcp_lb_ip)
+            for iter, (port, tcp_port) in enumerate(zip(port_types, tcp_ports), 1)
+        ]
+
+    templates = None
+    if pool:
+        env = POOL_ENV
+        templates = [
+            {
+                "ChangeMode": "signal",
+                "ChangeSignal": "SIGHUP",
+                "DestPath": f"secrets/{name}",
+                "EmbeddedTmpl": (
+                    f'[[ keyOrDefault "{POOL_KV_PREFIX}/{job_id}/{name}" "" ]]'
+                ),
+                "LeftDelim": "[[",
+                "Perms": "0644",
+                "RightDelim": "]]",
+                "Splay": 0,
+            }
+            for name in ["authorized_keys", "bandwidth"]
+        ]
+    else:
+        env = {"BANDWIDTH": bandwidth, "SSH_KEY": ssh_key}
+
+    task = dict(
+        TASK,
+        Config={
+            "image": current_app.config["SSHD_IMAGE"],
+            "labels": [{"io.holepunch.sshd": job_id if pool else box_name}],
+            "port_map": [port_map],
+        },
+        Env=env,
+        Resources={
+            "CPU": 20,
+            "Devices": None,
+            "DiskMB": 0,
+            "IOPS": 0,
+            "MemoryMB": 20,
+            "Networks": [network],
+        },
+        Services=services,
+        Templates=templates,
+    )
+    task_group = dict(TASK_GROUP, Tasks=[task])
+
+    return json.dumps(
+        {
+            "Job": dict(
+                JOB,
+                ID=job_id,
+                Name=job_id,
+                Affinities=affinities,
+                Datacenters=datacenters or JOB["Datacenters"],
+                TaskGroups=[task_group],
+            )
+        }
+    )
+
+
+def load_affinities(load: Dict[str, int], busiest: int) -> Optional[List[dict]]:
+    """Affinities keeping new tunnels off the nodes carrying the most
+    bandwidth, given by node address.
+
+    Nodes above the average get a negative weight growing with their share of
+    the busiest one, up to `busiest` of them so the job stays small"""
+    if not load or busiest <= 0:
+        return None
+
+    average = sum(load.values()) / len(load)
+    heaviest = max(load.values())
+    above = sorted(
+        (node for node in load.items() if node[1] > average),
+        key=lambda node: node[1],
+        reverse=True,
+    )[:busiest]
+    if not above:
+        return None
+
+    return [
+        {
+            "LTarget": "${attr.unique.network.ip-address}",
+            "Operand": "=",
+            "RTarget": address,
+            "Weight": -max(round(100 * bandwidth / heaviest), 1),
+        }
+        for address, bandwidth in above
+    ]
+
+
+def dispatch_job_id(port_types: List[str]) -> str:
+    return DISPATCH_PREFIX + "-".join(port_types)
+
+
+def dispatched(job_id: str) -> bool:
+    return job_id.startswith(DISPATCH_PREFIX)
+
+
+def dispatch_meta_keys(port_types: List[str]) -> List[str]:
+    return ["box", "ssh_key", "bandwidth"] + [
+        port_label(port, iter)
+        for iter, port in enumerate(port_types, 1)
+        if port == "tcp"
+    ]
+
+
+def build_sshd_dispatch_job(port_types: List[str]) -> str:
+    """Put together the parameterized sshd job tunnels with these port types
+    are dispatched from.
+
+    It is the job build_sshd_job makes with everything that differs between
+    tunnels read from the metadata of the dispatch, see `dispatch_meta`.
+    Nomad only allows batch jobs to be parameterized, which rules out the
+    update and migrate blocks of service jobs."""
+    tcp_ports: list = [
+        "${NOMAD_META_%s}" % port_label(port, iter) if port == "tcp" else 0
+        for iter, port in enumerate(port_types, 1)
+    ]
+    job = json.loads(
+        build_sshd_job(
+            dispatch_job_id(port_types),
+            "${NOMAD_META_box}",
+            port_types,
+            tcp_ports,
+            ssh_key="${NOMAD_META_ssh_key}",
+            bandwidth="${NOMAD_META_bandwidth}",
+        )
+    )["Job"]
+
+    job.update(
+        Type="batch",
+        Update=None,
+        ParameterizedJob={
+            "Payload": "forbidden",
+            "MetaRequired": dispatch_meta_keys(port_types),
+            "MetaOptional": None,
+        },
+    )
+    job["TaskGroups"][0]["Migrate"] = None
+    return json.dumps({"Job": job})
+
+
+def dispatch_meta(
+    box_name: str,
+    port_types: List[str],
+    tcp_ports: List[int],
+    ssh_key: str,
+    bandwidth: str,
+) -> Dict[str, str]:
+    """The metadata to dispatch a tunnel's sshd job with"""
+    meta = {"box": box_name, "ssh_key": ssh_key, "bandwidth": bandwidth}
+    for iter, (port, tcp_port) in enumerate(zip(port_types, tcp_ports), 1):
+        if port == "tcp":
+            meta[port_label(port, iter)] = str(tcp_port)
+    return meta
+
+
+def multiplex_job_id(user_id: int) -> str:
+    return f"{MULTIPLEX_PREFIX}{user_id}"
+
+
+def multiplexed(job_id: str) -> bool:
+    return job_id.startswith(MULTIPLEX_PREFIX)
+
+
+def slot_label(slot: int, label: str) -> str:
+    return f"s{slot}{label}"
+
+
+def slot_labels(port_types: List[str], slot_ports: List[str]) -> Optional[List[str]]:
+    """The labels of the slot ports a tunnel's forwards go to, in the order of
+    its port types, or None when they don't fit into a slot"""
+    free = [port_label(port, iter) for iter, port in enumerate(slot_ports, 1)]
+    labels = []
+    for port in port_types:
+        label = next(
+            (label for label in free if label.rstrip("0123456789") == port), None
+        )
+        if label is None:
+            return None
+        free.remove(label)
+        labels.append(label)
+    return labels
+
+
+@lru_cache(maxsize=32)
+def slot_layout(slot_ports: Tuple[str, ...], slots: int) -> Tuple[dict, dict]:
+    """The docker port map and network block of a container with `slots`
+    slots of `slot_ports` each"""
+    tunnel_map, _ = port_layout(slot_ports)
+    port_map = {"ssh": 22}
+    dynamic_ports = []
+    for slot in range(slots):
+        for label, container_port in tunnel_map.items():
+            if label != "ssh":
+                port_map[slot_label(slot, label)] = container_port + SLOT_STRIDE * slot
+                dynamic_ports.append({"Label": slot_label(slot, label), "Value": 0})
+
+    network = {
+        "CIDR": "",
+        "Device": "",
+        "DynamicPorts": dynamic_ports + [{"Label": "ssh", "Value": 0}],
+        "IP": "",
+        "MBits": 1,
+        "ReservedPorts": None,
+    }
+    return port_map, network
+
+
+def build_multiplexed_sshd_job(
+    job_id: str,
+    slots: int,
+    tunnels: Dict[int, Tuple[str, List[str], List[int]]],
+    slot_ports: List[str],
+) -> str:
+    """Put together the sshd job serving the tunnels of a user, given as their
+    box name, port types and tcp ports by slot.
+
+    Every slot has the same ports so the network of the job never changes,
+    tunnels coming and going only change its services.  Nomad applies that to
+    the running container, as it does the keys and bandwidth it renders from
+    Consul."""
+    port_map, network = slot_layout(tuple(slot_ports), slots)
+    base_url = current_app.config["BASE_SERVICE_URL"]
+    tcp_lb_ip = current_app.config["TCP_LB_IP"]
+
+    services = []
+    for slot, (box_name, port_types, tcp_ports) in sorted(tunnels.items()):
+        labels = slot_labels(port_types, slot_ports) or []
+        for iter, (port, tcp_port, label) in enumerate(
+            zip(port_types, tcp_ports, labels), 1
+        ):
+            # The service keeps the name it has in a container of its own
+            tunnel_service = service(
+                port, iter, box_name, tcp_port, base_url, tcp_lb_ip
+            )
+            checks = [
+                dict(check, PortLabel=slot_label(slot, label))
+                for check in tunnel_service["Checks"]
+            ]
+            services.append(
+                dict(tunnel_service, PortLabel=slot_label(slot, label), Checks=checks)
+            )
+
+    kv_prefix = f"{MULTIPLEX_KV_PREFIX}/{job_id}"
+    templates = [
+        {
+            "ChangeMode": "signal",
+            "ChangeSignal": "SIGHUP",
+            "DestPath": "secrets/authorized_keys",
+            "EmbeddedTmpl": (
+                f'[[ range ls "{kv_prefix}/keys" ]][[ .Value ]]\n[[ end ]]'
+            ),
+            "LeftDelim": "[[",
+            "Perms": "0644",
+            "RightDelim": "]]",
+            "Splay": 0,
+        },
+        {
+            "ChangeMode": "signal",
+            "ChangeSignal": "SIGHUP",
+            "DestPath": "secrets/bandwidth",
+            "EmbeddedTmpl": f'[[ keyOrDefault "{kv_prefix}/bandwidth" "" ]]',
+            "LeftDelim": "[[",
+            "Perms": "0644",
+            "RightDelim": "]]",
+            "Splay": 0,
+        },
+    ]
+
+    task = dict(
+        TASK,
+        Config={
+            "image": current_app.config["SSHD_IMAGE"],
+            "labels": [{"io.holepunch.sshd": job_id}],
+            "port_map": [port_map],
+        },
+        Env=POOL_ENV,
+        Resources={
+            "CPU": 20 + SLOT_CPU * (slots - 1),
+            "Devices": None,
+            "DiskMB": 0,
+            "IOPS": 0,
+            "MemoryMB": 20 + SLOT_MEMORY_MB * (slots - 1),
+            "Networks": [network],
+        },
+        Services=services,
+        Templates=templates,
+    )
+    task_group = dict(TASK_GROUP, Tasks=[task])
+
+    return json.dumps(
+        {"Job": dict(JOB, ID=job_id, Name=job_id, TaskGroups=[task_group])}
+    )
+
+
+def build_prepull_job(image: str, datacenters: Optional[List[str]] = None) -> str:
+    """Put together the system job running `image` on every node of the
+    `datacenters` tunnels can land on.
+
+    It only sleeps, but a node has to pull the image to start it and keeps
+    it while it runs, so tunnels never wait for the pull themselves"""
+    task = dict(
+        TASK,
+        Name="prepull",
+        Config={
+            "image": image,
+            # Instead of the image's own entrypoint, which starts sshd
+            "entrypoint": ["/bin/sh", "-c"],
+            "command": "trap exit TERM; while true; do sleep 3600 & wait; done",
+        },
+        Env=None,
+        Resources={
+            "CPU": 10,
+            "Devices": None,
+            "DiskMB": 0,
+            "IOPS": 0,
+            "MemoryMB": 10,
+            "Networks": None,
+        },
+        Services=None,
+        Templates=None,
+    )
+    # System jobs can't be migrated or rescheduled, Nomad places them itself
+    task_group = dict(
+        TASK_GROUP,
+        Name="prepull",
+        EphemeralDisk={"Migrate": False, "SizeMB": 10, "Sticky": False},
+        Migrate=None,
+        ReschedulePolicy=None,
+        Tasks=[task],
+    )
+
+    return json.dumps(
+        {
+            "Job": dict(
+                JOB,
+                ID=PREPULL_JOB_ID,
+                Name=PREPULL_JOB_ID,
+                Datacenters=datacenters or JOB["Datacenters"],
+                Type="system",
+                Meta={"image": image},
+                TaskGroups=[task_group],
+            )
+        }
+    )
+
+
+def render_sshd_job(
+    job_id: str,
+    box_name: Optional[str],
+    port_types: List[str],
+    tcp_ports: List[int],
+    ssh_key: str = "",
+    bandwidth: str = "",
+    pool: bool = False,
+    affinities: Optional[List[dict]] = None,
+    datacenters: Optional[List[str]] = None,
+) -> str:
+    """Render the sshd job from sshd.j2.json.  Kept as the reference
+    `build_sshd_job` is checked against."""
+    return render_template(
+        "sshd.j2.json",
+        job_id=job_id,
+        label=job_id if pool else box_name,
+        pool=pool,
+        pool_kv_prefix=POOL_KV_PREFIX,
+        ssh_key=ssh_key,
+        box_name=box_name,
+        bandwidth=bandwidth,
+        image=current_app.config["SSHD_IMAGE"],
+        affinities=affinities,
+        datacenters=datacenters or JOB["Datacenters"],
+        base_url=current_app.config["BASE_SERVICE_URL"],
+        port_types=port_types,
+        tcp_ports=tcp_ports,
+        tcp_lb_ip=current_app.config["TCP_LB_IP"],
+    )
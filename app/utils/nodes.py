@@ -0,0 +1,91 @@
+import random
+import threading
+import time
+import nomad
+from flask import current_app
+
+from app.utils.errors import TunnelError
+
+from typing import Dict
+
+
+class NodeAddressIndex:
+    """NodeID -> Address lookups for the Nomad clients tunnels land on, shared
+    by every request in the process.
+
+    The index is refreshed when it is older than NODE_INDEX_TTL or when asked
+    about a node it has not seen yet.  With NODE_INDEX_WATCH on, a background
+    thread also follows `/v1/nodes` with blocking queries so changes show up
+    without anybody having to wait on a refresh."""
+
+    def __init__(self, nomad=None):
+        # The clients of the cluster to watch, the app wide ones if not given
+        self.nomad = nomad
+        self.lock = threading.Lock()
+        self.addresses: Dict[str, str] = {}
+        self.index = 0
+        self.refreshed_at = 0.0
+        self.refreshes = 0
+        self.watcher = None
+
+    def address(self, node_id: str, nomad_client) -> str:
+        if current_app.config["NODE_INDEX_WATCH"]:
+            self.watch()
+
+        if time.monotonic() - self.refreshed_at > current_app.config["NODE_INDEX_TTL"]:
+            self.refresh(nomad_client)
+
+        address = self.addresses.get(node_id)
+        if address is None:
+            # A node that joined since we last looked
+            self.refresh(nomad_client)
+            address = self.addresses.get(node_id)
+
+        if address is None:
+            raise TunnelError(detail="The tunnel was placed on an unknown node.")
+
+        return address
+
+    def refresh(self, nomad_client, block: bool = False) -> None:
+        params = {}
+        if block:
+            # Leave room for the jitter Nomad adds to blocking queries
+            wait = int(nomad_client.nodes.timeout * 15 / 17 * 1000)
+            params = {"index": self.index, "wait": f"{wait}ms"}
+
+        response = nomad_client.nodes.request(method="get", params=params)
+        index = int(response.headers.get("X-Nomad-Index", 0))
+        addresses = {node["ID"]: node["Address"] for node in response.json()}
+
+        with self.lock:
+            self.addresses = addresses
+            self.index = index if index >= self.index else 0
+            self.refreshed_at = time.monotonic()
+            self.refreshes += 1
+
+    def watch(self) -> None:
+        with self.lock:
+            if self.watcher and self.watcher.is_alive():
+                return
+
+            self.watcher = threading.Thread(
+                target=self._watch,
+                args=(current_app._get_current_object(),),
+                name="node-address-index",
+                daemon=True,
+            )
+            self.watcher.start()
+
+    def _watch(self, app) -> None:
+        from app import nomad_clients
+
+        clients = self.nomad or nomad_clients
+        failures = 0
+        with app.app_context():
+            while True:
+                try:
+                    self.refresh(clients.client(), block=True)
+                    failures = 0
+                except nomad.api.exceptions.BaseNomadException:
+                    failures += 1
+                    time.sleep(random.uniform(0, min(30, 2 ** failures)))
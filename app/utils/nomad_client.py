@@ -0,0 +1,377 @@
+import math
+import random
+import threading
+import time
+import dns.exception
+import nomad
+import nomad.api.base
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import parse_qs, urlsplit
+from flask import current_app
+
+from app.utils.dns import discover_service
+from app.utils.errors import NomadUnavailable
+
+from typing import Callable, Dict, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Weight of the newest request in the moving average of Nomad's latency, and
+# seconds without requests after which the average says nothing anymore
+LATENCY_WEIGHT = 0.2
+LATENCY_WINDOW = 30
+
+
+class Endpoint:
+    def __init__(self, ip: str, weight: int = 100):
+        self.ip = ip
+        self.weight = weight
+        self.requests = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+
+class CircuitBreaker:
+    """Stops calling Nomad after NOMAD_BREAKER_FAILURES failed requests in a
+    row and fails fast with NomadUnavailable instead, so a degraded Nomad
+    doesn't tie up every web worker until it times out.
+
+    After NOMAD_BREAKER_RESET seconds a single request is let through to
+    probe Nomad, the circuit closes again as soon as one succeeds."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+
+    def check(self) -> None:
+        """Raise NomadUnavailable if a request would be turned away right now"""
+        with self.lock:
+            now = time.monotonic()
+            if self.state == self.OPEN and not self._probe_due(now):
+                self.rejected += 1
+                raise NomadUnavailable(retry_after=self._retry_after(now))
+
+    def acquire(self) -> None:
+        """Let a request through or raise NomadUnavailable"""
+        with self.lock:
+            now = time.monotonic()
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and self._probe_due(now):
+                self.state = self.HALF_OPEN
+                return
+            self.rejected += 1
+            raise NomadUnavailable(retry_after=self._retry_after(now))
+
+    def success(self) -> None:
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.state == self.OPEN:
+                return
+            if (
+                self.state == self.HALF_OPEN
+                or self.failures >= current_app.config["NOMAD_BREAKER_FAILURES"]
+            ):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.trips += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = {
+                "state": self.state,
+                "failures": self.failures,
+                "trips": self.trips,
+                "rejected": self.rejected,
+            }
+            if self.state != self.CLOSED:
+                stats["retry_after"] = self._retry_after(time.monotonic())
+            return stats
+
+    def _probe_due(self, now: float) -> bool:
+        return now >= self.opened_at + current_app.config["NOMAD_BREAKER_RESET"]
+
+    def _retry_after(self, now: float) -> int:
+        reopens_at = self.opened_at + current_app.config["NOMAD_BREAKER_RESET"]
+        return max(math.ceil(reopens_at - now), 1)
+
+
+class RetryBudget:
+    """Keeps retries to NOMAD_RETRY_PERCENT of the calls made to Nomad.
+
+    Every call earns a fraction of a retry and every retry spends a whole
+    one, so retrying can't multiply the load on a Nomad that is already
+    struggling.  A few retries are kept in reserve for quiet processes."""
+
+    def __init__(self, reserve: float = 10.0):
+        self.lock = threading.Lock()
+        self.reserve = reserve
+        self.balance = reserve
+        self.retries = 0
+        self.exhausted = 0
+
+    def deposit(self) -> None:
+        with self.lock:
+            earned = current_app.config["NOMAD_RETRY_PERCENT"] / 100
+            self.balance = min(self.balance + earned, self.reserve)
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.balance < 1:
+                self.exhausted += 1
+                return False
+            self.balance -= 1
+            self.retries += 1
+            return True
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "balance": round(self.balance, 2),
+                "retries": self.retries,
+                "exhausted": self.exhausted,
+            }
+
+
+class EndpointAdapter(HTTPAdapter):
+    """Keeps the connection pool for one Nomad server and ejects the server
+    when it stops answering"""
+
+    def __init__(self, endpoint: Endpoint, manager: "NomadClientManager", **kwargs):
+        self.endpoint = endpoint
+        self.manager = manager
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        breaker = self.manager.breaker
+        breaker.acquire()
+
+        self.endpoint.requests += 1
+        try:
+            response = super().send(request, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            self.endpoint.failures += 1
+            self.manager.eject(self.endpoint)
+            breaker.failure()
+            raise
+        except Exception:
+            breaker.failure()
+            raise
+
+        if response.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+
+        # Blocking queries take as long as they are told to wait
+        if "index" not in parse_qs(urlsplit(request.url).query):
+            self.manager.observe(response.elapsed.total_seconds())
+        return response
+
+    def pool_stats(self) -> dict:
+        pools = [self.poolmanager.pools[key] for key in self.poolmanager.pools.keys()]
+        return {
+            "connections": sum(pool.num_connections for pool in pools),
+            "idle": sum(pool.pool.qsize() for pool in pools if pool.pool),
+        }
+
+
+class NomadClientManager:
+    """Process wide Nomad clients sharing one keep-alive connection pool per
+    Nomad server.
+
+    Servers are looked up in Consul DNS once every NOMAD_ENDPOINT_TTL seconds
+    instead of on every request.  A server that fails a request is ejected
+    for NOMAD_EJECT_SECONDS so a Nomad going down doesn't take the web api
+    with it.  Requests also go through a CircuitBreaker shared by every
+    server, and `retry` retries failed calls within a RetryBudget.
+
+    Every Nomad cluster gets a manager of its own, reaching its servers
+    through `service` on `port`, see app.utils.clusters"""
+
+    def __init__(self, service: str = "nomad", port: Optional[int] = None):
+        self.service = service
+        self.port = port
+        self.lock = threading.RLock()
+        self.breaker = CircuitBreaker()
+        self.budget = RetryBudget()
+        self.endpoints: Dict[str, Endpoint] = {}
+        self.clients: Dict[str, nomad.Nomad] = {}
+        self.adapters: Dict[str, EndpointAdapter] = {}
+        self.session = requests.Session()
+        self.resolved_at = 0.0
+        self.resolutions = 0
+        self.latency_ms = 0.0
+        self.observed_at = 0.0
+
+    def client(self) -> nomad.Nomad:
+        with self.lock:
+            endpoint = self._pick()
+            if endpoint.ip not in self.clients:
+                self.clients[endpoint.ip] = self._build_client(endpoint)
+            return self.clients[endpoint.ip]
+
+    def retry(self, call: Callable[[nomad.Nomad], T]) -> T:
+        """Make a Nomad call, retrying server errors with jittered backoff on a
+        fresh pick of server for as long as the retry budget allows.
+
+        Only use it for calls that are safe to repeat, eg. registering a job
+        under a fixed id"""
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                return call(self.client())
+            except nomad.api.exceptions.BaseNomadException as e:
+                attempt += 1
+                if (
+                    not self._retryable(e)
+                    or attempt > current_app.config["NOMAD_RETRIES"]
+                    or not self.budget.withdraw()
+                ):
+                    raise
+
+            backoff = current_app.config["NOMAD_RETRY_BACKOFF_MS"] / 1000
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+    @staticmethod
+    def _retryable(error: nomad.api.exceptions.BaseNomadException) -> bool:
+        # No response means the request never made it, 4xx won't get better
+        response = error.nomad_resp
+        return not isinstance(response, requests.Response) or (
+            response.status_code >= 500
+        )
+
+    def observe(self, seconds: float) -> None:
+        with self.lock:
+            self.latency_ms += LATENCY_WEIGHT * (seconds * 1000 - self.latency_ms)
+            self.observed_at = time.monotonic()
+
+    def latency(self) -> float:
+        """Moving average of how long Nomad has recently taken to answer, in
+        milliseconds.  Nothing is known once it hasn't been asked anything
+        for a while, say, because new tunnels were turned away"""
+        with self.lock:
+            if time.monotonic() - self.observed_at > LATENCY_WINDOW:
+                return 0.0
+            return self.latency_ms
+
+    def eject(self, endpoint: Endpoint) -> None:
+        with self.lock:
+            endpoint.ejected_until = (
+                time.monotonic() + current_app.config["NOMAD_EJECT_SECONDS"]
+            )
+            # Something changed, look for other servers on the next request
+            self.resolved_at = 0.0
+
+    def stats(self) -> dict:
+        with self.lock:
+            now = time.monotonic()
+            return {
+                "breaker": self.breaker.stats(),
+                "retry_budget": self.budget.stats(),
+                "latency_ms": round(self.latency(), 1),
+                "resolutions": self.resolutions,
+                "endpoints": [
+                    dict(
+                        ip=endpoint.ip,
+                        requests=endpoint.requests,
+                        failures=endpoint.failures,
+                        ejected=not endpoint.available(now),
+                        **self._pool_stats(endpoint),
+                    )
+                    for endpoint in self.endpoints.values()
+                ],
+            }
+
+    def _pool_stats(self, endpoint: Endpoint) -> dict:
+        adapter = self.adapters.get(endpoint.ip)
+        if adapter is None:
+            return {"connections": 0, "idle": 0}
+        return adapter.pool_stats()
+
+    def _pick(self) -> Endpoint:
+        now = time.monotonic()
+        if now - self.resolved_at > current_app.config["NOMAD_ENDPOINT_TTL"]:
+            self._refresh(now)
+
+        available = [e for e in self.endpoints.values() if e.available(now)]
+        if not available:
+            # Everything is ejected, best to try somebody rather than nobody
+            available = list(self.endpoints.values())
+
+        return random.choices(available, [e.weight for e in available], k=1)[0]
+
+    def _refresh(self, now: float) -> None:
+        self.resolutions += 1
+        self.resolved_at = now
+        try:
+            resolved = self._resolve()
+        except dns.exception.DNSException:
+            # Carry on with the servers we already know about if there are any
+            if self.endpoints:
+                return
+            raise
+
+        for ip, weight in resolved:
+            if ip not in self.endpoints:
+                self.endpoints[ip] = Endpoint(ip, weight)
+            self.endpoints[ip].weight = weight
+
+        # Keep servers that dropped out of DNS around only while they are busy
+        # being ejected so their stats stay visible
+        known = {ip for ip, _ in resolved}
+        for ip in list(self.endpoints):
+            if ip not in known and self.endpoints[ip].available(now):
+                self._forget(ip)
+
+    def _resolve(self) -> List[tuple]:
+        service = discover_service(self.service)
+        return list(zip([entry.ip for entry in service.entries()], service.weights))
+
+    def _forget(self, ip: str) -> None:
+        self.endpoints.pop(ip, None)
+        self.clients.pop(ip, None)
+        adapter: Optional[EndpointAdapter] = self.adapters.pop(ip, None)
+        if adapter:
+            adapter.close()
+
+    def _build_client(self, endpoint: Endpoint) -> nomad.Nomad:
+        port = self.port or current_app.config["NOMAD_PORT"]
+        adapter = EndpointAdapter(
+            endpoint,
+            self,
+            pool_connections=1,
+            pool_maxsize=current_app.config["NOMAD_POOL_SIZE"],
+        )
+        self.adapters[endpoint.ip] = adapter
+        self.session.mount(f"http://{endpoint.ip}:{port}/", adapter)
+
+        client = nomad.Nomad(
+            host=endpoint.ip, port=port, timeout=current_app.config["NOMAD_TIMEOUT"]
+        )
+
+        # python-nomad gives every endpoint its own session, point them all at
+        # the shared one so they reuse the same connections
+        for requester in vars(client).values():
+            if isinstance(requester, nomad.api.base.Requester):
+                requester.session = self.session
+
+        return client
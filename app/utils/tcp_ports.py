@@ -0,0 +1,360 @@
+from flask import current_app
+
+from app.utils.errors import TunnelError
+
+from typing import Dict, Iterable, List
+
+# The pool is a bitmap where the bit at a port's offset is set while the port
+# is free, with a counter of the set bits next to it.  Every script first hands
+# expired leases back, so a tunnel that died while being provisioned can't keep
+# its ports forever
+PRELUDE = """
+redis.replicate_commands()
+local range = redis.call('HMGET', KEYS[4], 'start', 'stop', 'cursor')
+local first = tonumber(range[1]) or 0
+local stop = tonumber(range[2]) or 0
+local now = tonumber(redis.call('TIME')[1])
+
+local function give_back(port)
+  redis.call('HDEL', KEYS[2], port)
+  redis.call('ZREM', KEYS[3], port)
+  port = tonumber(port)
+  if port >= first and port < stop
+      and redis.call('SETBIT', KEYS[1], port, 1) == 0 then
+    redis.call('INCR', KEYS[5])
+    return 1
+  end
+  return 0
+end
+
+for _, port in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)) do
+  give_back(port)
+end
+"""
+
+# ARGV: owner, lease seconds, number of ports.  Ports are handed out next-fit
+# from a cursor so a released port isn't reused straight away, and a tunnel
+# with several tcp ports gets them in one contiguous block when there is one
+LEASE = (
+    PRELUDE
+    + """
+local count = tonumber(ARGV[3])
+if tonumber(redis.call('GET', KEYS[5]) or 0) < count then
+  return false
+end
+
+local cursor = tonumber(range[3]) or first
+if cursor < first or cursor >= stop then
+  cursor = first
+end
+
+-- The first free port in [from, to), BITPOS only takes byte offsets
+local function next_free(from, to)
+  while from < to and from % 8 ~= 0 do
+    if redis.call('GETBIT', KEYS[1], from) == 1 then
+      return from
+    end
+    from = from + 1
+  end
+  if from >= to then
+    return -1
+  end
+  local port = redis.call('BITPOS', KEYS[1], 1, math.floor(from / 8))
+  if port >= to then
+    return -1
+  end
+  return port
+end
+
+local function find_block(from, to)
+  local start = next_free(from, to)
+  while start ~= -1 and start + count <= to do
+    local taken = -1
+    for port = start + 1, start + count - 1 do
+      if redis.call('GETBIT', KEYS[1], port) == 0 then
+        taken = port
+        break
+      end
+    end
+    if taken == -1 then
+      return start
+    end
+    start = next_free(taken + 1, to)
+  end
+  return -1
+end
+
+local ports = {}
+local start = find_block(cursor, stop)
+if start == -1 then
+  start = find_block(first, math.min(cursor + count - 1, stop))
+end
+
+if start ~= -1 then
+  for port = start, start + count - 1 do
+    ports[#ports + 1] = port
+  end
+else
+  local from, to, wrapped = cursor, stop, false
+  while #ports < count do
+    local port = next_free(from, to)
+    if port ~= -1 then
+      ports[#ports + 1] = port
+      from = port + 1
+    elseif wrapped then
+      return false
+    else
+      from, to, wrapped = first, cursor, true
+    end
+  end
+end
+
+for _, port in ipairs(ports) do
+  redis.call('SETBIT', KEYS[1], port, 0)
+  redis.call('HSET', KEYS[2], port, ARGV[1])
+  redis.call('ZADD', KEYS[3], now + tonumber(ARGV[2]), port)
+end
+redis.call('DECRBY', KEYS[5], count)
+redis.call('HSET', KEYS[4], 'cursor', ports[#ports] + 1)
+return ports
+"""
+)
+
+# ARGV: owner, ports...
+CONFIRM = """
+local confirmed = 0
+for i = 2, #ARGV do
+  if redis.call('HGET', KEYS[2], ARGV[i]) == ARGV[1] then
+    confirmed = confirmed + redis.call('ZREM', KEYS[3], ARGV[i])
+  end
+end
+return confirmed
+"""
+
+# ARGV: owner, ports...  Ports handed out before leases existed have no
+# owner and are taken back from anybody
+RELEASE = (
+    PRELUDE
+    + """
+local released = 0
+for i = 2, #ARGV do
+  local owner = redis.call('HGET', KEYS[2], ARGV[i])
+  if owner == false or owner == ARGV[1] then
+    released = released + give_back(ARGV[i])
+  end
+end
+return released
+"""
+)
+
+# ARGV: start, stop.  Only the ports entering or leaving the range are
+# touched, leased ports stay with their owner and come back on release if
+# they are still in range by then.  A pool still kept as a set of free ports
+# is converted on the way
+RESIZE = (
+    PRELUDE
+    + """
+local new_first, new_stop = tonumber(ARGV[1]), tonumber(ARGV[2])
+
+local function set_free(port)
+  if redis.call('HEXISTS', KEYS[2], port) == 0
+      and redis.call('SETBIT', KEYS[1], port, 1) == 0 then
+    redis.call('INCR', KEYS[5])
+  end
+end
+
+if stop == 0 and redis.call('EXISTS', KEYS[6]) == 1 then
+  for _, port in ipairs(redis.call('SMEMBERS', KEYS[6])) do
+    port = tonumber(port)
+    if port >= new_first and port < new_stop then
+      set_free(port)
+    end
+  end
+  redis.call('DEL', KEYS[6])
+  first, stop = new_first, new_stop
+end
+
+local function clear(from, to)
+  for port = from, to - 1 do
+    if redis.call('SETBIT', KEYS[1], port, 0) == 1 then
+      redis.call('DECR', KEYS[5])
+    end
+  end
+end
+
+clear(first, math.min(stop, new_first))
+clear(math.max(first, new_stop), stop)
+
+for port = new_first, math.min(new_stop, first) - 1 do
+  set_free(port)
+end
+for port = math.max(new_first, stop), new_stop - 1 do
+  set_free(port)
+end
+
+redis.call('HMSET', KEYS[4], 'start', new_first, 'stop', new_stop)
+return tonumber(redis.call('GET', KEYS[5]) or 0)
+"""
+)
+
+# ARGV: port, owner the database has for it or '' pairs.  Leases nobody in
+# the database holds are only taken back when a second run still finds them
+# with the same owner, a tunnel may have been committed since the database
+# was read.  Returns the fixes as free ports that were allocated, leases
+# with the wrong owner, leaked leases, taken ports without a lease and
+# leases left for the next run
+RECONCILE = (
+    PRELUDE
+    + """
+local allocated, owners, leaked, lost, suspect = 0, 0, 0, 0, 0
+for i = 1, #ARGV, 2 do
+  local port, owner = tonumber(ARGV[i]), ARGV[i + 1]
+  local holder = redis.call('HGET', KEYS[2], port)
+  local in_range = port >= first and port < stop
+  local free = in_range and redis.call('GETBIT', KEYS[1], port) == 1
+
+  if owner ~= '' then
+    redis.call('HDEL', KEYS[7], port)
+    if free then
+      redis.call('SETBIT', KEYS[1], port, 0)
+      redis.call('DECR', KEYS[5])
+      allocated = allocated + 1
+    end
+    if holder ~= owner then
+      redis.call('HSET', KEYS[2], port, owner)
+      owners = owners + 1
+    end
+    redis.call('ZREM', KEYS[3], port)
+  elseif holder then
+    if redis.call('ZSCORE', KEYS[3], port) then
+      redis.call('HDEL', KEYS[7], port)
+    elseif redis.call('HGET', KEYS[7], port) == holder then
+      redis.call('HDEL', KEYS[7], port)
+      give_back(port)
+      leaked = leaked + 1
+    else
+      redis.call('HSET', KEYS[7], port, holder)
+      suspect = suspect + 1
+    end
+  else
+    redis.call('HDEL', KEYS[7], port)
+    if in_range and not free then
+      redis.call('SETBIT', KEYS[1], port, 1)
+      redis.call('INCR', KEYS[5])
+      lost = lost + 1
+    end
+  end
+end
+return {allocated, owners, leaked, lost, suspect}
+"""
+)
+
+# Sets the free counter to the bits actually set, returns how far it was off
+RECOUNT = """
+local counted = tonumber(redis.call('GET', KEYS[5]) or 0)
+local actual = redis.call('BITCOUNT', KEYS[1])
+redis.call('SET', KEYS[5], actual)
+return counted - actual
+"""
+
+RECONCILED = ["allocated", "owners", "leaked", "lost", "suspect"]
+
+
+class TcpPortPool:
+    """The public tcp ports tunnels forward, kept as a bitmap over the ports
+    in range with a count of the free ones.
+
+    Each change is a single Lua script, so all the ports a tunnel needs are
+    taken in one round trip or not at all.  Taken ports are leased to their
+    owner, the subdomain of the tunnel, and go back to the pool on their own
+    unless the lease is confirmed within TCP_PORT_LEASE_SECONDS."""
+
+    def __init__(self, redis_client, key: str = "open_tcp_ports"):
+        self.redis_client = redis_client
+        self.key = key
+        self.bitmap_key = f"{key}:bitmap"
+        self.owners_key = f"{key}:owners"
+        self.expiry_key = f"{key}:expiry"
+        self.range_key = f"{key}:range"
+        self.free_key = f"{key}:free"
+        self.suspects_key = f"{key}:suspects"
+        self.scripts: Dict[str, object] = {}
+
+    @property
+    def keys(self) -> List[str]:
+        # KEYS[6] is the set the pool used to be kept in
+        return [
+            self.bitmap_key,
+            self.owners_key,
+            self.expiry_key,
+            self.range_key,
+            self.free_key,
+            self.key,
+            self.suspects_key,
+        ]
+
+    def lease(self, owner: str, count: int) -> List[int]:
+        if count <= 0:
+            return []
+
+        ports = self._run(
+            LEASE, owner, current_app.config["TCP_PORT_LEASE_SECONDS"], count
+        )
+        if ports is None:
+            raise TunnelError(detail="No tcp ports available")
+        return [int(port) for port in ports]
+
+    def confirm(self, owner: str, ports: Iterable[int]) -> int:
+        """Keep leased ports until they are released"""
+        ports = [port for port in ports if port]
+        if not ports:
+            return 0
+        return self._run(CONFIRM, owner, *ports)
+
+    def release(self, owner: str, ports: Iterable[int]) -> int:
+        ports = [port for port in ports if port]
+        if not ports:
+            return 0
+        return self._run(RELEASE, owner, *ports)
+
+    def resize(self, start: int, stop: int) -> int:
+        """Serve the ports in [start, stop), returns how many are free"""
+        if not 0 < start < stop:
+            raise ValueError(f"Invalid tcp port range {start}-{stop}")
+        return self._run(RESIZE, start, stop)
+
+    def reconcile(self, allocated: Dict[int, str]) -> Dict[str, int]:
+        """Make the pool agree with the owners the database has for a batch
+        of ports, an empty owner meaning no tunnel has the port"""
+        args: List[object] = []
+        for port, owner in allocated.items():
+            args += [port, owner]
+        if not args:
+            return dict.fromkeys(RECONCILED, 0)
+        return dict(zip(RECONCILED, self._run(RECONCILE, *args)))
+
+    def recount(self) -> int:
+        return self._run(RECOUNT)
+
+    def held(self) -> List[int]:
+        """Every port currently leased"""
+        return [int(port) for port in self.redis_client.hkeys(self.owners_key)]
+
+    def stats(self) -> dict:
+        pipe = self.redis_client.pipeline()
+        pipe.get(self.free_key)
+        pipe.hlen(self.owners_key)
+        pipe.zcard(self.expiry_key)
+        pipe.hmget(self.range_key, "start", "stop")
+        free, leased, expiring, (start, stop) = pipe.execute()
+        return {
+            "open": int(free or 0),
+            "leased": leased,
+            "unconfirmed": expiring,
+            "range": [int(start or 0), int(stop or 0)],
+        }
+
+    def _run(self, source: str, *args):
+        if source not in self.scripts:
+            self.scripts[source] = self.redis_client.register_script(source)
+        return self.scripts[source](keys=self.keys, args=list(args))
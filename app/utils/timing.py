@@ -0,0 +1,89 @@
+import math
+import time
+from contextlib import ExitStack, contextmanager
+from flask import current_app
+from redis import RedisError
+
+from app import redis_client
+
+from typing import Dict, List, Tuple
+
+PERCENTILES = [50, 95, 99]
+
+
+class PhaseTimer:
+    """Times the named phases of a single piece of work, eg. creating one
+    tunnel.
+
+    Timings go to the log and, on flush, to a capped list per phase in Redis
+    so every web and worker process feeds the same histogram.  With
+    PHASE_TRACING on each phase also gets its own ddtrace span."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.timings: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, phase: str):
+        with ExitStack() as stack:
+            if current_app.config["PHASE_TRACING"]:
+                from ddtrace import tracer
+
+                stack.enter_context(tracer.trace(f"{self.name}.{phase}"))
+
+            started = time.monotonic()
+            try:
+                yield
+            finally:
+                self.record(phase, time.monotonic() - started)
+
+    def record(self, phase: str, seconds: float) -> None:
+        self.timings.append((phase, seconds))
+
+    def flush(self) -> None:
+        if not self.timings:
+            return
+
+        timings, self.timings = self.timings, []
+        current_app.logger.info(
+            f"{self.name} timings "
+            + " ".join(f"{phase}={seconds * 1000:.1f}ms" for phase, seconds in timings)
+        )
+
+        samples = current_app.config["PHASE_SAMPLES"]
+        try:
+            pipe = redis_client.pipeline()
+            for phase, seconds in timings:
+                key = f"phase_timings:{self.name}:{phase}"
+                pipe.sadd(f"phase_timings:{self.name}", phase)
+                pipe.lpush(key, round(seconds * 1000, 3))
+                pipe.ltrim(key, 0, samples - 1)
+            pipe.execute()
+        except RedisError:
+            # Losing a few samples is better than failing the tunnel over it
+            current_app.logger.warning(f"Could not record {self.name} timings")
+
+
+def percentile(samples: List[float], pct: int) -> float:
+    """Nearest rank percentile of already sorted samples"""
+    rank = max(math.ceil(pct / 100 * len(samples)), 1)
+    return samples[rank - 1]
+
+
+def phase_summary(name: str) -> Dict[str, dict]:
+    """p50, p95 and p99 in milliseconds of the recent timings of each phase"""
+    summary = {}
+    for phase in sorted(
+        p.decode() for p in redis_client.smembers(f"phase_timings:{name}")
+    ):
+        samples = sorted(
+            float(s)
+            for s in redis_client.lrange(f"phase_timings:{name}:{phase}", 0, -1)
+        )
+        if not samples:
+            continue
+        summary[phase] = dict(
+            count=len(samples),
+            **{f"p{pct}": percentile(samples, pct) for pct in PERCENTILES},
+        )
+    return summary
@@ -0,0 +1,29 @@
+"""add status to tunnel
+
+Revision ID: 4c2f9a1d7e63
+Revises: 25853ecf738c
+Create Date: 2019-08-12 14:02:18.331207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "4c2f9a1d7e63"
+down_revision = "25853ecf738c"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "tunnel",
+        sa.Column(
+            "status", sa.String(length=16), nullable=False, server_default="running"
+        ),
+    )
+
+
+def downgrade():
+    op.drop_column("tunnel", "status")
@@ -0,0 +1,24 @@
+"""add tunnel slot
+
+Revision ID: 5d8c1f3b6a20
+Revises: 9a4d6e2f8b17
+Create Date: 2019-08-29 14:22:51.730194
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5d8c1f3b6a20"
+down_revision = "9a4d6e2f8b17"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("tunnel", sa.Column("slot", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("tunnel", "slot")
@@ -0,0 +1,23 @@
+"""index tunnel job_id
+
+Revision ID: 7b3e5d2a9c41
+Revises: 4c2f9a1d7e63
+Create Date: 2019-08-19 10:41:07.582114
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "7b3e5d2a9c41"
+down_revision = "4c2f9a1d7e63"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f("ix_tunnel_job_id"), "tunnel", ["job_id"], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_tunnel_job_id"), table_name="tunnel")
@@ -0,0 +1,43 @@
+"""add user usage
+
+Revision ID: 9a4d6e2f8b17
+Revises: 7b3e5d2a9c41
+Create Date: 2019-08-26 09:17:43.206518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9a4d6e2f8b17"
+down_revision = "7b3e5d2a9c41"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "user_usage",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("tunnels", sa.Integer(), nullable=False),
+        sa.Column("reserved_subdomains", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["user.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+    op.execute(
+        """
+        INSERT INTO user_usage (user_id, tunnels, reserved_subdomains)
+        SELECT "user".id,
+               (SELECT count(*) FROM tunnel
+                JOIN subdomain ON subdomain.id = tunnel.subdomain_id
+                WHERE subdomain.user_id = "user".id),
+               (SELECT count(*) FROM subdomain
+                WHERE subdomain.user_id = "user".id AND subdomain.reserved)
+        FROM "user"
+        """
+    )
+
+
+def downgrade():
+    op.drop_table("user_usage")
@@ -0,0 +1,24 @@
+"""add tunnel cluster
+
+Revision ID: b2e7c4f19d35
+Revises: 5d8c1f3b6a20
+Create Date: 2019-09-04 10:41:17.286513
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b2e7c4f19d35"
+down_revision = "5d8c1f3b6a20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("tunnel", sa.Column("cluster", sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    op.drop_column("tunnel", "cluster")
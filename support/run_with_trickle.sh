@@ -0,0 +1,51 @@
+#!/bin/sh
+# Entrypoint of the sshd image.
+#
+# Tunnels of their own get the key and bandwidth in SSH_KEY and BANDWIDTH.
+# Warm pool and multiplexed containers are started before either is known,
+# they get SSH_KEY_FILE and BANDWIDTH_FILE instead, which Nomad renders from
+# Consul and follows up with a SIGHUP whenever they change.
+
+KEYS=/home/punch/.ssh/authorized_keys
+
+if [ -z "$SSH_KEY_FILE" ]; then
+  echo $SSH_KEY > $KEYS
+  exec trickle -s -u $BANDWIDTH -d $BANDWIDTH /usr/sbin/sshd -D
+fi
+
+load() {
+  cat "$SSH_KEY_FILE" > $KEYS 2>/dev/null || : > $KEYS
+  BANDWIDTH=$(cat "$BANDWIDTH_FILE" 2>/dev/null)
+}
+
+start() {
+  # Nobody can log in to an unclaimed container, so it isn't throttled yet
+  if [ -n "$BANDWIDTH" ]; then
+    trickle -s -u $BANDWIDTH -d $BANDWIDTH /usr/sbin/sshd -D &
+  else
+    /usr/sbin/sshd -D &
+  fi
+  SSHD=$!
+}
+
+reload() {
+  previous=$BANDWIDTH
+  load
+  # sshd reads the keys on every login, only trickle has to start over.
+  # Open sessions are children of their own and stay up meanwhile
+  if [ "$BANDWIDTH" != "$previous" ]; then
+    kill $SSHD
+    wait $SSHD
+    start
+  fi
+}
+
+trap reload HUP
+trap 'kill $SSHD; exit 0' TERM INT
+
+load
+start
+# A trapped signal ends the wait early, keep waiting until sshd itself exits
+while kill -0 $SSHD 2>/dev/null; do
+  wait $SSHD
+done
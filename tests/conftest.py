@@ -1,15 +1,19 @@
 import pytest
 from dotenv import load_dotenv
-from app import create_app, stripe
+from app import create_app, nomad_clients, stripe
 from app.commands import populate_redis
 from app import db as _db
 from sqlalchemy import event
+from app.utils.nomad_client import CircuitBreaker
 from tests.support.client import TestClient
+from tests.support.fake_nomad import FakeNomad
 from tests.factories import user, plan as plan_factory
 from functools import wraps
 import time
 from stripe.webhook import WebhookSignature
 import json
+import nomad
+from unittest.mock import patch
 
 collect_ignore = ["client.py"]
 
@@ -172,3 +176,25 @@ def current_admin_user(session):
     session.add(u)
     session.flush()
     return u
+
+
+@pytest.fixture
+def fake_nomad():
+    fake = FakeNomad().start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def fake_nomad_client(fake_nomad):
+    return nomad.Nomad(host="127.0.0.1", port=fake_nomad.port)
+
+
+@pytest.fixture
+def nomad_cluster(fake_nomad, fake_nomad_client):
+    """Sends everything for the default cluster to the fake Nomad, behind a
+    breaker of its own so failures from earlier tests don't leave it open"""
+    with patch.object(nomad_clients, "breaker", CircuitBreaker()), patch.object(
+        nomad_clients, "client", return_value=fake_nomad_client
+    ):
+        yield fake_nomad
@@ -1,32 +1,108 @@
 import pytest
-from app.jobs.nomad_cleanup import find_unused_boxes
+from unittest.mock import patch
+from redis.exceptions import LockError
+from app.jobs.nomad_cleanup import cleanup_old_nomad_box, find_unused_boxes
 from app.services.tunnel import TunnelCreationService
+from app.utils.job_spec import multiplex_job_id
 from tests.factories.subdomain import ReservedSubdomainFactory
-import nomad
-from app.utils.dns import discover_service
+from tests.factories.tunnel import TunnelFactory
+
+
+def failing_checks(service):
+    return (
+        0,
+        [
+            {
+                "Checks": [
+                    {"Name": "Serf Health Status", "Status": "passing"},
+                    {"Name": "http", "ServiceName": service, "Status": "critical"},
+                ]
+            }
+        ],
+    )
 
 
 class TestNomadCleanup(object):
     """Nomad Cleanup job kills correct boxes"""
 
-    @pytest.mark.vcr()
-    def test_find_unused_boxes(self, current_user, session):
+    @patch("app.jobs.nomad_cleanup.discover_service")
+    @patch("app.jobs.nomad_cleanup.consul.Consul")
+    def test_find_unused_boxes(
+        self, mock_consul, mock_discover, current_user, session, nomad_cluster
+    ):
         """ Kills unused boxes """
         asub = ReservedSubdomainFactory(user=current_user, name="bobjoebob")
         session.add(asub)
         session.flush()
 
-        TunnelCreationService(
+        tunnel = TunnelCreationService(
             current_user=current_user,
             subdomain_id=asub.id,
             port_types=["http"],
             ssh_key="",
         ).create()
 
+        consul_client = mock_consul.return_value
+        consul_client.catalog.services.return_value = (0, {"ssh-bobjoebob-http": []})
+        consul_client.health.service.side_effect = failing_checks
+
         find_unused_boxes()
+        assert tunnel.job_id in nomad_cluster.jobs
+
         find_unused_boxes()
+        assert tunnel.job_id not in nomad_cluster.jobs
+
+    @pytest.mark.parametrize(
+        "job_id, cluster, cleaned",
+        [
+            ("ssh-client-sleepybox", None, False),
+            (multiplex_job_id(1), None, True),
+            ("ssh-dispatch-http/dispatch-1-abc", None, True),
+            ("ssh-client-sleepybox", "east", True),
+        ],
+    )
+    @patch("app.jobs.nomad_cleanup.cleanup_old_nomad_box")
+    @patch("app.jobs.nomad_cleanup.discover_service")
+    @patch("app.jobs.nomad_cleanup.consul.Consul")
+    def test_idle_boxes_left_to_hibernation(
+        self,
+        mock_consul,
+        mock_discover,
+        mock_cleanup,
+        job_id,
+        cluster,
+        cleaned,
+        app,
+        current_user,
+        session,
+    ):
+        """ Only tunnels that get hibernated are kept from being cleaned up """
+        tun = TunnelFactory(
+            subdomain=ReservedSubdomainFactory(user=current_user, name="sleepybox"),
+            job_id=job_id,
+            cluster=cluster,
+            status="running",
+        )
+        session.add(tun)
+        session.flush()
+
+        consul_client = mock_consul.return_value
+        consul_client.catalog.services.return_value = (0, {"ssh-sleepybox-http": []})
+        consul_client.health.service.side_effect = failing_checks
+
+        with patch.dict(app.config, {"HIBERNATE_AFTER": 60}):
+            find_unused_boxes()
+            find_unused_boxes()
+
+        assert mock_cleanup.called == cleaned
+
+    @patch("app.jobs.nomad_cleanup.cleanup_old_nomad_box.schedule")
+    @patch("app.jobs.nomad_cleanup.Multiplexer.release", side_effect=LockError)
+    def test_busy_multiplexed_box_is_retried(self, mock_release, mock_schedule):
+        """ A slot that can't be locked right now is released later on """
+        job_id = multiplex_job_id(1)
 
-        nomad_client = nomad.Nomad(discover_service("nomad").ip)
-        deploys = nomad_client.job.get_deployments("ssh-client-bobjoebob")
+        with pytest.raises(LockError):
+            cleanup_old_nomad_box(job_id, "busybox")
 
-        assert len(deploys) == 0
+        assert mock_schedule.call_args[0][1:] == (job_id, "busybox", None)
@@ -1,6 +1,7 @@
 from tests.factories import subdomain
 from app.services.tunnel import TunnelCreationService
-import pytest
+from app.models import Tunnel
+from unittest.mock import patch
 
 
 class TestAdmin(object):
@@ -11,8 +12,10 @@ class TestAdmin(object):
         res = client.post("/admin/tunnel")
         assert res.status_code == 404
 
-    @pytest.mark.vcr()
-    def test_tunnel_index(self, admin_client, current_user, session):
+    @patch("app.services.tunnel.cleanup_old_nomad_box.queue")
+    def test_tunnel_index(
+        self, mock_cleanup, admin_client, current_user, session, nomad_cluster
+    ):
         """User can list all of their tunnels"""
         sub = subdomain.ReservedSubdomainFactory(
             user=current_user, name="testtunnelsubdomain"
@@ -38,3 +41,26 @@ class TestAdmin(object):
             },
         )
         assert res.status_code == 204
+        assert Tunnel.query.filter_by(user=current_user).count() == 0
+        assert mock_cleanup.call_args[0][0] == tun.job_id
+
+    def test_nomad_pool_stats(self, admin_client):
+        """Admins can see the Nomad connection pool"""
+        res = admin_client.get("/admin/nomad")
+        assert res.status_code == 200
+        assert "endpoints" in res.get_json()
+
+    def test_nomad_pool_stats_non_admin(self, client):
+        """Nomad connection pool is hidden from everyone else"""
+        res = client.get("/admin/nomad")
+        assert res.status_code == 404
+
+    def test_tunnel_timings(self, admin_client):
+        """Admins can see how long each phase of tunnel creation takes"""
+        res = admin_client.get("/admin/timings")
+        assert res.status_code == 200
+
+    def test_tunnel_timings_non_admin(self, client):
+        """Tunnel timings are hidden from everyone else"""
+        res = client.get("/admin/timings")
+        assert res.status_code == 404
@@ -0,0 +1,121 @@
+from dpath.util import values
+from unittest import mock
+
+from app.models import Subdomain, Tunnel
+from app.services.tunnel import TunnelCreationService
+from app.utils.errors import TunnelError
+from tests.factories import tunnel
+
+
+def add_tunnel(**relationships):
+    data = {
+        "type": "tunnel",
+        "attributes": {"port": ["http"], "sshKey": "ssh-rsa AAAA\n"},
+    }
+    if relationships:
+        data["relationships"] = {"subdomain": {"data": relationships}}
+    return {"op": "add", "data": data}
+
+
+class TestOperations(object):
+    """Users can change several tunnels and subdomains in one request"""
+
+    @mock.patch.object(
+        TunnelCreationService, "get_tunnel_details", return_value=("2222", "10.0.0.1")
+    )
+    @mock.patch.object(
+        TunnelCreationService, "create_tunnel_nomad", return_value=("job", [0])
+    )
+    def test_add_subdomain_and_tunnels(
+        self, mock_create, mock_details, client, current_user, session
+    ):
+        """A new subdomain can be used by a tunnel in the same request"""
+        res = client.post(
+            "/operations",
+            json={
+                "atomic:operations": [
+                    {
+                        "op": "add",
+                        "data": {
+                            "type": "subdomain",
+                            "lid": "ci",
+                            "attributes": {"name": "ci-runner"},
+                        },
+                    },
+                    add_tunnel(type="subdomain", lid="ci"),
+                    add_tunnel(),
+                ]
+            },
+        )
+
+        assert res.status_code == 200, res.get_json()
+        results = res.get_json()["atomic:results"]
+        assert values(results, "*/data/type") == ["subdomain", "tunnel", "tunnel"]
+        assert mock_create.call_count == 2
+        assert Tunnel.query.filter_by(user=current_user).count() == 2
+        assert Subdomain.query.filter_by(name="ci-runner").one().in_use
+
+    @mock.patch("app.services.operations.cleanup_old_nomad_box.queue")
+    @mock.patch.object(
+        TunnelCreationService,
+        "get_tunnel_details",
+        side_effect=[("2222", "10.0.0.1"), TunnelError(detail="Error")],
+    )
+    @mock.patch.object(
+        TunnelCreationService, "create_tunnel_nomad", return_value=("job", [0])
+    )
+    def test_failed_tunnel_stops_the_others(
+        self, mock_create, mock_details, mock_cleanup, client, current_user, session
+    ):
+        """Nothing is kept when one of the tunnels fails to start"""
+        res = client.post(
+            "/operations", json={"atomic:operations": [add_tunnel(), add_tunnel()]}
+        )
+
+        assert res.status_code == 500
+        assert res.json["data"]["attributes"]["source"].startswith(
+            "/atomic:operations/"
+        )
+        assert mock_cleanup.called
+        assert Tunnel.query.filter_by(user=current_user).count() == 0
+
+    @mock.patch("app.services.tunnel.cleanup_old_nomad_box.queue")
+    def test_remove_tunnel_and_subdomain(
+        self, mock_cleanup, client, current_user, session
+    ):
+        """Tunnels are only stopped once every operation went through"""
+        tun = tunnel.TunnelFactory(subdomain__user=current_user)
+        session.add(tun)
+        session.flush()
+
+        res = client.post(
+            "/operations",
+            json={
+                "atomic:operations": [
+                    {"op": "remove", "ref": {"type": "tunnel", "id": str(tun.id)}},
+                    {"op": "remove", "ref": {"type": "subdomain", "id": "0"}},
+                ]
+            },
+        )
+
+        assert res.status_code == 404
+        assert res.json["data"]["attributes"]["source"] == "/atomic:operations/1"
+        assert not mock_cleanup.called
+
+    def test_tunnel_limit_counts_the_whole_request(self, free_client):
+        """Tunnels asked for in the same request count towards the limit"""
+        res = free_client.post(
+            "/operations", json={"atomic:operations": [add_tunnel(), add_tunnel()]}
+        )
+
+        assert res.status_code == 403
+        assert res.json["data"]["attributes"]["source"] == "/atomic:operations/1"
+
+    def test_invalid_operation(self, client):
+        """Operations have to be adds or removes"""
+        res = client.post(
+            "/operations",
+            json={"atomic:operations": [{"op": "update", "data": {"type": "tunnel"}}]},
+        )
+
+        assert res.status_code == 400
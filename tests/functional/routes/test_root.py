@@ -1,3 +1,10 @@
+import time
+from unittest.mock import patch
+
+from app import nomad_clusters
+from app.utils.nomad_client import CircuitBreaker
+
+
 class TestRoot(object):
     def test_root_accessible(self, unauthenticated_client, app):
         """Root url is accessible with no login"""
@@ -13,3 +20,27 @@ class TestRoot(object):
         """health_check is accessible with no login"""
         res = unauthenticated_client.get("/health_check")
         assert res.get_data() == b"OK"
+
+    def test_health_reports_nomad_breaker(self, unauthenticated_client):
+        """health shows whether tunnels can currently be changed"""
+        res = unauthenticated_client.get("/health")
+        assert res.status_code == 200
+        assert res.get_json()["nomad"]["state"] in ["closed", "open", "half_open"]
+
+    def test_health_reports_every_cluster(
+        self, unauthenticated_client, app, nomad_cluster
+    ):
+        """health is degraded while any cluster's breaker is open"""
+        east = CircuitBreaker()
+        east.state = CircuitBreaker.OPEN
+        east.opened_at = time.monotonic()
+        with patch.dict(app.config, {"NOMAD_CLUSTERS": ["city=nomad", "east=nomad"]}):
+            with patch.object(nomad_clusters, "clusters", {}):
+                with patch.object(nomad_clusters.get("east").nomad, "breaker", east):
+                    res = unauthenticated_client.get("/health")
+
+        assert res.status_code == 200
+        assert res.get_json()["status"] == "degraded"
+        assert res.get_json()["clusters"]["east"]["state"] == "open"
+        assert res.get_json()["clusters"]["city"]["state"] == "closed"
+        assert res.get_json()["nomad"]["state"] == "closed"
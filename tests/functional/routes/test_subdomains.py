@@ -1,4 +1,5 @@
 from app.models import Subdomain
+from app.services.usage import Usage
 from tests.factories import subdomain
 from tests.support.assertions import assert_valid_schema
 from dpath.util import values
@@ -45,6 +46,36 @@ class TestSubdomain(object):
         assert_valid_schema(res.get_data(), "subdomain.json")
         assert post_subdomain_count > pre_subdomain_count
 
+    def test_subdomain_reserve_retried(self, client, current_user):
+        """Retrying with the same Idempotency-Key reserves the subdomain once"""
+        body = {"data": {"type": "subdomain", "attributes": {"name": "retried"}}}
+        headers = {"Idempotency-Key": "reserve-retried"}
+
+        first = client.post("/subdomains", json=body, headers=headers)
+        retry = client.post("/subdomains", json=body, headers=headers)
+
+        assert first.status_code == retry.status_code == 200
+        assert retry.headers["Idempotent-Replayed"] == "true"
+        assert retry.get_json() == first.get_json()
+        assert Subdomain.query.filter_by(user_id=current_user.id).count() == 1
+
+    def test_subdomain_reserve_reused_key(self, client, current_user):
+        """An Idempotency-Key can't be used for a different request"""
+        headers = {"Idempotency-Key": "reserve-reused"}
+
+        client.post(
+            "/subdomains",
+            json={"data": {"type": "subdomain", "attributes": {"name": "first"}}},
+            headers=headers,
+        )
+        res = client.post(
+            "/subdomains",
+            json={"data": {"type": "subdomain", "attributes": {"name": "second"}}},
+            headers=headers,
+        )
+
+        assert res.status_code == 422
+
     def test_subdomain_reserve_owned(self, client, current_user, session):
         """User cant reserve an already reserved subdomain"""
 
@@ -89,6 +120,7 @@ class TestSubdomain(object):
         session.add(sub4)
         session.add(sub5)
         session.flush()
+        Usage(current_user.id).change(reserved_subdomains=5)
         res = client.post(
             "/subdomains",
             json={"data": {"type": "subdomain", "attributes": {"name": "test"}}},
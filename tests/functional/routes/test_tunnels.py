@@ -2,11 +2,12 @@ import pytest
 from dpath.util import values
 from app.models import Tunnel
 from app.services.tunnel import TunnelCreationService, TunnelDeletionService
-from app.utils.errors import TunnelError
+from app.utils.errors import TunnelCreationThrottled, TunnelError
 from tests.factories.user import UserFactory
 from tests.factories import subdomain, tunnel
 from tests.support.assertions import assert_valid_schema
 from unittest import mock
+from werkzeug.datastructures import Headers
 from app import momblish
 
 
@@ -52,9 +53,8 @@ class TestTunnels(object):
         assert res.status_code == 404
 
     @mock.patch.object(momblish, "word", return_value="multipleportssubdomain")
-    @pytest.mark.vcr()
     def test_tunnel_open_without_subdomain(
-        self, mock_get_unused_subdomain, client, current_user, session
+        self, mock_get_unused_subdomain, client, current_user, session, nomad_cluster
     ):
         """User can open a tunnel without providing a subdomain"""
 
@@ -71,11 +71,11 @@ class TestTunnels(object):
         assert res.status_code == 201
         assert_valid_schema(res.get_data(), "tunnel.json")
         assert Tunnel.query.filter_by(user=current_user).count() == 1
+        assert "ssh-client-multipleportssubdomain" in nomad_cluster.jobs
 
     @mock.patch.object(momblish, "word", return_value="multipleportssubdomain")
-    @pytest.mark.vcr()
     def test_tunnel_open_with_multiple_ports(
-        self, mock_get_unused_subdomain, client, current_user, session
+        self, mock_get_unused_subdomain, client, current_user, session, nomad_cluster
     ):
         """User can open a tunnel with multiple ports"""
 
@@ -96,8 +96,9 @@ class TestTunnels(object):
         assert_valid_schema(res.get_data(), "tunnel.json")
         assert Tunnel.query.filter_by(user=current_user).count() == 1
 
-    @pytest.mark.vcr()
-    def test_tunnel_open_with_subdomain(self, client, current_user, session):
+    def test_tunnel_open_with_subdomain(
+        self, client, current_user, session, nomad_cluster
+    ):
         """User can open a tunnel when providing a subdomain they own"""
 
         sub = subdomain.ReservedSubdomainFactory(
@@ -126,6 +127,7 @@ class TestTunnels(object):
         assert len(values(res.get_json(), "data/id")) == 1
         assert_valid_schema(res.get_data(), "tunnel.json")
         assert Tunnel.query.filter_by(user=current_user).count() == 1
+        assert "ssh-client-testtunnelsubdomain" in nomad_cluster.jobs
 
     @pytest.mark.vcr()
     def test_tunnel_open_unowned_subdomain(self, client, current_user, session):
@@ -151,8 +153,10 @@ class TestTunnels(object):
         assert res.status_code == 403
         assert Tunnel.query.filter_by(user=current_user).count() == 0
 
-    @pytest.mark.vcr()
-    def test_tunnel_close_owned(self, client, session, current_user):
+    @mock.patch("app.services.tunnel.cleanup_old_nomad_box.queue")
+    def test_tunnel_close_owned(
+        self, mock_cleanup, client, session, current_user, nomad_cluster
+    ):
         """User can close a tunnel"""
 
         sub = subdomain.ReservedSubdomainFactory(
@@ -168,6 +172,8 @@ class TestTunnels(object):
 
         res = client.delete("/tunnels/" + str(tun.id))
         assert res.status_code == 204
+        assert Tunnel.query.filter_by(user=current_user).count() == 0
+        assert mock_cleanup.call_args[0][0] == tun.job_id
 
     def test_tunnel_close_unowned(self, client):
         """User cant close a tunnel they do not own"""
@@ -177,6 +183,159 @@ class TestTunnels(object):
 
         assert res.status_code == 404
 
+    @mock.patch("app.services.tunnel.provision_tunnel.queue")
+    def test_tunnel_open_async(self, mock_provision, client, current_user, session):
+        """User can ask for a tunnel to be provisioned in the background"""
+
+        res = client.post(
+            "/tunnels",
+            headers=Headers({"Prefer": "respond-async"}),
+            json={
+                "data": {
+                    "type": "tunnel",
+                    "attributes": {"port": ["http"], "sshKey": "ssh-rsa AAAA\n"},
+                }
+            },
+        )
+
+        assert res.status_code == 202
+        assert values(res.get_json(), "data/attributes/status") == ["pending"]
+        assert mock_provision.called
+
+        tunnel_id = values(res.get_json(), "data/relationships/tunnel/data/id")[0]
+        assert res.headers["Location"].endswith(f"/tunnels/{tunnel_id}")
+
+        tun = Tunnel.query.filter_by(user=current_user).one()
+        assert tun.status == "pending"
+        assert tun.subdomain.in_use
+
+    @mock.patch("app.services.tunnel.provision_tunnel.queue")
+    def test_tunnel_open_retried(self, mock_provision, client, current_user, session):
+        """Retrying with the same Idempotency-Key opens the tunnel once"""
+        body = {
+            "data": {
+                "type": "tunnel",
+                "attributes": {"port": ["http"], "sshKey": "ssh-rsa AAAA\n"},
+            }
+        }
+        headers = {"Prefer": "respond-async", "Idempotency-Key": "open-retried"}
+
+        first = client.post("/tunnels", json=body, headers=headers)
+        retry = client.post("/tunnels", json=body, headers=headers)
+
+        assert first.status_code == retry.status_code == 202
+        assert retry.headers["Location"] == first.headers["Location"]
+        assert mock_provision.call_count == 1
+        assert Tunnel.query.filter_by(user=current_user).count() == 1
+
+    @mock.patch.object(TunnelCreationService, "create_tunnel_nomad")
+    @mock.patch.object(TunnelCreationService, "allocation_healthy", return_value=True)
+    @mock.patch.object(TunnelCreationService, "update_ssh_key")
+    def test_tunnel_reattach(
+        self, mock_update, mock_healthy, mock_create, client, current_user, session
+    ):
+        """User reconnecting to a reserved subdomain gets their tunnel back"""
+        tun = tunnel.TunnelFactory(
+            subdomain=subdomain.ReservedSubdomainFactory(
+                user=current_user, name="reattached", in_use=True
+            ),
+            status="running",
+        )
+        session.add(tun)
+        session.flush()
+
+        res = client.post(
+            "/tunnels",
+            json={
+                "data": {
+                    "type": "tunnel",
+                    "attributes": {
+                        "port": ["http"],
+                        "sshKey": "ssh-rsa BBBB\n",
+                        "reattach": True,
+                    },
+                    "relationships": {
+                        "subdomain": {
+                            "data": {"type": "subdomain", "id": str(tun.subdomain_id)}
+                        }
+                    },
+                }
+            },
+        )
+
+        assert res.status_code == 200, res.get_json()
+        assert values(res.get_json(), "data/id") == [str(tun.id)]
+        assert mock_update.called
+        assert not mock_create.called
+
+    @mock.patch("app.services.tunnel.tcp_port_pool")
+    def test_tunnel_update_ports(
+        self, mock_pool, client, current_user, session, nomad_cluster
+    ):
+        """User can add a forward to a running tunnel"""
+        mock_pool.lease.return_value = [5001]
+        tun = tunnel.TunnelFactory(
+            subdomain__user=current_user, status="running", allocated_tcp_ports=[0]
+        )
+        session.add(tun)
+        session.flush()
+        nomad_cluster.register(
+            {"ID": tun.job_id, "TaskGroups": [{"Tasks": [{"Env": {"SSH_KEY": "A"}}]}]}
+        )
+
+        res = client.patch(
+            f"/tunnels/{tun.id}",
+            json={
+                "data": {
+                    "type": "tunnel",
+                    "id": str(tun.id),
+                    "attributes": {"port": ["http", "tcp"]},
+                }
+            },
+        )
+
+        assert res.status_code == 200, res.get_json()
+        assert values(res.get_json(), "data/attributes/port") == [["http", "tcp"]]
+        updated = Tunnel.query.get(tun.id)
+        assert updated.allocated_tcp_ports == [0, 5001]
+        assert updated.ssh_port == 20001
+        task = nomad_cluster.jobs[tun.job_id]["TaskGroups"][0]["Tasks"][0]
+        assert task["Env"]["SSH_KEY"] == "A"
+
+    def test_tunnel_update_pending(self, client, current_user, session):
+        """User cant change the ports of a tunnel still being provisioned"""
+        tun = tunnel.TunnelFactory(subdomain__user=current_user, status="pending")
+        session.add(tun)
+        session.flush()
+
+        res = client.patch(
+            f"/tunnels/{tun.id}",
+            json={"data": {"type": "tunnel", "attributes": {"port": ["https"]}}},
+        )
+
+        assert res.status_code == 422
+
+    def test_tunnel_resume_failed(self, client, current_user, session):
+        """User can only resume a tunnel that was hibernated"""
+        tun = tunnel.TunnelFactory(subdomain__user=current_user, status="failed")
+        session.add(tun)
+        session.flush()
+
+        res = client.post(f"/tunnels/{tun.id}/resume")
+
+        assert res.status_code == 422
+
+    @pytest.mark.parametrize("status", ["pending", "failed"])
+    def test_get_provisioned_tunnel(self, client, current_user, session, status):
+        """User gets the current state of a tunnel being provisioned"""
+        tun = tunnel.TunnelFactory(subdomain__user=current_user, status=status)
+        session.add(tun)
+        session.flush()
+
+        res = client.get(f"/tunnels/{tun.id}")
+        assert_valid_schema(res.get_json(), "tunnel.json")
+        assert values(res.get_json(), "data/attributes/status") == [status]
+
     def test_tunnel_filter_by_subdomain_name(self, client, session, current_user):
         """Can filter a subdomain using JSON-API compliant filters"""
 
@@ -271,3 +430,23 @@ class TestFailedTunnels(object):
         assert not mock_get_tunnel_details.called
         assert not mock_del_tunnel_from_db.called
         assert not mock_del_tunnel_job.called
+
+    @mock.patch(
+        "app.services.tunnel.admit", side_effect=TunnelCreationThrottled(retry_after=3)
+    )
+    @mock.patch.object(TunnelCreationService, "create_tunnel_nomad")
+    def test_tunnel_open_throttled(self, mock_create_tunnel, mock_admit, client):
+        """Tunnels turned away by admission control get a 503 to retry"""
+        res = client.post(
+            "/tunnels",
+            json={
+                "data": {
+                    "type": "tunnel",
+                    "attributes": {"port": ["http"], "sshKey": "i-am-lousy-public-key"},
+                }
+            },
+        )
+
+        assert res.status_code == 503
+        assert res.headers["Retry-After"] == "3"
+        assert not mock_create_tunnel.called
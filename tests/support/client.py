@@ -45,7 +45,9 @@ class TestClient(FlaskClient):
                 }
             )
 
-            headers = kwargs.pop("headers", Headers())
+            # A copy, so plain dicts work too and headers reused across
+            # requests don't pick up a second set of api headers
+            headers = Headers(kwargs.pop("headers", None))
             headers.extend(api_headers)
             kwargs["headers"] = headers
 
@@ -0,0 +1,247 @@
+"""
+A small in-process stand-in for the parts of the Nomad HTTP API holepunch
+talks to.  It honours blocking queries (`?index=&wait=`) so tests can check
+how many round trips a piece of code makes.
+"""
+
+import json
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def without_services(job):
+    return [
+        [dict(task, Services=None) for task in group.get("Tasks", [])]
+        for group in job.get("TaskGroups", [])
+    ]
+
+
+class FakeNomad:
+    def __init__(self, nodes=None):
+        self.index = 1
+        self.jobs = {}
+        self.allocations = {}
+        self.nodes = nodes or [
+            {"ID": str(uuid.uuid4()), "Address": "10.0.0.1", "Status": "ready"}
+        ]
+        self.requests = []
+        # Status an allocation is created with when a job is registered
+        self.initial_status = "running"
+        self.changed = threading.Condition()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def bump(self):
+        with self.changed:
+            self.index += 1
+            self.changed.notify_all()
+            return self.index
+
+    def register(self, job):
+        with self.changed:
+            self.index += 1
+            job = dict(job, Status="running", JobModifyIndex=self.index)
+            job.setdefault("CreateIndex", self.index)
+            previous = self.jobs.get(job["ID"])
+            self.jobs[job["ID"]] = job
+            # Parameterized jobs only run once dispatched, and changing just
+            # the services is applied to the running allocation
+            if not job.get("ParameterizedJob") and not (
+                previous and without_services(previous) == without_services(job)
+            ):
+                self.add_allocation(job["ID"], self.initial_status)
+            self.changed.notify_all()
+            return job
+
+    def dispatch(self, parent_id, meta):
+        parent = self.jobs[parent_id]
+        job_id = f"{parent_id}/dispatch-{self.index}-{uuid.uuid4().hex[:8]}"
+        job = dict(
+            parent,
+            ID=job_id,
+            Name=job_id,
+            ParentID=parent_id,
+            Dispatched=True,
+            Meta=meta,
+            ParameterizedJob=None,
+        )
+        job.pop("CreateIndex", None)
+        return self.register(job)
+
+    def add_allocation(self, job_id, status="pending", node=None):
+        with self.changed:
+            self.index += 1
+            alloc_id = str(uuid.uuid4())
+            self.allocations[alloc_id] = {
+                "ID": alloc_id,
+                "JobID": job_id,
+                "NodeID": (node or self.nodes[0])["ID"],
+                "ClientStatus": status,
+                "DesiredStatus": "run",
+                "CreateIndex": self.index,
+                "ModifyIndex": self.index,
+                "Resources": {
+                    "Networks": [
+                        {
+                            "DynamicPorts": [
+                                {"Label": "ssh", "Value": 20000 + len(self.allocations)}
+                            ]
+                        }
+                    ]
+                },
+            }
+            self.changed.notify_all()
+            return self.allocations[alloc_id]
+
+    def set_status(self, alloc_id, status):
+        with self.changed:
+            self.index += 1
+            self.allocations[alloc_id]["ClientStatus"] = status
+            self.allocations[alloc_id]["ModifyIndex"] = self.index
+            self.changed.notify_all()
+
+    def set_status_later(self, alloc_id, status, delay):
+        timer = threading.Timer(delay, self.set_status, (alloc_id, status))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def deregister(self, job_id):
+        with self.changed:
+            self.index += 1
+            self.jobs.pop(job_id, None)
+            for alloc in self.allocations.values():
+                if alloc["JobID"] == job_id:
+                    alloc["DesiredStatus"] = "stop"
+                    alloc["ClientStatus"] = "complete"
+                    alloc["ModifyIndex"] = self.index
+            self.changed.notify_all()
+
+    def count(self, path):
+        return len([r for r in self.requests if r[1] == path])
+
+    def _block(self, query):
+        index = int(query.get("index", ["0"])[0])
+        wait = query.get("wait", ["0ms"])[0]
+        seconds = int(wait[:-2]) / 1000 if wait.endswith("ms") else int(wait[:-1])
+        with self.changed:
+            self.changed.wait_for(lambda: self.index > index, timeout=seconds)
+            return self.index
+
+    def _routes(self):
+        return [
+            # Dispatched jobs are named <parent>/dispatch-<...>
+            ("GET", r"^/v1/job/(?P<id>.+)/allocations$", self._job_allocations),
+            ("POST", r"^/v1/job/(?P<id>.+)/dispatch$", self._dispatch_job),
+            ("GET", r"^/v1/job/(?P<id>.+)$", self._job),
+            ("DELETE", r"^/v1/job/(?P<id>.+)$", self._deregister),
+            ("POST", r"^/v1/jobs$", self._register),
+            ("POST", r"^/v1/job/(?P<id>.+)$", self._register),
+            ("GET", r"^/v1/allocation/(?P<id>[^/]+)$", self._allocation),
+            ("GET", r"^/v1/allocations$", self._allocations),
+            ("GET", r"^/v1/nodes$", self._nodes),
+        ]
+
+    def _job_allocations(self, query, body, id):
+        index = self._block(query)
+        allocs = [a for a in self.allocations.values() if a["JobID"] == id]
+        return 200, index, [dict(a, Resources=None) for a in allocs]
+
+    def _allocations(self, query, body):
+        index = self._block(query)
+        return 200, index, [dict(a, Resources=None) for a in self.allocations.values()]
+
+    def _allocation(self, query, body, id):
+        if id not in self.allocations:
+            return 404, self.index, None
+        return 200, self.index, self.allocations[id]
+
+    def _job(self, query, body, id):
+        if id not in self.jobs:
+            return 404, self.index, None
+        return 200, self.index, self.jobs[id]
+
+    def _register(self, query, body, id=None):
+        job = self.register(json.loads(body)["Job"])
+        return (
+            200,
+            self.index,
+            {
+                "EvalID": str(uuid.uuid4()),
+                "Index": self.index,
+                "JobModifyIndex": job["JobModifyIndex"],
+            },
+        )
+
+    def _dispatch_job(self, query, body, id):
+        if id not in self.jobs:
+            return 500, self.index, None
+        job = self.dispatch(id, json.loads(body)["Meta"])
+        return (
+            200,
+            self.index,
+            {
+                "DispatchedJobID": job["ID"],
+                "EvalID": str(uuid.uuid4()),
+                "Index": self.index,
+                "JobCreateIndex": job["CreateIndex"],
+            },
+        )
+
+    def _deregister(self, query, body, id):
+        self.deregister(id)
+        return 200, self.index, {"EvalID": str(uuid.uuid4())}
+
+    def _nodes(self, query, body):
+        index = self._block(query)
+        return 200, index, self.nodes
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _dispatch(self):
+                url = urlparse(self.path)
+                fake.requests.append((self.command, url.path))
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+
+                for method, pattern, route in fake._routes():
+                    match = re.match(pattern, url.path)
+                    if method == self.command and match:
+                        status, index, data = route(
+                            parse_qs(url.query), body, **match.groupdict()
+                        )
+                        break
+                else:
+                    status, index, data = 404, fake.index, None
+
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.send_header("X-Nomad-Index", str(index))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+        return Handler
@@ -0,0 +1,111 @@
+import pytest
+import requests
+from unittest.mock import patch
+from redis.exceptions import ConnectionError as RedisConnectionError
+from sqlalchemy.exc import InvalidRequestError
+
+from app.services.allocation_sync import AllocationSync
+from app.services.usage import Usage
+from tests.factories.subdomain import ReservedSubdomainFactory
+from tests.factories.tunnel import TunnelFactory
+
+
+class TestAllocationSync(object):
+    """Tunnel rows follow their Nomad allocations"""
+
+    @patch("app.services.tunnel.tcp_port_pool")
+    @patch("app.services.tunnel.cleanup_old_nomad_box.queue")
+    def test_failed_allocation_fails_tunnel(
+        self,
+        mock_cleanup,
+        mock_pool,
+        current_user,
+        session,
+        fake_nomad,
+        fake_nomad_client,
+    ):
+        """ Tunnels whose container died are marked as failed and give back
+        what they held """
+        sub = ReservedSubdomainFactory(user=current_user, name="dead", in_use=True)
+        tun = TunnelFactory(
+            subdomain=sub,
+            job_id="ssh-client-dead",
+            port=["tcp"],
+            allocated_tcp_ports=[5001],
+        )
+        session.add(tun)
+        session.flush()
+        Usage(current_user.id).change(tunnels=1)
+
+        sync = AllocationSync(fake_nomad_client)
+        fake_nomad.register({"ID": "ssh-client-dead"})
+        sync.poll(block=False)
+        assert tun.status == "running"
+
+        alloc = next(iter(fake_nomad.allocations))
+        fake_nomad.set_status(alloc, "failed")
+
+        assert sync.poll() == 1
+        assert tun.status == "failed"
+        assert tun.allocated_tcp_ports == []
+        assert not sub.in_use
+        assert Usage(current_user.id).tunnels() == 0
+        mock_pool.release.assert_called_once_with("dead", [5001])
+        assert mock_cleanup.call_args[0][:2] == ("ssh-client-dead", "dead")
+
+        # Nothing is given back twice
+        fake_nomad.set_status(alloc, "complete")
+        assert sync.poll() == 0
+        assert Usage(current_user.id).tunnels() == 0
+
+    def test_rescheduled_allocation_moves_tunnel(
+        self, current_user, session, fake_nomad, fake_nomad_client
+    ):
+        """ Tunnels pick up the port of a replacement container """
+        tun = TunnelFactory(
+            subdomain__user=current_user, job_id="ssh-client-moved", ssh_port=1
+        )
+        session.add(tun)
+        session.flush()
+
+        fake_nomad.register({"ID": "ssh-client-moved"})
+        replacement = fake_nomad.add_allocation("ssh-client-moved", "running")
+
+        AllocationSync(fake_nomad_client).poll(block=False)
+
+        ssh_port = replacement["Resources"]["Networks"][0]["DynamicPorts"][0]
+        assert tun.ssh_port == ssh_port["Value"]
+        assert tun.ip_address == fake_nomad.nodes[0]["Address"]
+
+    def test_pending_tunnels_are_left_alone(
+        self, current_user, session, fake_nomad, fake_nomad_client
+    ):
+        """ Tunnels still being provisioned belong to their job """
+        tun = TunnelFactory(
+            subdomain__user=current_user, job_id="ssh-client-new", status="pending"
+        )
+        session.add(tun)
+        session.flush()
+
+        fake_nomad.register({"ID": "ssh-client-new"})
+
+        assert AllocationSync(fake_nomad_client).poll(block=False) == 0
+        assert tun.status == "pending"
+
+    @pytest.mark.parametrize(
+        "error", [InvalidRequestError, requests.ConnectionError, RedisConnectionError]
+    )
+    @patch("app.services.allocation_sync.db.session.rollback")
+    def test_errors_back_off(self, mock_rollback, error, fake_nomad_client):
+        """ A failed round is rolled back and retried after a while """
+        sync = AllocationSync(fake_nomad_client)
+
+        with patch.object(sync, "poll", side_effect=error):
+            with patch(
+                "app.services.allocation_sync.time.sleep", side_effect=StopIteration
+            ) as mock_sleep:
+                with pytest.raises(StopIteration):
+                    sync.run()
+
+        assert mock_rollback.called
+        assert 0 <= mock_sleep.call_args[0][0] <= 2
@@ -0,0 +1,110 @@
+import pytest
+from unittest.mock import patch
+
+from app import nomad_clusters
+from app.jobs.nomad_cleanup import cleanup_old_nomad_box
+from app.services.allocation_sync import AllocationSync
+from app.services.clusters import ClusterPlacement
+from app.services.tunnel import TunnelCreationService, TunnelDeletionService
+from tests.factories.subdomain import ReservedSubdomainFactory
+from tests.factories.tunnel import TunnelFactory
+from tests.support.fake_nomad import FakeNomad
+
+
+@pytest.fixture
+def east_nomad(app):
+    east = FakeNomad(
+        nodes=[{"ID": "east-node", "Address": "10.1.0.1", "Status": "ready"}]
+    ).start()
+    clusters = ["city=nomad", f"east=127.0.0.1:{east.port}"]
+    with patch.dict(app.config, {"NOMAD_CLUSTERS": clusters}), patch.object(
+        nomad_clusters, "clusters", {}
+    ):
+        yield east
+    east.stop()
+
+
+def tunnels_on(session, cluster, count, job_id="ssh-client-loaded"):
+    tunnels = [
+        TunnelFactory(job_id=job_id, cluster=cluster, status="running")
+        for _ in range(count)
+    ]
+    session.add_all(tunnels)
+    session.flush()
+    return tunnels
+
+
+class TestClusterPlacement(object):
+    """New tunnels are sharded over the Nomad clusters"""
+
+    def test_single_cluster(self, app):
+        """ With one cluster there is nothing to pick """
+        assert ClusterPlacement.pick("abox") == "city"
+
+    def test_hash_keeps_subdomain_on_cluster(self, east_nomad):
+        """ A subdomain lands on the same cluster every time """
+        names = ["city", "east"]
+        picks = {ClusterPlacement.by_hash(f"box{i}", names) for i in range(20)}
+
+        assert picks == {"city", "east"}
+        assert ClusterPlacement.pick("abox") == ClusterPlacement.pick("abox")
+
+    def test_least_loaded(self, app, session, east_nomad):
+        """ The cluster running the fewest tunnels is picked """
+        tunnels_on(session, None, 2)
+        tunnels_on(session, "east", 1)
+
+        with patch.dict(app.config, {"CLUSTER_STRATEGY": "least_loaded"}):
+            assert ClusterPlacement.pick("abox") == "east"
+            tunnels_on(session, "east", 2)
+            assert ClusterPlacement.pick("abox") == "city"
+
+
+@patch("app.services.tunnel.ClusterPlacement.pick", return_value="east")
+class TestShardedTunnels(object):
+    """Tunnels are created, deleted and kept in sync on their own cluster"""
+
+    def test_tunnel_lifecycle(
+        self,
+        mock_pick,
+        current_user,
+        session,
+        fake_nomad,
+        fake_nomad_client,
+        east_nomad,
+    ):
+        """ The tunnel only ever talks to the cluster it was placed on """
+        asub = ReservedSubdomainFactory(user=current_user, name="eastbox")
+        session.add(asub)
+        session.flush()
+
+        with patch("app.nomad_clients.client", return_value=fake_nomad_client):
+            tunnel = TunnelCreationService(
+                current_user, asub.id, ["http"], "ssh-rsa A"
+            ).create()
+
+        job = east_nomad.jobs[tunnel.job_id]
+        assert tunnel.cluster == "east"
+        assert tunnel.ip_address == "10.1.0.1"
+        assert job["Datacenters"] == ["east"]
+        assert fake_nomad.jobs == {}
+
+        with patch("app.services.tunnel.cleanup_old_nomad_box.queue") as mock_queue:
+            TunnelDeletionService(current_user, tunnel).delete()
+        cleanup_old_nomad_box(*mock_queue.call_args[0])
+
+        assert mock_queue.call_args[0][2] == "east"
+        assert tunnel.job_id not in east_nomad.jobs
+
+    def test_allocation_sync(self, mock_pick, session, east_nomad):
+        """ Only the tunnels on the cluster followed are updated """
+        [city] = tunnels_on(session, None, 1, job_id="ssh-client-twin")
+        [east] = tunnels_on(session, "east", 1, job_id="ssh-client-twin")
+
+        east_nomad.register({"ID": "ssh-client-twin"})
+        alloc = next(iter(east_nomad.allocations))
+        east_nomad.set_status(alloc, "failed")
+
+        assert AllocationSync(cluster="east").poll(block=False) == 1
+        assert east.status == "failed"
+        assert city.status == "running"
@@ -0,0 +1,147 @@
+import pytest
+from unittest.mock import patch
+
+from app import redis_client
+from app.services.hibernation import HIBERNATED_KEY, IDLE_KEY, Hibernation
+from app.services.tunnel import TunnelResumeService
+from app.utils.errors import NomadUnavailable
+from tests.factories.subdomain import ReservedSubdomainFactory
+from tests.factories.tunnel import TunnelFactory
+
+
+def checks(status):
+    return (
+        0,
+        [
+            {"ServiceName": "", "Status": "passing"},
+            {"ServiceName": "ssh-sleepybox-http", "Status": status},
+        ],
+    )
+
+
+@pytest.fixture
+def hibernation_config(app):
+    with patch.dict(app.config, {"HIBERNATE_AFTER": 60}):
+        redis_client.delete(IDLE_KEY, HIBERNATED_KEY)
+        yield app.config
+        redis_client.delete(IDLE_KEY, HIBERNATED_KEY)
+
+
+@pytest.fixture
+def idle_tunnel(current_user, session, fake_nomad):
+    sub = ReservedSubdomainFactory(user=current_user, name="sleepybox", in_use=True)
+    tun = TunnelFactory(
+        subdomain=sub,
+        job_id="ssh-client-sleepybox",
+        port=["tcp"],
+        allocated_tcp_ports=[5001],
+        status="running",
+    )
+    session.add(tun)
+    session.flush()
+
+    fake_nomad.register(
+        {"ID": tun.job_id, "TaskGroups": [{"Tasks": [{"Env": {"SSH_KEY": "A"}}]}]}
+    )
+    return tun
+
+
+class TestHibernation(object):
+    """Idle tunnels have their containers stopped until they are resumed"""
+
+    @patch("app.services.hibernation.consul.Consul")
+    def test_idle_tunnel_hibernates(
+        self,
+        mock_consul,
+        hibernation_config,
+        idle_tunnel,
+        fake_nomad,
+        fake_nomad_client,
+    ):
+        """ Only tunnels idle for longer than the threshold are stopped """
+        mock_consul.return_value.health.state.return_value = checks("critical")
+        hibernation = Hibernation(fake_nomad_client)
+
+        with patch(
+            "app.services.hibernation.nomad_clients.client",
+            return_value=fake_nomad_client,
+        ):
+            assert hibernation.run() == []
+            with patch("app.services.hibernation.time.time", return_value=1e10):
+                assert hibernation.run() == [idle_tunnel.job_id]
+
+        assert idle_tunnel.status == "hibernated"
+        assert idle_tunnel.allocated_tcp_ports == [5001]
+        assert idle_tunnel.subdomain.in_use
+        assert idle_tunnel.job_id not in fake_nomad.jobs
+        assert redis_client.hexists(HIBERNATED_KEY, idle_tunnel.job_id)
+
+    def test_hibernated_before_stopped(
+        self, hibernation_config, session, idle_tunnel, fake_nomad_client
+    ):
+        """ The tunnel is saved as hibernated before its container stops """
+        seen = []
+
+        def deregister(call):
+            seen.append((idle_tunnel.status, idle_tunnel in session.dirty))
+            return call(fake_nomad_client)
+
+        with patch(
+            "app.services.hibernation.nomad_clients.retry", side_effect=deregister
+        ):
+            Hibernation(fake_nomad_client).hibernate(idle_tunnel)
+
+        assert seen == [("hibernated", False)]
+
+    def test_failed_stop_keeps_tunnel_running(
+        self, hibernation_config, idle_tunnel, fake_nomad, fake_nomad_client
+    ):
+        """ A container that couldn't be stopped is still a running tunnel """
+        ssh_port = idle_tunnel.ssh_port
+
+        with patch(
+            "app.services.hibernation.nomad_clients.retry", side_effect=NomadUnavailable
+        ):
+            with pytest.raises(NomadUnavailable):
+                Hibernation(fake_nomad_client).hibernate(idle_tunnel)
+
+        assert idle_tunnel.status == "running"
+        assert idle_tunnel.ssh_port == ssh_port
+        assert idle_tunnel.job_id in fake_nomad.jobs
+        assert not redis_client.hexists(HIBERNATED_KEY, idle_tunnel.job_id)
+
+    @patch("app.services.hibernation.consul.Consul")
+    def test_connected_tunnel_stays(
+        self, mock_consul, hibernation_config, idle_tunnel, fake_nomad_client
+    ):
+        """ A tunnel whose client came back starts its idle time over """
+        mock_consul.return_value.health.state.return_value = checks("critical")
+        Hibernation(fake_nomad_client).run()
+
+        mock_consul.return_value.health.state.return_value = checks("passing")
+        with patch("app.services.hibernation.time.time", return_value=1e10):
+            assert Hibernation(fake_nomad_client).run() == []
+
+        assert not redis_client.hexists(IDLE_KEY, "sleepybox")
+        assert idle_tunnel.status == "running"
+
+    def test_resume(
+        self,
+        hibernation_config,
+        current_user,
+        idle_tunnel,
+        fake_nomad,
+        fake_nomad_client,
+    ):
+        """ Resuming registers the job as it was stopped """
+        with patch(
+            "app.services.hibernation.nomad_clients.client",
+            return_value=fake_nomad_client,
+        ):
+            Hibernation(fake_nomad_client).hibernate(idle_tunnel)
+            tunnel = TunnelResumeService(current_user, idle_tunnel).resume()
+
+        assert tunnel.status == "running"
+        assert tunnel.ssh_port
+        assert fake_nomad.jobs[tunnel.job_id]["Stop"] is False
+        assert not redis_client.hexists(HIBERNATED_KEY, tunnel.job_id)
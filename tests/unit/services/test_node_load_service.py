@@ -0,0 +1,27 @@
+from app import redis_client
+from app.services.node_load import LOAD_KEY, NodeLoad
+from tests.factories.tunnel import TunnelFactory
+
+
+class TestNodeLoad(object):
+    """Nodes are weighed by the plan bandwidth of their tunnels"""
+
+    def test_refresh(self, current_user, current_free_user, session):
+        """ Running tunnels count towards the node they run on """
+        for user, address, status in [
+            (current_user, "10.9.9.1", "running"),
+            (current_free_user, "10.9.9.1", "running"),
+            (current_free_user, "10.9.9.2", "running"),
+            (current_user, "10.9.9.2", "hibernated"),
+        ]:
+            session.add(
+                TunnelFactory(subdomain__user=user, ip_address=address, status=status)
+            )
+        session.flush()
+
+        load = NodeLoad.refresh()
+
+        assert load["10.9.9.1"] == 100100
+        assert load["10.9.9.2"] == 100
+        assert NodeLoad.read() == load
+        redis_client.delete(LOAD_KEY)
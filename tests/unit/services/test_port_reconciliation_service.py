@@ -0,0 +1,63 @@
+import pytest
+
+from app import redis_client
+from app.services.port_reconciliation import PortReconciliation
+from app.utils.tcp_ports import TcpPortPool
+from tests.factories.tunnel import TunnelFactory
+
+
+@pytest.fixture
+def pool(app):
+    pool = TcpPortPool(redis_client, key="test_reconciled_tcp_ports")
+    redis_client.delete(*pool.keys)
+    pool.resize(5001, 5005)
+    yield pool
+    redis_client.delete(*pool.keys)
+
+
+class TestPortReconciliation(object):
+    """The tcp port pool is repaired against the tunnels in the database"""
+
+    def test_allocated_ports_leave_the_pool(self, current_user, session, pool):
+        """ Ports the database has handed out are no longer free """
+        tun = TunnelFactory(
+            subdomain__user=current_user, port=["tcp"], allocated_tcp_ports=[5002]
+        )
+        session.add(tun)
+        session.flush()
+
+        drift = PortReconciliation(pool).run()
+
+        assert drift["allocated"] == 1
+        assert drift["owners"] == 1
+        assert pool.stats()["open"] == 3
+        assert pool.release(tun.subdomain.name, [5002]) == 1
+
+    def test_leaked_ports_return_on_second_run(self, pool):
+        """ Ports nobody holds come back once a second run agrees """
+        ports = pool.lease("gone", 1)
+        pool.confirm("gone", ports)
+
+        assert PortReconciliation(pool).run()["suspect"] == 1
+        assert pool.stats()["open"] == 3
+        assert PortReconciliation(pool).run()["leaked"] == 1
+        assert pool.stats()["open"] == 4
+
+    def test_unconfirmed_leases_are_left(self, pool):
+        """ Ports of tunnels still being created are not touched """
+        pool.lease("creating", 2)
+
+        drift = PortReconciliation(pool).run()
+
+        assert drift["suspect"] == 0
+        assert pool.stats()["unconfirmed"] == 2
+
+    def test_lost_ports_return(self, pool):
+        """ Taken ports without a lease go back to the pool """
+        redis_client.setbit(pool.bitmap_key, 5003, 0)
+
+        drift = PortReconciliation(pool).run()
+
+        assert drift["lost"] == 1
+        assert drift["counter"] == 1
+        assert pool.stats()["open"] == 4
@@ -0,0 +1,65 @@
+import pytest
+from unittest.mock import patch
+
+from app import nomad_clusters, redis_client
+from app.jobs.prepull import prepull_sshd_image
+from app.services.prepull import ImagePrepull
+from app.utils.job_spec import PREPULL_JOB_ID
+from tests.support.fake_nomad import FakeNomad
+
+WARM_KEYS = [ImagePrepull.warm_nodes_key(name) for name in ["city", "east"]]
+
+
+@pytest.fixture
+def prepull(app, fake_nomad_client, nomad_cluster):
+    redis_client.delete(*WARM_KEYS)
+    yield ImagePrepull(fake_nomad_client)
+    redis_client.delete(*WARM_KEYS)
+
+
+@pytest.fixture
+def east_nomad(app):
+    east = FakeNomad(
+        nodes=[{"ID": "east-node", "Address": "10.1.0.1", "Status": "ready"}]
+    ).start()
+    clusters = ["city=nomad", f"east=127.0.0.1:{east.port}"]
+    with patch.dict(app.config, {"NOMAD_CLUSTERS": clusters}), patch.object(
+        nomad_clusters, "clusters", {}
+    ):
+        yield east
+    east.stop()
+
+
+class TestImagePrepull(object):
+    """Every node keeps the current sshd image"""
+
+    def test_registered_once_per_image(self, app, prepull, fake_nomad):
+        """ The system job is only registered again when the image changes """
+        assert prepull.ensure()
+        assert not prepull.ensure()
+
+        with patch.dict(app.config, {"SSHD_IMAGE": "cypherpunkarmory/sshd:9.9.9"}):
+            assert prepull.ensure()
+
+        job = fake_nomad.jobs[PREPULL_JOB_ID]
+        assert job["Type"] == "system"
+        assert job["TaskGroups"][0]["Tasks"][0]["Config"]["image"].endswith("9.9.9")
+
+    def test_warm_nodes(self, prepull, fake_nomad):
+        """ Nodes running the job are known to have the image """
+        prepull.ensure()
+        node_id = fake_nomad.nodes[0]["ID"]
+
+        assert not ImagePrepull.warm(node_id)
+        assert prepull.refresh() == 1
+        assert ImagePrepull.warm(node_id)
+
+    def test_every_cluster(self, prepull, fake_nomad, east_nomad):
+        """ The nodes of every cluster get the image, and are warm there only """
+        assert prepull_sshd_image() == 2
+
+        job = east_nomad.jobs[PREPULL_JOB_ID]
+        assert job["Datacenters"] == ["east"]
+        assert fake_nomad.jobs[PREPULL_JOB_ID]["Datacenters"] == ["city"]
+        assert ImagePrepull.warm("east-node", "east")
+        assert not ImagePrepull.warm("east-node")
@@ -1,13 +1,41 @@
 import pytest
 
-from app.services.tunnel import TunnelCreationService
-from app.models import UserLimit
+from app.services.tunnel import Launch, TunnelCreationService, TunnelUpdateService
+from app.models import Tunnel, UserLimit
 from app.jobs.nomad_cleanup import del_tunnel_nomad
-from app.utils.errors import TunnelLimitReached
+from app.utils.errors import TunnelError, TunnelLimitReached
 from tests.factories.subdomain import SubdomainFactory, ReservedSubdomainFactory
+from tests.factories.tunnel import TunnelFactory
 from unittest.mock import patch
-import nomad
-from app.utils.dns import discover_service
+from app import nomad_lookups, redis_client
+from app.services.multiplex import Multiplexer
+from app.services.usage import Usage
+
+
+def running_tunnel(
+    current_user,
+    session,
+    fake_nomad,
+    ssh_key,
+    port=None,
+    tcp_ports=None,
+    job_id="ssh-client-runningbox",
+):
+    sub = ReservedSubdomainFactory(user=current_user, name="runningbox", in_use=True)
+    tun = TunnelFactory(
+        subdomain=sub,
+        job_id=job_id,
+        port=port or ["http"],
+        allocated_tcp_ports=tcp_ports or [0],
+        status="running",
+    )
+    session.add(tun)
+    session.flush()
+
+    fake_nomad.register(
+        {"ID": tun.job_id, "TaskGroups": [{"Tasks": [{"Env": {"SSH_KEY": ssh_key}}]}]}
+    )
+    return tun
 
 
 class TestTunnelCreationService(object):
@@ -31,8 +59,9 @@ class TestTunnelCreationService(object):
                     ssh_key="",
                 ).create()
 
-    @pytest.mark.vcr()
-    def test_third_invocation_of_named_tunnel_works(self, current_user, session):
+    def test_third_invocation_of_named_tunnel_works(
+        self, current_user, session, nomad_cluster, fake_nomad_client
+    ):
         asub = ReservedSubdomainFactory(user=current_user, name="bobjoeboe")
         session.add(asub)
         session.flush()
@@ -44,8 +73,7 @@ class TestTunnelCreationService(object):
             ssh_key="",
         ).create()
 
-        nomad_client = nomad.Nomad(discover_service("nomad").ip)
-        del_tunnel_nomad(nomad_client, first_time.job_id)
+        del_tunnel_nomad(fake_nomad_client, first_time.job_id)
         asub.in_use = False
         session.add(asub)
         session.flush()
@@ -57,8 +85,7 @@ class TestTunnelCreationService(object):
             ssh_key="",
         ).create()
 
-        nomad_client = nomad.Nomad(discover_service("nomad").ip)
-        del_tunnel_nomad(nomad_client, first_time.job_id)
+        del_tunnel_nomad(fake_nomad_client, first_time.job_id)
         asub.in_use = False
         session.add(asub)
         session.flush()
@@ -71,3 +98,274 @@ class TestTunnelCreationService(object):
         ).create()
 
         assert first_time.ssh_port != second_time.ssh_port != third_time.ssh_port
+
+    def test_tunnel_details(self, current_user, session, fake_nomad, fake_nomad_client):
+        """ Ports and node address are looked up once the job is running """
+        asub = ReservedSubdomainFactory(user=current_user, name="detailsbox")
+        session.add(asub)
+        session.flush()
+
+        with patch("app.nomad_clients.client", return_value=fake_nomad_client):
+            service = TunnelCreationService(current_user, asub.id, ["http"], "")
+
+        gathered = nomad_lookups.stats()["gathered"]
+        fake_nomad.register({"ID": "ssh-client-detailsbox"})
+        ssh_port, _ = service.get_tunnel_details("ssh-client-detailsbox")
+
+        assert ssh_port == 20000
+        assert nomad_lookups.stats()["gathered"] == gathered + 1
+
+    def test_launch_from_plan(self, current_user, session, fake_nomad, nomad_cluster):
+        """ A planned launch doesn't need the user or subdomain rows """
+        asub = ReservedSubdomainFactory(user=current_user, name="plannedbox")
+        session.add(asub)
+        session.flush()
+
+        service = TunnelCreationService(current_user, asub.id, ["http"], "")
+        plan = service.plan_launch()
+        service.current_user = service.subdomain = None
+
+        job_id, _, ssh_port, _ = service.launch(plan)
+
+        limits = current_user.limits()
+        assert plan == Launch(
+            "plannedbox", current_user.id, str(limits.bandwidth), limits.tunnel_count
+        )
+        assert job_id == "ssh-client-plannedbox"
+        assert job_id in fake_nomad.jobs
+        assert ssh_port == 20000
+
+    def test_dispatch_backend(
+        self, app, current_user, session, fake_nomad, fake_nomad_client
+    ):
+        """ Tunnels can be dispatched from one parameterized job per profile """
+        asub = ReservedSubdomainFactory(user=current_user, name="dispatchbox")
+        session.add(asub)
+        session.flush()
+
+        with patch("app.nomad_clients.client", return_value=fake_nomad_client), patch(
+            "app.utils.dispatch.registered", set()
+        ), patch.dict(app.config, {"TUNNEL_BACKEND": "dispatch"}):
+            service = TunnelCreationService(current_user, asub.id, ["tcp"], "ssh-rsa A")
+            job_id, _ = service.create_tunnel_nomad([5001])
+            service.create_tunnel_nomad([5002])
+            ssh_port, _ = service.get_tunnel_details(job_id)
+
+        assert job_id.startswith("ssh-dispatch-tcp/dispatch-")
+        assert fake_nomad.jobs[job_id]["Meta"]["tcp1"] == "5001"
+        assert fake_nomad.jobs["ssh-dispatch-tcp"]["ParameterizedJob"]
+        assert fake_nomad.count("/v1/jobs") == 1
+        assert ssh_port
+
+    @patch("app.services.multiplex.consul.Consul")
+    def test_multiplexed_backend(
+        self, mock_consul, app, current_user, session, fake_nomad, fake_nomad_client
+    ):
+        """ The tunnels of a user share one container, each in a slot """
+        subdomains = [
+            ReservedSubdomainFactory(user=current_user, name=name)
+            for name in ["sharedbox", "otherbox"]
+        ]
+        session.add_all(subdomains)
+        session.flush()
+        redis_client.delete(f"multiplex:ssh-user-{current_user.id}")
+
+        with patch(
+            "app.nomad_clients.client", return_value=fake_nomad_client
+        ), patch.dict(app.config, {"TUNNEL_BACKEND": "multiplexed"}):
+            services = [
+                TunnelCreationService(current_user, sub.id, ["http"], "ssh-rsa A")
+                for sub in subdomains
+            ]
+            job_ids = [service.create_tunnel_nomad([0])[0] for service in services]
+            Multiplexer(job_ids[0]).release("sharedbox")
+
+        task = fake_nomad.jobs[job_ids[0]]["TaskGroups"][0]["Tasks"][0]
+        assert job_ids == [f"ssh-user-{current_user.id}"] * 2
+        assert [service.slot for service in services] == [0, 1]
+        assert len(fake_nomad.allocations) == 1
+        assert [s["Name"] for s in task["Services"]] == ["ssh-otherbox-http"]
+        mock_consul.return_value.kv.put.assert_any_call(
+            f"holepunch/users/{job_ids[0]}/keys/1", "ssh-rsa A"
+        )
+        redis_client.delete(f"multiplex:{job_ids[0]}")
+
+    def test_reattach_reuses_healthy_tunnel(
+        self, current_user, session, fake_nomad, fake_nomad_client
+    ):
+        """ Reconnecting with the same key reuses the container untouched """
+        tun = running_tunnel(current_user, session, fake_nomad, "ssh-rsa AAAA")
+
+        with patch("app.nomad_clients.client", return_value=fake_nomad_client):
+            reattached = TunnelCreationService(
+                current_user, tun.subdomain_id, ["http"], "ssh-rsa AAAA"
+            ).reattach()
+
+        assert reattached == tun
+        assert [r for r in fake_nomad.requests if r[0] != "GET"] == []
+
+    def test_reattach_updates_key_in_place(
+        self, current_user, session, fake_nomad, fake_nomad_client
+    ):
+        """ Reconnecting with a new key updates the job instead of replacing it """
+        tun = running_tunnel(current_user, session, fake_nomad, "ssh-rsa AAAA")
+
+        with patch("app.nomad_clients.client", return_value=fake_nomad_client):
+            reattached = TunnelCreationService(
+                current_user, tun.subdomain_id, ["http"], "ssh-rsa BBBB"
+            ).reattach()
+
+        job = fake_nomad.jobs[tun.job_id]
+        assert reattached == tun
+        assert job["TaskGroups"][0]["Tasks"][0]["Env"]["SSH_KEY"] == "ssh-rsa BBBB"
+        assert tun.ssh_port == 20001
+        assert fake_nomad.count(f"/v1/job/{tun.job_id}") == 2
+        assert ("DELETE", f"/v1/job/{tun.job_id}") not in fake_nomad.requests
+
+    @pytest.mark.parametrize(
+        "job_id, purged",
+        [("ssh-client-runningbox", False), ("ssh-dispatch-http/dispatch-1-abc", True)],
+    )
+    @patch("app.services.tunnel.tcp_port_pool")
+    @patch("app.services.tunnel.cleanup_old_nomad_box.queue")
+    def test_reattach_drops_dead_tunnel(
+        self,
+        mock_cleanup,
+        mock_pool,
+        job_id,
+        purged,
+        current_user,
+        session,
+        fake_nomad,
+        fake_nomad_client,
+    ):
+        """ A tunnel whose container died makes way for a new one, the job
+        the new one registers again isn't purged from under it """
+        tun = running_tunnel(
+            current_user, session, fake_nomad, "ssh-rsa AAAA", ["tcp"], [5001], job_id
+        )
+        alloc_id = next(iter(fake_nomad.allocations))
+        fake_nomad.set_status(alloc_id, "failed")
+
+        with patch("app.nomad_clients.client", return_value=fake_nomad_client):
+            reattached = TunnelCreationService(
+                current_user, tun.subdomain_id, ["tcp"], "ssh-rsa AAAA"
+            ).reattach()
+
+        assert reattached is None
+        assert Tunnel.query.get(tun.id) is None
+        assert not tun.subdomain.in_use
+        mock_pool.release.assert_called_once_with("runningbox", [5001])
+        if purged:
+            mock_cleanup.assert_called_once_with(
+                job_id, "runningbox", "city", timeout=60000
+            )
+        else:
+            assert not mock_cleanup.called
+
+    @patch.object(
+        TunnelCreationService, "create_tunnel_nomad", return_value=("ssh-client-x", [0])
+    )
+    @patch.object(
+        TunnelCreationService, "get_tunnel_details", return_value=(2222, "10.0.0.1")
+    )
+    def test_provision_marks_tunnel_running(
+        self, mock_details, mock_create, current_user, session
+    ):
+        """ Provisioning a pending tunnel records where it ended up """
+        tun = TunnelFactory(subdomain__user=current_user, status="pending")
+        session.add(tun)
+        session.flush()
+
+        TunnelCreationService(
+            current_user, tun.subdomain_id, tun.port, "ssh-rsa AAAA"
+        ).provision(tun)
+
+        assert tun.status == "running"
+        assert tun.ssh_port == 2222
+        assert tun.ip_address == "10.0.0.1"
+
+    @patch("app.services.tunnel.tcp_port_pool")
+    @patch("app.services.tunnel.cleanup_old_nomad_box.queue")
+    @patch.object(
+        TunnelCreationService, "create_tunnel_nomad", return_value=("ssh-client-x", [0])
+    )
+    @patch.object(
+        TunnelCreationService, "get_tunnel_details", side_effect=TunnelError("Error")
+    )
+    def test_provision_failure_releases_tunnel(
+        self, mock_details, mock_create, mock_cleanup, mock_pool, current_user, session
+    ):
+        """ A tunnel that fails to provision gives back everything it held """
+        sub = ReservedSubdomainFactory(user=current_user, name="failbox", in_use=True)
+        tun = TunnelFactory(subdomain=sub, status="pending", allocated_tcp_ports=[5001])
+        session.add(tun)
+        session.flush()
+        Usage(current_user.id).change(tunnels=1)
+
+        TunnelCreationService(
+            current_user, tun.subdomain_id, tun.port, "ssh-rsa AAAA"
+        ).provision(tun)
+
+        assert Tunnel.query.get(tun.id).status == "failed"
+        assert tun.allocated_tcp_ports == []
+        assert not sub.in_use
+        assert Usage(current_user.id).tunnels() == 0
+        mock_pool.release.assert_called_once_with("failbox", [5001])
+        assert mock_cleanup.called
+
+
+@patch("app.services.tunnel.tcp_port_pool")
+class TestTunnelUpdateService(object):
+    """Tunnel update service only touches the ports that changed"""
+
+    def test_add_tcp_forward(
+        self, mock_pool, current_user, session, fake_nomad, nomad_cluster
+    ):
+        """ A new tcp forward takes one port and updates the job in place """
+        mock_pool.lease.return_value = [5002]
+        tun = running_tunnel(
+            current_user, session, fake_nomad, "ssh-rsa AAAA", ["tcp"], [5001]
+        )
+
+        TunnelUpdateService(current_user, tun, ["tcp", "tcp"]).update()
+
+        job = fake_nomad.jobs[tun.job_id]
+        assert tun.port == ["tcp", "tcp"]
+        assert tun.allocated_tcp_ports == [5001, 5002]
+        assert tun.ssh_port == 20001
+        assert job["TaskGroups"][0]["Tasks"][0]["Env"]["SSH_KEY"] == "ssh-rsa AAAA"
+        mock_pool.lease.assert_called_once_with("runningbox", 1)
+        assert ("DELETE", f"/v1/job/{tun.job_id}") not in fake_nomad.requests
+
+    def test_port_changes(self, mock_pool, current_user, session):
+        """ Kept forwards hold on to their ports, dropped ones give them back """
+        mock_pool.lease.return_value = []
+        tun = TunnelFactory(
+            subdomain__user=current_user,
+            port=["http", "tcp", "tcp"],
+            allocated_tcp_ports=[0, 5001, 5002],
+        )
+
+        with patch("app.nomad_clients.client"):
+            service = TunnelUpdateService(current_user, tun, ["tcp", "https"])
+
+        assert service.port_changes() == ([5001, 0], [], [5002])
+
+    @patch.object(
+        TunnelUpdateService, "get_tunnel_details", side_effect=TunnelError("Error")
+    )
+    def test_failed_update_rolls_back(
+        self, mock_details, mock_pool, current_user, session, fake_nomad, nomad_cluster
+    ):
+        """ A failed update puts the job back and returns the new ports """
+        mock_pool.lease.return_value = [5002]
+        tun = running_tunnel(current_user, session, fake_nomad, "ssh-rsa AAAA")
+
+        with pytest.raises(TunnelError, match="Failed to update tunnel"):
+            TunnelUpdateService(current_user, tun, ["http", "tcp"]).update()
+
+        task = fake_nomad.jobs[tun.job_id]["TaskGroups"][0]["Tasks"][0]
+        assert tun.port == ["http"]
+        assert len(task["Resources"]["Networks"][0]["DynamicPorts"]) == 2
+        mock_pool.release.assert_called_once_with("runningbox", [5002])
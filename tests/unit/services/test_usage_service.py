@@ -0,0 +1,70 @@
+from unittest.mock import patch
+
+from app.services.subdomain import SubdomainCreationService, SubdomainDeletionService
+from app.services.tunnel import TunnelDeletionService
+from app.services.usage import Usage
+from tests.factories.subdomain import ReservedSubdomainFactory
+from tests.factories.tunnel import TunnelFactory
+
+
+class TestUsage(object):
+    """Usage counters follow the tunnels and subdomains of a user"""
+
+    def test_counters_start_at_zero(self, current_user):
+        """ Users without a counter row have nothing open """
+        assert Usage(current_user.id).tunnels() == 0
+        assert Usage(current_user.id).reserved_subdomains() == 0
+
+    def test_reserve_and_release_subdomain(self, current_user):
+        """ Reserved subdomains are counted until they are released """
+        subdomain = SubdomainCreationService(current_user, "counted").reserve(True)
+        SubdomainCreationService(current_user, "uncounted").reserve(False)
+
+        assert Usage(current_user.id).reserved_subdomains() == 1
+
+        SubdomainDeletionService(current_user, subdomain).release()
+        assert Usage(current_user.id).reserved_subdomains() == 0
+
+    def test_tunnel_removal_counts_down(self, current_user, session):
+        """ Removing a tunnel takes it off the counter """
+        tun = TunnelFactory(subdomain__user=current_user)
+        session.add(tun)
+        session.flush()
+        Usage(current_user.id).change(tunnels=1)
+
+        TunnelDeletionService(current_user, tun).remove()
+        assert Usage(current_user.id).tunnels() == 0
+
+    def test_failed_tunnel_counted_once(self, current_user, session):
+        """ A failed tunnel left the counter already, deleting it later on
+        doesn't take it off again """
+        tun = TunnelFactory(subdomain__user=current_user)
+        session.add(tun)
+        session.flush()
+        Usage(current_user.id).change(tunnels=1)
+
+        with patch("app.services.tunnel.cleanup_old_nomad_box.queue") as mock_queue:
+            TunnelDeletionService(current_user, tun).fail()
+            assert Usage(current_user.id).tunnels() == 0
+            assert Usage.verify() == {}
+
+            TunnelDeletionService(current_user, tun).delete()
+
+        assert Usage(current_user.id).tunnels() == 0
+        assert mock_queue.call_count == 1
+
+    def test_verify_fixes_drift(self, current_user, session):
+        """ Counters that don't match the database are corrected """
+        sub = ReservedSubdomainFactory(user=current_user, name="drifted")
+        tun = TunnelFactory(subdomain__user=current_user)
+        session.add(sub)
+        session.add(tun)
+        session.flush()
+        Usage(current_user.id).change(tunnels=3)
+
+        drifted = Usage.verify()
+
+        assert drifted[current_user.id] == {"counted": [3, 0], "actual": [1, 1]}
+        assert Usage(current_user.id).tunnels() == 1
+        assert Usage(current_user.id).reserved_subdomains() == 1
+        assert Usage.verify() == {}
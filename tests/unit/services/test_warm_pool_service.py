@@ -0,0 +1,66 @@
+import pytest
+from unittest.mock import patch
+
+from app import redis_client
+from app.services.warm_pool import WarmPool
+
+
+@pytest.fixture
+def warm_pool_config(app):
+    with patch.dict(
+        app.config, {"WARM_POOL_TARGET": 2, "WARM_POOL_PROFILES": [["http"]]}
+    ):
+        redis_client.delete("warm_pool:http", "warm_pool_pending:http")
+        yield app.config
+        redis_client.delete("warm_pool:http", "warm_pool_pending:http")
+
+
+class TestWarmPool(object):
+    """Warm pool hands out pre-started sshd containers"""
+
+    def test_claim_disabled_without_target(self, fake_nomad_client):
+        """ Nothing is claimed when the pool is turned off """
+        assert (
+            WarmPool(["http"], fake_nomad_client).claim("abox", "ssh-rsa A", "1", [0])
+            is None
+        )
+
+    def test_claim_unknown_profile(self, warm_pool_config, fake_nomad_client):
+        """ Port profiles the pool does not keep fall through """
+        assert (
+            WarmPool(["tcp"], fake_nomad_client).claim("abox", "ssh-rsa A", "1", [9])
+            is None
+        )
+
+    def test_refill_starts_missing_containers(
+        self, warm_pool_config, fake_nomad, fake_nomad_client
+    ):
+        """ Refilling brings the pool up to its target """
+        pool = WarmPool(["http"], fake_nomad_client)
+
+        assert pool.refill() == 2
+        assert pool.size() == 2
+        assert all(
+            not job["TaskGroups"][0]["Tasks"][0]["Services"]
+            for job in fake_nomad.jobs.values()
+        )
+        assert pool.refill() == 0
+
+    @patch("app.services.warm_pool.consul.Consul")
+    def test_claim_binds_container_to_tunnel(
+        self, mock_consul, warm_pool_config, fake_nomad, fake_nomad_client
+    ):
+        """ Claiming writes the key to Consul and attaches the services """
+        pool = WarmPool(["http"], fake_nomad_client)
+        pool.refill()
+
+        job_id = pool.claim("abox", "ssh-rsa A", "100", [0])
+
+        assert job_id.startswith("ssh-pool-http-")
+        assert pool.size() == 1
+        mock_consul.return_value.kv.put.assert_any_call(
+            f"holepunch/pool/{job_id}/authorized_keys", "ssh-rsa A"
+        )
+        task = fake_nomad.jobs[job_id]["TaskGroups"][0]["Tasks"][0]
+        assert [s["Name"] for s in task["Services"]] == ["ssh-abox-http"]
+        assert "SSH_KEY" not in task["Env"]
@@ -0,0 +1,88 @@
+import pytest
+from unittest.mock import MagicMock, patch
+
+from app import nomad_clusters, redis_client
+from app.utils.admission import BUCKET_KEY, admit
+from app.utils.errors import TunnelCreationThrottled, TunnelLimitReached
+
+
+@pytest.fixture
+def buckets(app):
+    redis_client.delete(BUCKET_KEY, f"{BUCKET_KEY}:1", f"{BUCKET_KEY}:2")
+    with patch.dict(
+        app.config,
+        {
+            "ADMISSION_RATE": 0.01,
+            "ADMISSION_BURST": 3,
+            "ADMISSION_USER_RATE": 0.01,
+            "ADMISSION_USER_BURST": 2,
+        },
+    ):
+        yield app.config
+    redis_client.delete(BUCKET_KEY, f"{BUCKET_KEY}:1", f"{BUCKET_KEY}:2")
+
+
+@pytest.fixture
+def city(app):
+    return nomad_clusters.get()
+
+
+class TestAdmission(object):
+    """New tunnels are let through to Nomad at a limited rate"""
+
+    def test_user_bucket_runs_out(self, buckets, city):
+        """ A user is turned away once their own burst is used up """
+        admit(1, [city])
+        admit(1, [city])
+
+        with pytest.raises(TunnelCreationThrottled) as e:
+            admit(1, [city])
+        assert e.value.retry_after >= 1
+
+    def test_users_share_cluster_bucket(self, buckets, city):
+        """ Other users get in until the shared bucket is empty as well """
+        admit(1, [city], 2)
+        admit(2, [city])
+
+        with pytest.raises(TunnelCreationThrottled):
+            admit(2, [city])
+
+    def test_nothing_taken_when_turned_away(self, buckets, city):
+        """ A rejected request doesn't use up any tokens """
+        admit(1, [city])
+        with pytest.raises(TunnelCreationThrottled):
+            admit(1, [city], 2)
+
+        admit(2, [city], 2)
+
+    def test_batch_over_burst(self, buckets, city):
+        """ A batch bigger than a bucket is turned away for good """
+        with pytest.raises(TunnelLimitReached):
+            admit(1, [city], 3)
+
+        admit(1, [city], 2)
+        with pytest.raises(TunnelCreationThrottled):
+            admit(2, [city], 2)
+
+    def test_slow_nomad(self, buckets, city):
+        """ New tunnels are turned away while Nomad is slow to answer """
+        with patch.object(city.nomad, "latency", return_value=5000.0):
+            with pytest.raises(TunnelCreationThrottled):
+                admit(1, [city])
+
+    def test_slow_cluster(self, buckets, city):
+        """ A slow cluster only turns away the tunnels placed on it """
+        east = MagicMock()
+        east.nomad.latency.return_value = 5000.0
+
+        admit(1, [city])
+        with pytest.raises(TunnelCreationThrottled):
+            admit(2, [city, east])
+
+    @patch("app.utils.admission.Q.get_queue")
+    def test_backed_up_queue(self, mock_queue, buckets, city):
+        """ New tunnels are turned away while the nomad queue is backed up """
+        mock_queue.return_value.count = 1000
+        with patch.dict(buckets, {"ADMISSION_MAX_QUEUED": 10}):
+            with pytest.raises(TunnelCreationThrottled):
+                admit(1, [city])
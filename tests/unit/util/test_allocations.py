@@ -0,0 +1,80 @@
+import pytest
+import nomad
+from unittest.mock import patch
+
+from app.utils.allocations import AllocationWaiter
+from app.utils.errors import TunnelError
+
+
+class TestAllocationWaiter(object):
+    def test_returns_running_allocation(self, fake_nomad, fake_nomad_client):
+        """ Returns straight away when the allocation is already running """
+        alloc = fake_nomad.add_allocation("ssh-client-up", "running")
+
+        found = AllocationWaiter(fake_nomad_client).wait_until_running("ssh-client-up")
+
+        assert found["ID"] == alloc["ID"]
+        assert fake_nomad.count("/v1/job/ssh-client-up/allocations") == 1
+
+    def test_waits_with_blocking_queries(self, fake_nomad, fake_nomad_client):
+        """ A slow start costs a handful of round trips rather than a spin loop """
+        alloc = fake_nomad.add_allocation("ssh-client-slow", "pending")
+        fake_nomad.set_status_later(alloc["ID"], "running", 1)
+
+        waiter = AllocationWaiter(fake_nomad_client, deadline=5)
+        found = waiter.wait_until_running("ssh-client-slow")
+
+        assert found["ID"] == alloc["ID"]
+        assert waiter.round_trips <= 3
+
+    def test_gives_up_early_when_allocation_fails(self, fake_nomad, fake_nomad_client):
+        """ A failed allocation is reported without waiting for the deadline """
+        alloc = fake_nomad.add_allocation("ssh-client-broken", "pending")
+        fake_nomad.set_status_later(alloc["ID"], "failed", 0.2)
+
+        waiter = AllocationWaiter(fake_nomad_client, deadline=30)
+        with pytest.raises(TunnelError):
+            waiter.wait_until_running("ssh-client-broken")
+
+        assert waiter.round_trips <= 3
+
+    def test_gives_up_at_deadline(self, fake_nomad, fake_nomad_client):
+        """ Stops waiting once the deadline passes """
+        fake_nomad.add_allocation("ssh-client-stuck", "pending")
+
+        with pytest.raises(TunnelError):
+            AllocationWaiter(fake_nomad_client, deadline=1).wait_until_running(
+                "ssh-client-stuck"
+            )
+
+    def test_ignores_allocations_before_index(self, fake_nomad, fake_nomad_client):
+        """ Allocations from before a job update are not mistaken for new ones """
+        fake_nomad.add_allocation("ssh-client-updated", "running")
+        index = fake_nomad.bump()
+        alloc = fake_nomad.add_allocation("ssh-client-updated", "pending")
+        fake_nomad.set_status_later(alloc["ID"], "running", 0.2)
+
+        found = AllocationWaiter(fake_nomad_client, deadline=5).wait_until_running(
+            "ssh-client-updated", after_index=index
+        )
+
+        assert found["ID"] == alloc["ID"]
+
+    def test_backs_off_when_nomad_errors(self, fake_nomad, fake_nomad_client):
+        """ Errors talking to Nomad are retried with a jittered backoff """
+        fake_nomad.add_allocation("ssh-client-flaky", "running")
+        waiter = AllocationWaiter(fake_nomad_client, deadline=5)
+        real_request = fake_nomad_client.job.request
+        responses = [nomad.api.exceptions.BaseNomadException(None)]
+
+        def flaky_request(*args, **kwargs):
+            if responses:
+                raise responses.pop()
+            return real_request(*args, **kwargs)
+
+        with patch.object(fake_nomad_client.job, "request", side_effect=flaky_request):
+            with patch("app.utils.allocations.time.sleep") as mock_sleep:
+                waiter.wait_until_running("ssh-client-flaky")
+
+        assert mock_sleep.called
+        assert waiter.round_trips == 2
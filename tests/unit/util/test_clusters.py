@@ -0,0 +1,37 @@
+import pytest
+from unittest.mock import patch
+
+from app.utils.clusters import ClusterRegistry
+from app.utils.nodes import NodeAddressIndex
+from app.utils.nomad_client import NomadClientManager
+
+
+@pytest.fixture
+def registry(app, fake_nomad):
+    clusters = [f"city=127.0.0.1:{fake_nomad.port}", "east=nomad-east"]
+    with patch.dict(app.config, {"NOMAD_CLUSTERS": clusters}):
+        yield ClusterRegistry(NomadClientManager(), NodeAddressIndex())
+
+
+class TestClusterRegistry(object):
+    """Every Nomad cluster is reached through clients of its own"""
+
+    def test_first_cluster_is_default(self, registry, fake_nomad):
+        """ Tunnels without a cluster use the app wide clients of the first """
+        cluster = registry.get()
+
+        assert cluster is registry.get("city")
+        assert cluster.nomad is registry.default_nomad
+        assert cluster.nodes is registry.default_nodes
+        assert cluster.nomad.client().nodes.get_nodes() == fake_nomad.nodes
+        assert registry.is_default(None) and not registry.is_default("east")
+
+    def test_clusters_have_own_clients(self, registry):
+        """ Other clusters get their own servers and node index """
+        cluster = registry.get("east")
+
+        assert cluster.nomad is not registry.default_nomad
+        assert (cluster.nomad.service, cluster.nomad.port) == ("nomad-east", None)
+        assert cluster.nodes.nomad is cluster.nomad
+        assert cluster.datacenters == ["east"]
+        assert [c.name for c in registry.all()] == ["city", "east"]
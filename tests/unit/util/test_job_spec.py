@@ -0,0 +1,166 @@
+import json
+import pytest
+import re
+from pathlib import Path
+
+from app.utils.job_spec import (
+    build_multiplexed_sshd_job,
+    build_prepull_job,
+    build_sshd_dispatch_job,
+    build_sshd_job,
+    dispatch_meta,
+    load_affinities,
+    printable,
+    render_sshd_job,
+    slot_labels,
+)
+
+PORT_TYPES = [["http"], ["https"], ["tcp"], ["http", "https", "tcp", "tcp"]]
+
+# The entrypoint of the sshd image, see Dockerfile.ssh
+ENTRYPOINT = Path(__file__).parents[3] / "support" / "run_with_trickle.sh"
+
+
+def assert_image_reads(task):
+    """The sshd image reads everything the task hands it, and picks up the
+    files rendered into it on the signal Nomad sends when they change"""
+    script = ENTRYPOINT.read_text()
+    assert set(task["Env"]) <= set(re.findall(r"\$\{?([A-Z_]+)", script))
+    for template in task["Templates"] or []:
+        assert "/" + template["DestPath"] in task["Env"].values()
+        assert template["ChangeSignal"] == "SIGHUP"
+        assert "trap reload HUP" in script
+
+
+class TestJobSpec(object):
+    """Job specs are built without rendering sshd.j2.json"""
+
+    @pytest.mark.parametrize("port_types", PORT_TYPES)
+    @pytest.mark.parametrize(
+        "pool,box_name", [(False, "abox"), (True, None), (True, "abox")]
+    )
+    def test_matches_template(self, app, port_types, pool, box_name):
+        """ The built job is the same as the rendered one """
+        tcp_ports = [10000 + i if p == "tcp" else 0 for i, p in enumerate(port_types)]
+        args = ("ssh-client-abox", box_name, port_types, tcp_ports)
+        kwargs = dict(ssh_key="ssh-rsa AAAA test@holepunch", bandwidth="1", pool=pool)
+
+        assert json.loads(build_sshd_job(*args, **kwargs)) == json.loads(
+            render_sshd_job(*args, **kwargs)
+        )
+
+    @pytest.mark.parametrize("pool", [False, True])
+    def test_image_reads_job(self, app, pool):
+        """ Containers of their own and pool ones get what the image reads """
+        job = json.loads(
+            build_sshd_job("ssh-pool-http-1", None, ["http"], [0], pool=pool)
+        )["Job"]
+
+        assert_image_reads(job["TaskGroups"][0]["Tasks"][0])
+
+    def test_affinities_match_template(self, app):
+        """ The built job carries the same affinities as the rendered one """
+        args = ("ssh-client-abox", "abox", ["http"], [0])
+        affinities = load_affinities({"10.0.0.1": 100, "10.0.0.2": 0}, 5)
+
+        job = json.loads(build_sshd_job(*args, affinities=affinities))
+        assert job == json.loads(render_sshd_job(*args, affinities=affinities))
+        assert job["Job"]["Affinities"][0]["RTarget"] == "10.0.0.1"
+
+    def test_datacenters_match_template(self, app):
+        """ Jobs go to the datacenters of their cluster """
+        args = ("ssh-client-abox", "abox", ["http"], [0])
+
+        job = json.loads(build_sshd_job(*args, datacenters=["east"]))
+        assert job == json.loads(render_sshd_job(*args, datacenters=["east"]))
+        assert job["Job"]["Datacenters"] == ["east"]
+        assert json.loads(build_sshd_job(*args))["Job"]["Datacenters"] == ["city"]
+
+    def test_load_affinities(self):
+        """ Only the nodes above the average are steered away from """
+        load = {"10.0.0.1": 1000, "10.0.0.2": 600, "10.0.0.3": 100, "10.0.0.4": 100}
+
+        affinities = load_affinities(load, 5)
+
+        assert [(a["RTarget"], a["Weight"]) for a in affinities] == [
+            ("10.0.0.1", -100),
+            ("10.0.0.2", -60),
+        ]
+        assert len(load_affinities(load, 1)) == 1
+        assert load_affinities({"10.0.0.1": 5, "10.0.0.2": 5}, 5) is None
+        assert load_affinities(load, 0) is None
+
+    def test_ssh_key_is_escaped(self, app):
+        """ Keys can't break out of the job spec """
+        job = build_sshd_job("ssh-client-abox", "abox", ["http"], [0], ssh_key='a"b\\')
+
+        task = json.loads(job)["Job"]["TaskGroups"][0]["Tasks"][0]
+        assert task["Env"]["SSH_KEY"] == 'a"b\\'
+
+    def test_dispatch_job(self, app):
+        """ The dispatch job takes everything that differs from its metadata """
+        job = json.loads(build_sshd_dispatch_job(["http", "tcp"]))["Job"]
+        task = job["TaskGroups"][0]["Tasks"][0]
+        meta = dispatch_meta("abox", ["http", "tcp"], [0, 10001], "ssh-rsa A", "1")
+
+        assert job["ID"] == "ssh-dispatch-http-tcp"
+        assert job["Type"] == "batch"
+        assert sorted(job["ParameterizedJob"]["MetaRequired"]) == sorted(meta)
+        assert task["Env"]["SSH_KEY"] == "${NOMAD_META_ssh_key}"
+        assert task["Services"][1]["Tags"] == [
+            "urlprefix-0.0.0.0:${NOMAD_META_tcp2}/ proto=tcp"
+        ]
+        assert meta["tcp2"] == "10001"
+
+    def test_multiplexed_job(self, app):
+        """ Every slot gets the same ports, only the slots in use services """
+        job = json.loads(
+            build_multiplexed_sshd_job(
+                "ssh-user-1",
+                3,
+                {1: ("abox", ["tcp", "http"], [10001, 0])},
+                ["http", "https", "tcp"],
+            )
+        )["Job"]
+        task = job["TaskGroups"][0]["Tasks"][0]
+        port_map = task["Config"]["port_map"][0]
+        labels = [p["Label"] for p in task["Resources"]["Networks"][0]["DynamicPorts"]]
+
+        assert len(labels) == 10
+        assert port_map["s0http"] == 3000
+        assert port_map["s1tcp3"] == 3012
+        assert port_map["s2https"] == 3021
+        assert [(s["Name"], s["PortLabel"]) for s in task["Services"]] == [
+            ("ssh-abox-tcp1", "s1tcp3"),
+            ("ssh-abox-http", "s1http"),
+        ]
+        assert task["Services"][0]["Checks"][0]["PortLabel"] == "s1tcp3"
+        assert "SSH_KEY" not in task["Env"]
+        assert_image_reads(task)
+
+    def test_slot_labels(self):
+        """ Tunnels only go into a slot that has all their forwards """
+        slot_ports = ["http", "https", "tcp", "tcp"]
+
+        assert slot_labels(["tcp", "http", "tcp"], slot_ports) == [
+            "tcp3",
+            "http",
+            "tcp4",
+        ]
+        assert slot_labels(["tcp", "tcp", "tcp"], slot_ports) is None
+
+    def test_prepull_job(self, app):
+        """ The image is run on every node without taking any ports """
+        job = json.loads(build_prepull_job("cypherpunkarmory/sshd:1.0.0"))["Job"]
+        task = job["TaskGroups"][0]["Tasks"][0]
+
+        assert job["Type"] == "system"
+        assert job["Meta"] == {"image": "cypherpunkarmory/sshd:1.0.0"}
+        assert task["Config"]["image"] == "cypherpunkarmory/sshd:1.0.0"
+        assert task["Config"]["entrypoint"] == ["/bin/sh", "-c"]
+        assert "sleep" in task["Config"]["command"]
+        assert task["Resources"]["Networks"] is None
+
+    def test_printable(self):
+        """ Control and non ascii characters are dropped from keys """
+        assert printable("ssh-rsa\r\n AAAA\x00é\x7f") == "ssh-rsa AAAA"
@@ -0,0 +1,51 @@
+import pytest
+import time
+
+from app.utils.errors import TunnelError
+from app.utils.lookups import ConcurrentLookups
+
+
+def slow(value, seconds=0.2):
+    def lookup():
+        time.sleep(seconds)
+        return value
+
+    return lookup
+
+
+def broken():
+    raise TunnelError(detail="Broken")
+
+
+class TestConcurrentLookups(object):
+    """Independent lookups run side by side"""
+
+    def test_lookups_overlap(self, app):
+        """ Lookups take as long as the slowest of them """
+        lookups = ConcurrentLookups()
+
+        started = time.monotonic()
+        results = lookups.gather(5, one=slow(1), two=slow(2), three=slow(3))
+
+        assert results == {"one": 1, "two": 2, "three": 3}
+        assert time.monotonic() - started < 0.5
+        assert lookups.stats()["saved_ms"] > 300
+
+    def test_deadline_cancels_lookups(self, app):
+        """ Lookups still running at the deadline are given up on """
+        lookups = ConcurrentLookups()
+
+        with pytest.raises(TunnelError):
+            lookups.gather(0.05, quick=slow(1, 0), stuck=slow(2, 1))
+
+        assert lookups.stats()["timeouts"] == 1
+
+    def test_failures_are_raised(self, app):
+        """ The first lookup to fail stops the rest """
+        lookups = ConcurrentLookups()
+
+        started = time.monotonic()
+        with pytest.raises(TunnelError):
+            lookups.gather(5, broken=broken, stuck=slow(2, 1))
+
+        assert time.monotonic() - started < 0.5
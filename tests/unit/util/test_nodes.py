@@ -0,0 +1,60 @@
+import pytest
+import uuid
+from unittest.mock import patch
+
+from app.utils.errors import TunnelError
+from app.utils.nodes import NodeAddressIndex
+
+
+class TestNodeAddressIndex(object):
+    """Node addresses are looked up without listing every node"""
+
+    def test_lookups_share_one_listing(self, app, fake_nomad, fake_nomad_client):
+        """ Repeated lookups are answered from the index """
+        index = NodeAddressIndex()
+        node = fake_nomad.nodes[0]
+
+        for _ in range(5):
+            assert index.address(node["ID"], fake_nomad_client) == node["Address"]
+
+        assert fake_nomad.count("/v1/nodes") == 1
+
+    def test_unknown_node_refreshes(self, app, fake_nomad, fake_nomad_client):
+        """ A node that joined after the last refresh is picked up """
+        index = NodeAddressIndex()
+        index.address(fake_nomad.nodes[0]["ID"], fake_nomad_client)
+
+        node = {"ID": str(uuid.uuid4()), "Address": "10.0.0.2", "Status": "ready"}
+        fake_nomad.nodes.append(node)
+        fake_nomad.bump()
+
+        assert index.address(node["ID"], fake_nomad_client) == "10.0.0.2"
+        assert fake_nomad.count("/v1/nodes") == 2
+
+        with pytest.raises(TunnelError):
+            index.address("not-a-node", fake_nomad_client)
+
+    def test_refresh_after_ttl(self, app, fake_nomad, fake_nomad_client):
+        """ The index is listed again once its TTL runs out """
+        index = NodeAddressIndex()
+
+        with patch.dict(app.config, {"NODE_INDEX_TTL": -1}):
+            index.address(fake_nomad.nodes[0]["ID"], fake_nomad_client)
+            index.address(fake_nomad.nodes[0]["ID"], fake_nomad_client)
+
+        assert fake_nomad.count("/v1/nodes") == 2
+
+    def test_blocking_refresh_waits_for_changes(
+        self, app, fake_nomad, fake_nomad_client
+    ):
+        """ A blocking refresh returns as soon as the node list changes """
+        index = NodeAddressIndex()
+        index.refresh(fake_nomad_client)
+
+        node = {"ID": str(uuid.uuid4()), "Address": "10.0.0.3", "Status": "ready"}
+        fake_nomad.nodes.append(node)
+        fake_nomad.bump()
+        index.refresh(fake_nomad_client, block=True)
+
+        assert index.addresses[node["ID"]] == "10.0.0.3"
+        assert index.index == fake_nomad.index
@@ -0,0 +1,121 @@
+import pytest
+import nomad
+from unittest.mock import patch
+
+from app.utils.errors import NomadUnavailable
+from app.utils.nomad_client import CircuitBreaker, NomadClientManager
+
+
+@pytest.fixture
+def manager(app, fake_nomad):
+    with patch.dict(app.config, {"NOMAD_PORT": fake_nomad.port}):
+        yield NomadClientManager()
+
+
+class TestNomadClientManager(object):
+    @patch.object(NomadClientManager, "_resolve", return_value=[("127.0.0.1", 100)])
+    def test_clients_share_connections(self, mock_resolve, manager, fake_nomad):
+        """ Repeated clients reuse the same keep-alive connection """
+        for _ in range(5):
+            manager.client().nodes.get_nodes()
+
+        stats = manager.stats()
+        assert mock_resolve.call_count == 1
+        assert stats["endpoints"][0]["requests"] == 5
+        assert stats["endpoints"][0]["connections"] == 1
+
+    def test_failed_endpoint_is_ejected(self, manager, fake_nomad):
+        """ A server that stops answering is skipped until it has recovered """
+        resolved = [("127.0.0.1", 100), ("127.0.0.2", 100)]
+
+        with patch.object(NomadClientManager, "_resolve", return_value=resolved):
+            with patch("app.utils.nomad_client.random.choices") as mock_choices:
+                mock_choices.side_effect = lambda pop, weights, k: [pop[-1]]
+                with pytest.raises(nomad.api.exceptions.BaseNomadException):
+                    manager.client().nodes.get_nodes()
+
+                # only the healthy server is left to pick from
+                manager.client().nodes.get_nodes()
+
+        stats = {e["ip"]: e for e in manager.stats()["endpoints"]}
+        assert stats["127.0.0.2"]["ejected"]
+        assert stats["127.0.0.2"]["failures"] == 1
+        assert stats["127.0.0.1"]["requests"] == 1
+
+    @patch.object(NomadClientManager, "_resolve", return_value=[("127.0.0.1", 100)])
+    def test_endpoints_reresolved_after_ttl(self, mock_resolve, app, manager):
+        """ Servers are looked up again once their TTL runs out """
+        with patch.dict(app.config, {"NOMAD_ENDPOINT_TTL": -1}):
+            manager.client()
+            manager.client()
+
+        assert mock_resolve.call_count == 2
+
+
+def pick_last(pop, weights, k):
+    return [pop[-1]]
+
+
+class TestCircuitBreaker(object):
+    @patch.object(NomadClientManager, "_resolve", return_value=[("127.0.0.2", 100)])
+    def test_opens_after_failures(self, mock_resolve, app, manager):
+        """ Nomad isn't called anymore once it failed too often in a row """
+        with patch.dict(app.config, {"NOMAD_BREAKER_FAILURES": 2}):
+            for _ in range(2):
+                with pytest.raises(nomad.api.exceptions.BaseNomadException):
+                    manager.client().nodes.get_nodes()
+
+            with pytest.raises(NomadUnavailable) as error:
+                manager.client().nodes.get_nodes()
+
+        stats = manager.stats()
+        assert error.value.retry_after == app.config["NOMAD_BREAKER_RESET"]
+        assert stats["breaker"]["state"] == CircuitBreaker.OPEN
+        assert stats["breaker"]["rejected"] == 1
+        assert stats["endpoints"][0]["requests"] == 2
+
+    @patch.object(NomadClientManager, "_resolve", return_value=[("127.0.0.1", 100)])
+    def test_probe_closes_circuit(self, mock_resolve, app, manager, fake_nomad):
+        """ A request is let through after a while and closes the circuit """
+        with patch.dict(app.config, {"NOMAD_BREAKER_FAILURES": 1}):
+            manager.breaker.failure()
+
+        with pytest.raises(NomadUnavailable):
+            manager.breaker.check()
+
+        with patch.dict(app.config, {"NOMAD_BREAKER_RESET": 0}):
+            manager.client().nodes.get_nodes()
+
+        assert manager.breaker.state == CircuitBreaker.CLOSED
+        assert manager.stats()["breaker"]["trips"] == 1
+
+
+@patch("app.utils.nomad_client.time.sleep")
+@patch("app.utils.nomad_client.random.choices", side_effect=pick_last)
+@patch.object(
+    NomadClientManager,
+    "_resolve",
+    return_value=[("127.0.0.1", 100), ("127.0.0.2", 100)],
+)
+class TestRetry(object):
+    def test_retries_on_another_server(
+        self, mock_resolve, mock_choices, mock_sleep, manager, fake_nomad
+    ):
+        """ A failed call is retried on a server that is still up """
+        nodes = manager.retry(lambda client: client.nodes.get_nodes())
+
+        assert nodes == fake_nomad.nodes
+        assert manager.stats()["retry_budget"]["retries"] == 1
+        assert mock_sleep.call_count == 1
+
+    def test_no_retries_without_budget(
+        self, mock_resolve, mock_choices, mock_sleep, manager, fake_nomad
+    ):
+        """ Retries stop once they make up too much of the traffic """
+        manager.budget.balance = 0
+
+        with pytest.raises(nomad.api.exceptions.BaseNomadException):
+            manager.retry(lambda client: client.nodes.get_nodes())
+
+        assert manager.stats()["retry_budget"]["exhausted"] == 1
+        assert fake_nomad.count("/v1/nodes") == 0
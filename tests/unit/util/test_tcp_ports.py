@@ -0,0 +1,108 @@
+import pytest
+from unittest.mock import patch
+
+from app import redis_client
+from app.utils.errors import TunnelError
+from app.utils.tcp_ports import TcpPortPool
+
+
+@pytest.fixture
+def pool(app):
+    pool = TcpPortPool(redis_client, key="test_tcp_ports")
+    redis_client.delete(*pool.keys)
+    pool.resize(5001, 5004)
+    yield pool
+    redis_client.delete(*pool.keys)
+
+
+class TestTcpPortPool(object):
+    """Tcp ports are leased to tunnels in single round trips"""
+
+    def test_lease_confirm_release(self, pool):
+        """ Leased ports are kept once confirmed and come back on release """
+        ports = pool.lease("box", 2)
+
+        assert len(ports) == 2
+        assert pool.stats() == {
+            "open": 1,
+            "leased": 2,
+            "unconfirmed": 2,
+            "range": [5001, 5004],
+        }
+        assert pool.confirm("box", ports + [0]) == 2
+        assert pool.stats()["unconfirmed"] == 0
+        assert pool.release("box", ports) == 2
+        assert pool.stats()["open"] == 3
+        assert pool.stats()["leased"] == 0
+
+    def test_lease_all_or_nothing(self, pool):
+        """ Nothing is taken when there aren't enough ports """
+        with pytest.raises(TunnelError):
+            pool.lease("box", 4)
+
+        assert pool.stats()["open"] == 3
+
+    def test_expired_leases_return(self, app, pool):
+        """ Ports of a tunnel that never got confirmed go back to the pool """
+        with patch.dict(app.config, {"TCP_PORT_LEASE_SECONDS": -1}):
+            pool.lease("crashed", 3)
+
+        assert sorted(pool.lease("box", 3)) == [5001, 5002, 5003]
+
+    def test_release_only_own_ports(self, pool):
+        """ Ports leased to somebody else are left alone """
+        ports = pool.lease("box", 1)
+
+        assert pool.release("other", ports) == 0
+        assert pool.confirm("other", ports) == 0
+        assert pool.stats()["leased"] == 1
+
+    def test_lease_contiguous_block(self, pool):
+        """ Several ports are taken as a block when there is one """
+        pool.resize(5001, 5007)
+        for owner in ["a", "b", "c", "d"]:
+            pool.lease(owner, 1)
+        pool.release("a", [5001])
+        pool.release("b", [5002])
+        pool.release("d", [5004])
+
+        assert pool.lease("box", 3) == [5004, 5005, 5006]
+
+    def test_lease_scattered_ports(self, pool):
+        """ Ports are still handed out when no block is left """
+        pool.lease("a", 1)
+        pool.lease("b", 1)
+        pool.lease("c", 1)
+        pool.release("b", [5002])
+        pool.resize(5001, 5005)
+
+        assert sorted(pool.lease("box", 2)) == [5002, 5004]
+
+    def test_resize_skips_leased(self, pool):
+        """ Growing the pool doesn't hand out leased ports twice """
+        ports = pool.lease("box", 1)
+        pool.resize(5001, 5005)
+
+        assert pool.stats()["open"] == 3
+        assert ports[0] not in pool.lease("other", 3)
+
+    def test_resize_shrinks(self, pool):
+        """ Ports leaving the range are no longer handed out """
+        ports = pool.lease("box", 1)
+        pool.resize(5002, 5003)
+
+        assert ports == [5001]
+        assert pool.stats()["open"] == 1
+        assert pool.release("box", ports) == 0
+        assert pool.stats()["leased"] == 0
+        assert pool.lease("other", 1) == [5002]
+
+    def test_resize_converts_set(self, pool):
+        """ A pool kept as a set of free ports is moved into the bitmap """
+        redis_client.delete(*pool.keys)
+        redis_client.sadd(pool.key, 5001, 5003, 6000)
+        pool.resize(5001, 5004)
+
+        assert pool.stats()["open"] == 2
+        assert not redis_client.exists(pool.key)
+        assert sorted(pool.lease("box", 2)) == [5001, 5003]
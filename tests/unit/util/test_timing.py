@@ -0,0 +1,48 @@
+import pytest
+
+from app import redis_client
+from app.utils.timing import PhaseTimer, percentile, phase_summary
+
+
+@pytest.fixture
+def clean_timings(app):
+    keys = ["phase_timings:test", "phase_timings:test:one", "phase_timings:test:two"]
+    redis_client.delete(*keys)
+    yield
+    redis_client.delete(*keys)
+
+
+class TestPhaseTimer(object):
+    """Phases of tunnel creation are timed"""
+
+    def test_flush_feeds_summary(self, clean_timings):
+        """ Flushed timings show up in the phase summary """
+        timer = PhaseTimer("test")
+        for _ in range(3):
+            with timer.phase("one"):
+                pass
+        with timer.phase("two"):
+            pass
+        timer.flush()
+
+        summary = phase_summary("test")
+        assert summary["one"]["count"] == 3
+        assert summary["two"]["count"] == 1
+        assert set(summary["one"]) == {"count", "p50", "p95", "p99"}
+        assert timer.timings == []
+
+    def test_failed_phase_is_timed(self, clean_timings):
+        """ Phases that raise are still recorded """
+        timer = PhaseTimer("test")
+        with pytest.raises(ValueError):
+            with timer.phase("one"):
+                raise ValueError()
+
+        assert [phase for phase, _ in timer.timings] == ["one"]
+
+    def test_percentile(self):
+        """ Percentiles use the nearest rank """
+        samples = list(range(1, 101))
+        assert percentile(samples, 50) == 50
+        assert percentile(samples, 99) == 99
+        assert percentile([7], 95) == 7